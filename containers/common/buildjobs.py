@@ -0,0 +1,68 @@
+"""Derive the build parallelism of each building block from the cores and
+the memory available on the build host.
+
+Each building block is given the memory (MiB) expected for each compile
+job and for each link job. At build time, the build-jobs script installed
+in the image prints the largest number of jobs N such that N - 1 compile
+jobs and one link job fit into the available memory (MemAvailable, or the
+cgroup limit of the build if lower), capped at the number of cores:
+
+    make -j$(build-jobs 3000 6000)
+"""
+
+from hpccm.primitives import comment
+
+from scripts import install_script
+
+BUILD_JOBS = "/usr/local/bin/build-jobs"
+
+BUILD_JOBS_SCRIPT = [
+    "#!/bin/sh",
+    "# Usage: build-jobs <MiB per compile job> [<MiB per link job>]",
+    "compile=$1",
+    "link=${2:-$1}",
+    'avail=$(awk "/^MemAvailable:/ {print int(\\$2 / 1024)}" /proc/meminfo)',
+    "if [ -r /sys/fs/cgroup/memory.max ] && [ $(cat /sys/fs/cgroup/memory.max) != max ]; then",
+    "    limit=$(( ($(cat /sys/fs/cgroup/memory.max) - $(cat /sys/fs/cgroup/memory.current)) / 1048576 ))",
+    "    [ $limit -lt $avail ] && avail=$limit",
+    "fi",
+    "jobs=$(( (avail - link) / compile + 1 ))",
+    "[ $jobs -gt $(nproc) ] && jobs=$(nproc)",
+    "[ $jobs -lt 1 ] && jobs=1",
+    'echo "build-jobs: ${avail} MiB available, ${jobs} jobs" >&2',
+    "echo $jobs",
+]
+
+
+class BuildJobs:
+    """Build parallelism of the building blocks of a recipe.
+
+    # Parameters
+
+    mode: "nproc" (default) to use one job per core, "auto" to derive the
+    number of jobs from the available memory, or a fixed number of jobs.
+    """
+
+    def __init__(self, mode="nproc"):
+        if mode not in ["nproc", "auto"] and not mode.isdigit():
+            raise ValueError("Invalid build parallelism: {}".format(mode))
+        self.mode = mode
+
+    def parallel(self, compile_mib, link_mib=None, default="$(nproc)"):
+        """Return the number of jobs of a building block, given the memory
+        required by each compile and link job (default is returned in
+        "nproc" mode)"""
+        if self.mode == "nproc":
+            return default
+        if self.mode == "auto":
+            return "$({} {} {})".format(BUILD_JOBS, compile_mib, link_mib or compile_mib)
+        return self.mode
+
+    def layers(self):
+        """Return the layers installing the build-jobs script"""
+        if self.mode != "auto":
+            return []
+        return [
+            comment("Memory-aware build parallelism"),
+            install_script(BUILD_JOBS, BUILD_JOBS_SCRIPT),
+        ]
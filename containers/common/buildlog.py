@@ -0,0 +1,207 @@
+"""Record the wall time, CPU time and memory used by each building block.
+
+Every building block of the devel stage is preceded and followed by a call
+to the build-log script installed in the first step:
+
+    build-log start <step> <block> <description>
+    ...
+    build-log end <step>
+
+which appends one JSON record per block to the log file, e.g.
+
+    {"step": "step3", "block": "boost", "wall_s": 512.3, "cpu_s": 30021.6,
+     "cores": 72, "cpu_efficiency": 0.814, "mem_peak_mib": 21345, ...}
+
+Records of the same build of a step share the same run identifier, i.e.,
+the shell running the %post section of the step, and the memory is sampled
+by a process started by "build-log start", which lives as long as that
+shell. The log therefore needs all layers of a step to run in the same
+shell, as with Singularity/Apptainer (or bash) definitions: with Docker,
+each layer runs in its own container, so it is not supported. CPU time and
+memory are
+measured for the whole build host (busy time in /proc/stat, MemTotal -
+MemAvailable sampled every second), so builds should not share the host
+with other workloads. The log can be written inside the image, or in a
+directory bind-mounted during the build, so that the records of all steps
+(also built at the same time) end up in the same file. Records are
+summarized by scripts/build_report.py.
+"""
+
+import os
+import shlex
+
+import hpccm
+from hpccm.primitives import comment, shell
+
+from buildsteps import block_prefix
+from scripts import install_script
+
+BUILD_LOG = "/usr/local/bin/build-log"
+
+BUILD_LOG_SCRIPT = [
+    "#!/usr/bin/env python3",
+    "import json, os, signal, socket, sys, time",
+    "LOG = {log!r}",
+    "STATE = '/tmp/build-log'",
+    "",
+    "def cpu_seconds():",
+    "    with open('/proc/stat') as f:",
+    "        fields = [int(x) for x in f.readline().split()[1:]]",
+    "    busy = sum(fields[:8]) - fields[3] - fields[4]",
+    "    return busy / os.sysconf('SC_CLK_TCK')",
+    "",
+    "def memory_mib():",
+    "    info = {{}}",
+    "    with open('/proc/meminfo') as f:",
+    "        for line in f:",
+    "            key, value = line.split(':')",
+    "            info[key] = int(value.split()[0])",
+    "    return (info['MemTotal'] - info['MemAvailable']) / 1024",
+    "",
+    "def run_id(pid):",
+    "    # Identify the shell running the step (i.e. one build of the step)",
+    "    with open('/proc/{{}}/stat'.format(pid)) as f:",
+    "        started = f.read().rsplit(')', 1)[1].split()[19]",
+    "    with open('/proc/sys/kernel/random/boot_id') as f:",
+    "        boot = f.read().strip()[:8]",
+    "    return '{{}}-{{}}-{{}}-{{}}'.format(socket.gethostname(), boot, pid, started)",
+    "",
+    "def start(step, block, description):",
+    "    os.makedirs(STATE, exist_ok=True)",
+    "    path = os.path.join(STATE, step)",
+    "    state = dict(step=step, block=block, description=description,",
+    "                 run=run_id(os.getppid()), start=time.time(),",
+    "                 cpu=cpu_seconds(), mem=memory_mib())",
+    "    with open(path, 'w') as f:",
+    "        json.dump(state, f)",
+    "    # Sample memory usage in the background until the block ends",
+    "    parent = os.getppid()",
+    "    child = os.fork()",
+    "    if child:",
+    "        os.waitpid(child, 0)",
+    "        return",
+    "    os.setsid()",
+    "    sampler = os.fork()",
+    "    if sampler:",
+    "        with open(path + '.pid', 'w') as f:",
+    "            f.write(str(sampler))",
+    "        os._exit(0)",
+    "    devnull = os.open(os.devnull, os.O_RDWR)",
+    "    for fd in [0, 1, 2]:",
+    "        os.dup2(devnull, fd)",
+    "    peak = state['mem']",
+    "    while os.path.exists(path) and os.path.exists('/proc/{{}}'.format(parent)):",
+    "        peak = max(peak, memory_mib())",
+    "        with open(path + '.peak.tmp', 'w') as f:",
+    "            f.write(str(peak))",
+    "        os.rename(path + '.peak.tmp', path + '.peak')",
+    "        time.sleep(1)",
+    "    os._exit(0)",
+    "",
+    "def end(step):",
+    "    path = os.path.join(STATE, step)",
+    "    if not os.path.exists(path):",
+    "        return",
+    "    with open(path) as f:",
+    "        state = json.load(f)",
+    "    try:",
+    "        with open(path + '.pid') as f:",
+    "            os.kill(int(f.read()), signal.SIGTERM)",
+    "    except (OSError, ValueError):",
+    "        pass",
+    "    peak = max(state['mem'], memory_mib())",
+    "    if os.path.exists(path + '.peak'):",
+    "        with open(path + '.peak') as f:",
+    "            peak = max(peak, float(f.read()))",
+    "    wall = time.time() - state['start']",
+    "    cpu = cpu_seconds() - state['cpu']",
+    "    cores = os.cpu_count()",
+    "    record = dict(",
+    "        step=state['step'],",
+    "        block=state['block'],",
+    "        description=state['description'],",
+    "        host=socket.gethostname(),",
+    "        run=state['run'],",
+    "        start=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(state['start'])),",
+    "        wall_s=round(wall, 1),",
+    "        cpu_s=round(cpu, 1),",
+    "        cores=cores,",
+    "        cpu_efficiency=round(cpu / (wall * cores), 3) if wall > 0 else 0.0,",
+    "        mem_start_mib=round(state['mem']),",
+    "        mem_peak_mib=round(peak),",
+    "    )",
+    "    os.makedirs(os.path.dirname(LOG), exist_ok=True)",
+    "    with open(LOG, 'a') as f:",
+    "        f.write(json.dumps(record) + '\\n')",
+    "    for suffix in ['', '.pid', '.peak', '.peak.tmp']:",
+    "        if os.path.exists(path + suffix):",
+    "            os.remove(path + suffix)",
+    "",
+    "if sys.argv[1] == 'start':",
+    "    start(*sys.argv[2:5])",
+    "else:",
+    "    end(sys.argv[2])",
+]
+
+
+def block_name(layer):
+    """Return a short name for a building block"""
+    name = layer.__class__.__name__
+    prefix = block_prefix(layer)
+    if name.startswith("generic_") and prefix:
+        return os.path.basename(prefix)
+    return name
+
+
+class BuildLog:
+    """Log of the resources used by each building block of a recipe.
+
+    # Parameters
+
+    log: path of the JSON lines log file in the container. If empty, the
+    building blocks are not instrumented. Not supported with Docker.
+    """
+
+    def __init__(self, log=""):
+        self.log = log
+        if self.enabled and hpccm.config.g_ctype == hpccm.container_type.DOCKER:
+            raise ValueError(
+                "The build log needs the layers of a step to run in one shell, "
+                "use the Singularity or bash format"
+            )
+
+    @property
+    def enabled(self):
+        return bool(self.log)
+
+    def layers(self):
+        """Return the layers installing the build-log script"""
+        if not self.enabled:
+            return []
+        script = [line.format(log=self.log) for line in BUILD_LOG_SCRIPT]
+        return [
+            comment("Building block instrumentation"),
+            install_script(BUILD_LOG, script),
+        ]
+
+    def instrument(self, step, layer, description):
+        """Return a layer preceded and followed by the calls to the
+        build-log script (skipped until it is installed)"""
+        return [
+            shell(
+                commands=[
+                    "if [ -x {0} ]; then {0} start {1} {2} {3}; fi".format(
+                        BUILD_LOG,
+                        step.name,
+                        shlex.quote(block_name(layer)),
+                        shlex.quote(description),
+                    )
+                ]
+            ),
+            layer,
+            shell(
+                commands=[
+                    "if [ -x {0} ]; then {0} end {1}; fi".format(BUILD_LOG, step.name)
+                ]
+            ),
+        ]
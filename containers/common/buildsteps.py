@@ -0,0 +1,590 @@
+"""Group the building blocks of a recipe stage into build steps.
+
+Steps are delimited in the generated recipe by comments like
+
+    # stepN: start
+
+which are used by scripts/generate_steps.sh to split a definition file in
+one file per step. In "linear" mode (the default) each step is built on top
+of the previous one. In "graph" mode each step is built on top of the steps
+it depends on, so that independent steps can be built at the same time, and
+the install prefixes of the other dependencies are copied into it:
+
+    # stepN: start after stepP stepK    (stepP is the bootstrap image)
+    # stepN: prefix /usr/local/foo      (prefixes installed by stepN)
+    # stepN: merge stepJ from stepK     (copy prefixes of stepJ from stepK)
+
+In "layered" mode steps are built one on top of the other as in "linear"
+mode, but the steps which do not depend on site-specific steps (e.g. the
+network stack) are built first, so that they are shared by the images of
+all sites with the same architecture (see scripts/build_steps.sh).
+
+OS packages installed by the building blocks can be coalesced into a single
+apt-get transaction at the start of the first step (and of the runtime
+stage), instead of one apt-get update and install for each block.
+
+The application files can be shipped in a separate overlay instead of the
+runtime image. The runtime image is then built from the steps preceding
+the application (so that it does not change when only the application
+does), and the last step lists the paths of the overlay and the steps
+providing them:
+
+    # stepN: overlay /usr/local/app1 /usr/local/app2 from stepJ stepK
+"""
+
+import hpccm.building_blocks as bb
+from hpccm.building_blocks.base import bb_instructions
+from hpccm.primitives import comment, environment
+
+# Layers that do not install anything by themselves
+NEUTRAL_LAYERS = ["comment", "environment", "label"]
+
+# Prefixes that are shared with the base image, and cannot be copied
+# from one step to another
+SYSTEM_PREFIXES = ["/", "/usr", "/usr/local", "/opt"]
+
+
+def block_prefix(block):
+    """Return the install prefix of a building block, if any"""
+    for name, value in vars(block).items():
+        if name == "prefix" or name.endswith("__prefix"):
+            if isinstance(value, str) and value.rstrip("/") not in SYSTEM_PREFIXES:
+                return value.rstrip("/")
+    return None
+
+
+def is_plain_apt(layer):
+    """Check whether a layer is an apt-get install not requiring extra
+    keys or repositories, i.e., one that can be moved to another step"""
+    return layer.__class__.__name__ == "apt_get" and not (
+        layer._apt_get__keys
+        or layer._apt_get__ppas
+        or layer._apt_get__repositories
+        or layer._apt_get__download
+        or layer._apt_get__aptitude
+    )
+
+
+def strip_ospackages(layer):
+    """Remove plain apt-get installs from a building block (recursively)
+    and return the list of packages they installed"""
+    ospackages = []
+    instructions = getattr(layer, "_bb_instructions__instructions_bb", [])
+    for child in list(instructions):
+        if is_plain_apt(child):
+            ospackages.extend(child.ospackages)
+            instructions.remove(child)
+        else:
+            ospackages.extend(strip_ospackages(child))
+    return ospackages
+
+
+class Step:
+    """A build step, i.e., a list of layers built into the same image"""
+
+    def __init__(self, description, after, prefix, branch, site_specific):
+        self.description = description
+        self.after = after
+        self.prefix = list(prefix or [])
+        self.branch = branch
+        self.layers = []
+        self.name = None
+        # Step the layers are built in, in "linear" and "layered" mode
+        self.built = None
+        self.__site_specific = site_specific
+
+    @property
+    def site_specific(self):
+        """Check whether the step, or any step it depends on, is specific
+        to a site"""
+        return self.__site_specific or any(s.site_specific for s in self.after)
+
+    @property
+    def prefixes(self):
+        """Install prefixes of the step, i.e., the explicit ones and those
+        of its building blocks"""
+        prefixes = list(self.prefix)
+        for layer in self.layers:
+            prefix = block_prefix(layer)
+            if prefix and prefix not in prefixes:
+                prefixes.append(prefix)
+        return prefixes
+
+    @property
+    def isolated(self):
+        """Check whether everything the step installs is contained in its
+        prefixes (apart from OS packages), so that it can be copied into
+        other steps"""
+        if self.prefix:
+            return True
+        installs = [
+            layer
+            for layer in self.layers
+            if layer.__class__.__name__ not in NEUTRAL_LAYERS + ["packages"]
+        ]
+        return bool(installs) and all(block_prefix(layer) for layer in installs)
+
+
+class BuildSteps:
+    """Container of the building blocks of a stage, grouped in steps.
+
+    # Parameters
+
+    mode: "linear" (default), "layered" or "graph", see the module
+    documentation.
+
+    coalesce: if True, install the OS packages of all building blocks in a
+    single apt-get transaction (default False). Installs requiring extra
+    keys or repositories are left in place.
+
+    # Examples
+
+    ```python
+    steps = BuildSteps(mode=USERARG.get("build-mode", "linear"))
+    Stage0 += steps
+
+    tools = steps.start("Install build tools over base image")
+    steps += bb.cmake(eula=True, version="3.31.4")
+
+    libs = steps.start("Install libraries", after=[tools])
+    steps += bb.hdf5(prefix="/usr/local/hdf5")
+    eigen = steps.branch("Eigen", after=[tools])
+    steps += bb.generic_cmake(...)
+    ```
+
+    Branches start a new step in "graph" mode only, and are part of the
+    enclosing step otherwise. Steps started with site_specific=True (and
+    those depending on them) are built last in "layered" mode.
+    """
+
+    def __init__(self, mode="linear", coalesce=False):
+        if mode not in ["linear", "layered", "graph"]:
+            raise ValueError("Invalid build mode: {}".format(mode))
+        self.mode = mode
+        self.coalesce = coalesce
+        self.__steps = []
+        self.__hoisted = []
+        self.__ospackages = None
+        self.__runtime_ospackages = []
+        self.__stripped = {}
+        self.__start_layers = []
+        self.__end_layers = []
+        self.__instrument = None
+        self.__overlay_paths = []
+        self.__overlay_after = []
+
+    def __iadd__(self, layer):
+        """Add a layer to the current step.  Allows "+=" syntax."""
+        if not self.__steps:
+            raise RuntimeError("no build step started")
+        if isinstance(layer, list):
+            self.__steps[-1].layers.extend(layer)
+        else:
+            self.__steps[-1].layers.append(layer)
+        return self
+
+    def start(self, description, after=None, prefix=None, site_specific=False):
+        """Start a new step.  Dependencies (after) default to the previous
+        step, and are only used in "layered" and "graph" mode."""
+        return self.__add_step(description, after, prefix, False, site_specific)
+
+    def branch(self, description, after=None, prefix=None, site_specific=False):
+        """Start a new step in "graph" mode, or continue the current step
+        otherwise"""
+        return self.__add_step(description, after, prefix, True, site_specific)
+
+    def hoist(self, layer):
+        """Add a layer to the first step in "graph" mode, or to the current
+        step otherwise.  Useful for cheap installs outside of any prefix
+        (e.g. from OS packages), which would otherwise prevent a step from
+        being built independently of the others."""
+        if self.mode == "graph":
+            self.__hoisted.append(layer)
+        else:
+            self += layer
+
+    def wrap(self, start=None, end=None):
+        """Add layers at the start and at the end of every (non-empty)
+        step, e.g. to set up the build environment or to report statistics
+        for each step"""
+        self.__start_layers.extend(start or [])
+        self.__end_layers.extend(end or [])
+
+    def instrument(self, function):
+        """Wrap every layer installing something with the layers returned
+        by function(step, layer, description), where description is the
+        last comment preceding the layer in its step (e.g. to measure the
+        resources used by each building block)"""
+        self.__instrument = function
+
+    def __instrumented(self, step, layers):
+        """Return the layers of a step, instrumented if requested"""
+        if self.__instrument is None:
+            return list(layers)
+        instrumented = []
+        description = step.description
+        for layer in layers:
+            if layer.__class__.__name__ == "comment":
+                description = layer._comment__string or description
+            if layer.__class__.__name__ in NEUTRAL_LAYERS:
+                instrumented.append(layer)
+            else:
+                instrumented.extend(self.__instrument(step, layer, description))
+        return instrumented
+
+    def __wrapped(self, step, layers):
+        """Return the layers of a step, with the start and end layers"""
+        if not layers:
+            return []
+        return (
+            self.__start_layers
+            + self.__instrumented(step, layers)
+            + self.__end_layers
+        )
+
+    def overlay(self, paths, after):
+        """Ship the given paths in an application overlay instead of the
+        runtime image, which is built from the steps given in after (and
+        those they depend on). The runtime instructions of the other steps
+        are reduced to their environment."""
+        self.__overlay_paths = list(paths)
+        self.__overlay_after = list(after)
+
+    def __ancestors(self, steps):
+        """Return the given steps and all the steps they depend on"""
+        ancestors = []
+        for step in steps:
+            if step not in ancestors:
+                ancestors.append(step)
+                ancestors.extend(
+                    s for s in self.__ancestors(step.after) if s not in ancestors
+                )
+        return ancestors
+
+    def __overlay_markers(self, step, steps):
+        """Return the comments listing the paths of the application overlay,
+        and the steps providing them"""
+        if not self.__overlay_paths or step is not steps[-1]:
+            return []
+        return [
+            comment(
+                "{}: overlay {} from {}".format(
+                    step.name,
+                    " ".join(self.__overlay_paths),
+                    " ".join(s.name for s in self.__parents(step, steps)),
+                ),
+                reformat=False,
+            )
+        ]
+
+    def prefixes(self):
+        """Return the install prefixes of all steps"""
+        prefixes = []
+        for step in self.__steps:
+            for prefix in step.prefixes:
+                if prefix not in prefixes:
+                    prefixes.append(prefix)
+        return prefixes
+
+    def __add_step(self, description, after, prefix, branch, site_specific):
+        if after is None and self.__steps:
+            after = [self.__steps[-1]]
+        step = Step(description, after or [], prefix, branch, site_specific)
+        self.__steps.append(step)
+        return step
+
+    def __steps_to_build(self):
+        """Return the steps to build in the current mode, with their layers"""
+        if self.mode == "linear":
+            # Merge branches into the enclosing step
+            steps = []
+            for step in self.__steps:
+                if step.branch and steps:
+                    steps[-1][1].extend(step.layers)
+                else:
+                    steps.append((step, list(step.layers)))
+                step.built = steps[-1][0]
+            return steps
+
+        if self.mode == "layered":
+            # Build site-specific steps last, and merge branches into the
+            # step preceding them in this order
+            ordered = [s for s in self.__steps if not s.site_specific]
+            ordered += [s for s in self.__steps if s.site_specific]
+            steps = []
+            for step in ordered:
+                if step.branch and steps:
+                    steps[-1][1].append(comment(step.description))
+                    steps[-1][1].extend(step.layers)
+                else:
+                    steps.append((step, list(step.layers)))
+                step.built = steps[-1][0]
+            return steps
+
+        # Empty steps are skipped, except for the first and the last one
+        return [
+            (step, step.layers)
+            for i, step in enumerate(self.__steps)
+            if step.layers or i in [0, len(self.__steps) - 1]
+        ]
+
+    def __parents(self, step, steps):
+        """Return the (non-skipped) steps a step depends on"""
+        parents = []
+        for parent in step.after:
+            if parent in steps:
+                candidates = [parent]
+            else:
+                candidates = self.__parents(parent, steps)
+            parents.extend(p for p in candidates if p not in parents)
+        return parents
+
+    def __lineage(self, step, steps):
+        """Return a step and all the steps it is built upon"""
+        lineage = [step]
+        for parent in self.__parents(step, steps):
+            lineage.extend(s for s in self.__lineage(parent, steps) if s not in lineage)
+        return lineage
+
+    def __markers(self, step, steps):
+        """Return the comments describing the position of a step in the
+        build graph"""
+        parents = self.__parents(step, steps)
+        if step is steps[0]:
+            return [comment("{}: start".format(step.name))]
+        if not parents:
+            raise RuntimeError(
+                "cannot build {} ({}): no dependencies".format(step.name, step.description)
+            )
+
+        # Steps which are not isolated cannot be copied from one image to
+        # another, hence they must all be in the lineage of the image the
+        # step is built upon
+        lineages = {parent: self.__lineage(parent, steps) for parent in parents}
+        system = {
+            s for lineage in lineages.values() for s in lineage if not s.isolated
+        }
+        bootstrap = next(
+            (p for p in parents if system.issubset(lineages[p])),
+            None,
+        )
+        if bootstrap is None:
+            raise RuntimeError(
+                "cannot build {} ({}): non-isolated steps {} are not in the same lineage".format(
+                    step.name,
+                    step.description,
+                    ", ".join(sorted(s.name for s in system)),
+                )
+            )
+
+        # Copy all other steps from the first parent providing them
+        merges = []
+        for s in steps:
+            if s in lineages[bootstrap]:
+                continue
+            source = next((p for p in parents if s in lineages[p]), None)
+            if source is not None:
+                merges.append((s, source))
+        sources = [bootstrap]
+        sources.extend(
+            source for _, source in merges if source not in sources
+        )
+
+        markers = [
+            comment(
+                "{}: start after {}".format(
+                    step.name, " ".join(s.name for s in sources)
+                ),
+                reformat=False,
+            )
+        ]
+        markers.extend(
+            comment(
+                "{}: merge {} from {}".format(step.name, s.name, source.name),
+                reformat=False,
+            )
+            for s, source in merges
+        )
+        return markers
+
+    def layers(self):
+        """Return the list of layers of all steps, including the comments
+        delimiting them"""
+        steps = self.__steps_to_build()
+        for i, (step, _) in enumerate(steps):
+            step.name = "step{}".format(i + 1)
+
+        # Move OS packages to the first step: all of them when coalescing
+        # apt-get installs, otherwise (in "graph" mode) those of isolated
+        # steps, so that they are available after merging them (only once,
+        # as this modifies the building blocks)
+        if self.__ospackages is None:
+            self.__ospackages = []
+            for i, (step, step_layers) in enumerate(steps):
+                if self.coalesce or (
+                    self.mode == "graph" and i > 0 and step.isolated
+                ):
+                    for layer in step_layers:
+                        self.__strip(layer)
+            if self.coalesce:
+                for layer in self.__hoisted:
+                    self.__strip(layer)
+
+        if self.mode != "graph":
+            layers = []
+            built = [step for step, _ in steps]
+            for i, (step, step_layers) in enumerate(steps):
+                if self.__overlay_paths and i == len(steps) - 1:
+                    # Build the runtime image from the last step the
+                    # application depends on
+                    parent = max(
+                        (s.built for s in self.__overlay_after), key=built.index
+                    )
+                    layers.append(
+                        comment(
+                            "{}: start after {}".format(step.name, parent.name),
+                            reformat=False,
+                        )
+                    )
+                else:
+                    layers.append(comment("{}: start".format(step.name)))
+                layers.extend(self.__overlay_markers(step, built))
+                layers.append(comment(step.description))
+                if i == 0:
+                    layers.extend(
+                        self.__instrumented(step, self.__ospackages_layers())
+                    )
+                layers.extend(self.__wrapped(step, step_layers))
+            return layers
+
+        steps = [step for step, _ in steps]
+        layers = []
+        for i, step in enumerate(steps):
+            if self.__overlay_paths and i == len(steps) - 1:
+                # Build the runtime image from the steps the application
+                # depends on
+                base = Step(None, self.__overlay_after, None, False, False)
+                base.name = step.name
+                layers.extend(self.__markers(base, steps))
+            else:
+                layers.extend(self.__markers(step, steps))
+            layers.extend(self.__overlay_markers(step, steps))
+            if step.isolated:
+                layers.append(
+                    comment(
+                        "{}: prefix {}".format(step.name, " ".join(step.prefixes)),
+                        reformat=False,
+                    )
+                )
+            layers.append(comment(step.description))
+            if i == 0:
+                layers.extend(
+                    self.__instrumented(
+                        step, self.__ospackages_layers() + self.__hoisted
+                    )
+                )
+            layers.extend(self.__wrapped(step, step.layers))
+        return layers
+
+    def __strip(self, layer):
+        """Move the OS packages of a layer to the first step"""
+        ospackages = strip_ospackages(layer)
+        self.__stripped[id(layer)] = ospackages
+        self.__ospackages.extend(ospackages)
+
+    def __ospackages_layers(self):
+        """Return the layers installing the OS packages moved to the first
+        step, if any"""
+        if not self.__ospackages:
+            return []
+        return [
+            comment(
+                "OS packages required by all steps"
+                if self.coalesce
+                else "OS packages required by later steps"
+            ),
+            bb.packages(ospackages=sorted(set(self.__ospackages))),
+        ]
+
+    def __runtime(self, layer, _from):
+        """Return the runtime instructions of a layer, without its OS
+        packages when coalescing apt-get installs"""
+        inst = layer.runtime(_from=_from)
+        if not self.coalesce:
+            return inst
+        rt = getattr(layer, "rt", None)
+        if inst == str(layer):
+            # Same instructions as in the first stage, where the OS packages
+            # have already been removed
+            self.__runtime_ospackages.extend(self.__stripped.get(id(layer), []))
+        elif isinstance(rt, bb_instructions) and inst == str(rt):
+            self.__runtime_ospackages.extend(strip_ospackages(rt))
+            inst = str(rt)
+        return inst
+
+    def runtime(self, _from="0"):
+        """Generate the set of instructions to install the runtime specific
+        components of all steps from a previous stage"""
+        if self.coalesce:
+            # Remove OS packages from the building blocks first
+            self.layers()
+        instructions = []
+        base = self.__steps
+        if self.__overlay_paths:
+            base = self.__ancestors(self.__overlay_after)
+        for step in self.__steps:
+            for layer in step.layers:
+                if step in base:
+                    inst = self.__layer_runtime(layer, _from)
+                else:
+                    # Shipped in the application overlay, only keep the
+                    # environment
+                    inst = self.__overlay_runtime(layer)
+                if inst:
+                    instructions.append(inst)
+        for layer in self.__hoisted:
+            inst = self.__layer_runtime(layer, _from)
+            if inst:
+                instructions.append(inst)
+        return "\n\n".join(instructions)
+
+    def __layer_runtime(self, layer, _from):
+        """Return the runtime instructions of a layer, if any"""
+        runtime = getattr(layer, "runtime", None)
+        if callable(runtime):
+            return self.__runtime(layer, _from)
+        return None
+
+    def __overlay_runtime(self, layer):
+        """Return the runtime environment of a layer shipped in the
+        application overlay, if any"""
+        environment_step = getattr(layer, "environment_step", None)
+        if not callable(environment_step) or not callable(
+            getattr(layer, "runtime", None)
+        ):
+            return None
+        variables = environment_step(runtime=True)
+        if not variables:
+            return None
+        return str(environment(variables=variables))
+
+    def coalesce_runtime(self, stage):
+        """Move the OS packages installed by a runtime stage, including
+        those of the runtime instructions of all steps, to a single apt-get
+        transaction after its base image (if coalescing apt-get installs)"""
+        if not self.coalesce:
+            return
+        layers = stage._Stage__layers
+        ospackages = list(self.__runtime_ospackages)
+        for layer in layers:
+            ospackages.extend(strip_ospackages(layer))
+        if ospackages:
+            index = 1 if layers and layers[0].__class__.__name__ == "baseimage" else 0
+            layers[index:index] = [
+                comment("OS packages required at runtime"),
+                bb.packages(ospackages=sorted(set(ospackages))),
+            ]
+
+    def __str__(self):
+        """String representation of all steps"""
+        return "\n\n".join(str(layer) for layer in self.layers() if str(layer))
@@ -0,0 +1,114 @@
+"""Cache compiler outputs across container builds with ccache.
+
+The cache directory lives outside of the image, and must be bind-mounted
+during the build, e.g., with
+
+    apptainer build --bind /path/to/ccache:/ccache my-container.sif my-container.def
+
+(or BUILD_OPTS="--bind /path/to/ccache:/ccache" with scripts/build_steps.sh).
+If the directory is not mounted, the cache is disabled for the step, so
+that it does not end up in the image. The setting is written to the ccache
+config file of the build (CONFIG), since environment variables exported by
+a layer are lost in the following ones with Docker.
+"""
+
+import hpccm.building_blocks as bb
+from hpccm.primitives import comment, environment, shell
+
+# ccache config file of the build, read instead of the one of the cache
+# directory (all other settings come from the environment)
+CONFIG = "/etc/ccache-build.conf"
+
+
+class CompilerCache:
+    """Compiler cache shared by all building blocks of a recipe.
+
+    Compilers found in the PATH (gcc, g++, and the MPI wrappers calling
+    them) go through the ccache masquerade directory, CMake projects also
+    use ccache as compiler launcher for CUDA. Compilers given by absolute
+    path must be wrapped explicitly (see launcher_opts).
+
+    # Parameters
+
+    directory: directory of the cache in the container. If empty, the
+    compiler cache is disabled.
+
+    max_size: maximum size of the cache (default 50G).
+    """
+
+    def __init__(self, directory="", max_size="50G"):
+        self.directory = directory.rstrip("/")
+        self.max_size = max_size
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def environment(self):
+        """Return the environment variables enabling the cache"""
+        return {
+            "CCACHE_DIR": self.directory,
+            "CCACHE_MAXSIZE": self.max_size,
+            # Sources are built in /var/tmp, hash paths relative to it so
+            # that repeated builds in different folders share the cache
+            "CCACHE_BASEDIR": "/var/tmp",
+            "CCACHE_NOHASHDIR": "1",
+            # Compilers built in a previous step (e.g. LLVM) are rebuilt
+            # with a new timestamp, hash their contents instead
+            "CCACHE_COMPILERCHECK": "content",
+            "CCACHE_CONFIGPATH": CONFIG,
+            "CMAKE_CUDA_COMPILER_LAUNCHER": "ccache",
+            "PATH": "/usr/lib/ccache:$PATH",
+        }
+
+    def launcher_opts(self):
+        """Return the CMake options wrapping compilers given by absolute
+        path with ccache"""
+        if not self.enabled:
+            return []
+        return [
+            "-DCMAKE_C_COMPILER_LAUNCHER=ccache",
+            "-DCMAKE_CXX_COMPILER_LAUNCHER=ccache",
+        ]
+
+    def layers(self):
+        """Return the layers installing ccache"""
+        if not self.enabled:
+            return []
+        return [
+            comment("Compiler cache"),
+            bb.packages(ospackages=["ccache"]),
+        ]
+
+    def start_layers(self):
+        """Return the layers enabling the cache at the start of a build
+        step, and resetting its statistics"""
+        if not self.enabled:
+            return []
+        return [
+            environment(variables=self.environment()),
+            shell(
+                commands=[
+                    "if mountpoint -q {0}; then : > {1}; else echo 'warning: {0} is not mounted, disabling compiler cache'; echo 'disable = true' > {1}; fi".format(
+                        self.directory, CONFIG
+                    ),
+                    "if mountpoint -q {} && command -v ccache > /dev/null; then ccache --zero-stats; fi".format(
+                        self.directory
+                    ),
+                ]
+            ),
+        ]
+
+    def end_layers(self):
+        """Return the layers reporting the cache statistics of a build step"""
+        if not self.enabled:
+            return []
+        return [
+            shell(
+                commands=[
+                    "if mountpoint -q {} && command -v ccache > /dev/null; then ccache --show-stats; fi".format(
+                        self.directory
+                    ),
+                ]
+            ),
+        ]
@@ -0,0 +1,103 @@
+"""Redirect the downloads of a recipe to a local source mirror.
+
+The mirror is populated by scripts/prefetch_sources.py and has the layout
+
+    <mirror>/files/<host>/<path>    files downloaded with wget
+    <mirror>/git/<host>/<path>      bare mirrors of git repositories
+    <mirror>/pypi/                  Python packages installed with pip
+
+The mirror can be a folder bind-mounted during the build (e.g. /mirror,
+with "apptainer build --bind /path/to/mirror:/mirror"), or the URL of a web
+server exposing it. In the latter case git repositories must be served with
+a protocol supporting shallow clones (e.g. "git daemon"), given by git_url.
+"""
+
+import hpccm.templates
+from hpccm.primitives import comment, environment, shell
+
+
+class SourceMirror:
+    """Local mirror of the sources downloaded by a recipe.
+
+    # Parameters
+
+    mirror: path or URL of the mirror. If empty, upstream sources are used.
+
+    git_url: URL of the git mirror, defaults to <mirror>/git.
+
+    pip_offline: if True, Python packages are only installed from the
+    mirror. OS packages (from the apt repositories of the distribution,
+    Mellanox OFED and LLVM) are still downloaded, so the build still needs
+    the network.
+    """
+
+    def __init__(self, mirror="", git_url=None, pip_offline=False):
+        self.mirror = mirror.rstrip("/")
+        self.local = self.mirror.startswith("/")
+        if git_url:
+            self.git_url = git_url.rstrip("/")
+        elif self.local:
+            self.git_url = "file://{}/git".format(self.mirror)
+        else:
+            self.git_url = "{}/git".format(self.mirror)
+        self.pip_offline = pip_offline
+
+        if self.mirror:
+            self.__patch_wget()
+
+    def url(self, url):
+        """Return the location of a file in the mirror"""
+        if not self.mirror or "://" not in url:
+            return url
+        return "{}/files/{}".format(self.mirror, url.split("://", 1)[1])
+
+    def __patch_wget(self):
+        """Monkey patch the wget template, used by all building blocks to
+        download files, so that files are taken from the mirror"""
+        mirror = self
+        wget_download_step = hpccm.templates.wget.download_step
+
+        def mirror_download_step(
+            self, outfile=None, referer=None, url=None, directory="/tmp"
+        ):
+            """Download a file from the source mirror"""
+            if not mirror.local:
+                return wget_download_step(
+                    self,
+                    outfile=outfile,
+                    referer=referer,
+                    url=mirror.url(url),
+                    directory=directory,
+                )
+            return "mkdir -p {0} && cp {1} {2}".format(
+                directory, mirror.url(url), outfile or directory
+            )
+
+        setattr(hpccm.templates.wget, "download_step", mirror_download_step)
+
+    def layers(self):
+        """Return the layers redirecting git clones and pip installs to the
+        mirror (to be added once git is installed)"""
+        if not self.mirror:
+            return []
+
+        layers = [
+            comment("Source mirror"),
+            shell(
+                commands=[
+                    'git config --global url."{}/".insteadOf https://'.format(
+                        self.git_url
+                    ),
+                ]
+            ),
+        ]
+        if self.pip_offline:
+            layers.append(
+                environment(
+                    variables={
+                        "PIP_NO_INDEX": "1",
+                        "PIP_FIND_LINKS": "{}/pypi".format(self.mirror),
+                    }
+                )
+            )
+        return layers
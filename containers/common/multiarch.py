@@ -0,0 +1,174 @@
+"""Build the applications for several host microarchitectures in one image,
+and dispatch to the best build at launch.
+
+The dependencies are built once, for the microarchitecture of the config
+file (hpccm.config.set_cpu_target), which must be an ancestor of the other
+ones, e.g. x86_64_v3 for an image running on skylake_avx512 and zen2 nodes.
+The applications are built for each of them, in folders next to the default
+builds, and a launcher is linked under the name of each binary, first in the
+PATH:
+
+    /usr/local/multiarch/targets     # <binary> <march> <path> <cpu flags...>
+    /usr/local/multiarch/bin/<binary> -> /usr/local/multiarch/march-exec
+
+The launcher execs the first build of the binary (most specific
+microarchitecture first) whose instructions are all supported by the CPU
+(flags of /proc/cpuinfo), or the build for MARCH_EXEC_TARGET, if set.
+MARCH_EXEC_VERBOSE=1 prints the chosen build.
+"""
+
+import archspec.cpu
+from hpccm.primitives import comment, copy, environment, shell
+
+from scripts import install_commands
+
+MULTIARCH_PREFIX = "/usr/local/multiarch"
+MARCH_EXEC = "{}/march-exec".format(MULTIARCH_PREFIX)
+MARCH_TARGETS = "{}/targets".format(MULTIARCH_PREFIX)
+
+MARCH_EXEC_SCRIPT = [
+    "#!/bin/bash",
+    "# Exec the build of this binary for the CPU of the node",
+    "name=$(basename $0)",
+    "flags=\" $(grep -m 1 -E '^(flags|Features)' /proc/cpuinfo | cut -d: -f2) \"",
+    "while read -r binary target path features",
+    "do",
+    "    [[ $binary == \"$name\" ]] || continue",
+    "    if [[ -n $MARCH_EXEC_TARGET ]]",
+    "    then",
+    "        [[ $target == \"$MARCH_EXEC_TARGET\" ]] || continue",
+    "    else",
+    "        for feature in $features",
+    "        do",
+    "            [[ $flags == *\" $feature \"* ]] || continue 2",
+    "        done",
+    "    fi",
+    "    [[ -n $MARCH_EXEC_VERBOSE ]] && echo \"march-exec: $name for $target\" >&2",
+    "    exec $path \"$@\"",
+    "done < {}".format(MARCH_TARGETS),
+    "echo \"march-exec: no build of $name for ${MARCH_EXEC_TARGET:-this CPU}\" >&2",
+    "exit 1",
+]
+
+
+class HostTargets:
+    """Host microarchitectures of the application builds.
+
+    # Parameters
+
+    march: microarchitecture of the config file (default builds and
+    dependencies).
+
+    extra: comma-separated list of additional microarchitectures (default
+    empty, i.e., only the default builds).
+    """
+
+    def __init__(self, march, extra=""):
+        self.march = march
+        self.extra = [
+            target
+            for target in dict.fromkeys(extra.split(","))
+            if target not in ["", march]
+        ]
+        for target in [march] + self.extra:
+            if target not in archspec.cpu.TARGETS:
+                raise ValueError("Invalid microarchitecture: {}".format(target))
+        for target in self.extra:
+            if not archspec.cpu.TARGETS[march] <= archspec.cpu.TARGETS[target]:
+                raise ValueError(
+                    "Dependencies built for {} do not run on {}".format(march, target)
+                )
+
+    @property
+    def enabled(self):
+        return bool(self.extra)
+
+    def flags(self, target, compiler="gcc", version="9999"):
+        """Return the flags building for a microarchitecture"""
+        flags = archspec.cpu.TARGETS[target].optimization_flags(compiler, version)
+        if compiler == "clang":
+            # Leave the code offloaded to GPUs alone
+            flags = " ".join("-Xarch_host {}".format(flag) for flag in flags.split())
+        return flags
+
+    def cmake_opts(self, target, compiler="gcc", version="9999", rpath=None):
+        """Return the CMake options building for a microarchitecture. With
+        rpath, the rpath of the binaries takes precedence over
+        LD_LIBRARY_PATH, so that they do not load the libraries of the
+        default build."""
+        flags = self.flags(target, compiler=compiler, version=version)
+        opts = [
+            '-DCMAKE_C_FLAGS="{}"'.format(flags),
+            '-DCMAKE_CXX_FLAGS="{}"'.format(flags),
+        ]
+        if rpath:
+            opts += [
+                '-DCMAKE_EXE_LINKER_FLAGS="-Wl,--disable-new-dtags"',
+                '-DCMAKE_SHARED_LINKER_FLAGS="-Wl,--disable-new-dtags"',
+                "-DCMAKE_BUILD_RPATH={}".format(rpath),
+                "-DCMAKE_INSTALL_RPATH={}".format(rpath),
+            ]
+        return opts
+
+    def prefixes(self):
+        """Return the install prefixes of the launcher"""
+        if not self.enabled:
+            return []
+        return [MULTIARCH_PREFIX]
+
+    def layers(self, builds):
+        """Return the layers installing the launcher of the binaries in the
+        given builds, as (march, folder, microarchitecture whose
+        instructions the binaries use)"""
+        if not self.enabled:
+            return []
+        # Most specific microarchitectures first
+        builds = sorted(
+            builds,
+            key=lambda build: -len(archspec.cpu.TARGETS[build[2]].ancestors),
+        )
+        commands = [
+            "mkdir -p {}/bin".format(MULTIARCH_PREFIX),
+            *install_commands(MARCH_EXEC, MARCH_EXEC_SCRIPT),
+            ": > {}".format(MARCH_TARGETS),
+        ]
+        for march, folder, target in builds:
+            features = " ".join(sorted(archspec.cpu.TARGETS[target].features))
+            commands.append(
+                "for f in {0}/*; do "
+                "if [ -f $f ] && [ -x $f ] && "
+                "[ \"$(head -c 4 $f | od -An -tx1 | tr -d ' \\n')\" = 7f454c46 ]; then "
+                "echo \"$(basename $f) {1} $f {2}\" >> {3} && "
+                "ln -sf {4} {5}/bin/$(basename $f); "
+                "fi; done".format(
+                    folder,
+                    march,
+                    features,
+                    MARCH_TARGETS,
+                    MARCH_EXEC,
+                    MULTIARCH_PREFIX,
+                )
+            )
+        return [
+            comment(
+                "Launcher of the builds for {}".format(
+                    ", ".join([self.march] + self.extra)
+                )
+            ),
+            shell(commands=commands),
+        ]
+
+    def runtime_layers(self, copy_files=True):
+        """Return the layers of the runtime image putting the launcher first
+        in the PATH (and copying it, unless shipped otherwise)"""
+        if not self.enabled:
+            return []
+        layers = [comment("Launcher of the builds for the CPU of the node")]
+        if copy_files:
+            layers.append(
+                copy(_from="devel", files={MULTIARCH_PREFIX: MULTIARCH_PREFIX})
+            )
+        layers.append(
+            environment(variables={"PATH": "{}/bin:$PATH".format(MULTIARCH_PREFIX)})
+        )
+        return layers
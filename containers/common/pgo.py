@@ -0,0 +1,158 @@
+"""Build applications with profile-guided (PGO) and link-time (LTO)
+optimizations.
+
+Profile-guided builds take two images:
+
+1. With pgo=generate, the applications are instrumented (instead of the
+   default build). Running a short training case with this image writes
+   the profiles to the profile folder (by default /var/tmp/pgo-profile,
+   bind-mounted from the host by apptainer), one subfolder per build.
+2. With pgo=use, the profiles are read from the same folder, which must be
+   bind-mounted during the build, e.g., with
+
+       BUILD_OPTS="--bind $HOME/pgo/seissol:/var/tmp/pgo-profile"
+
+   and the optimized applications are built next to the default ones, so
+   that both can be compared.
+
+LTO (lto=1) also builds the optimized applications next to the default ones,
+with or without profiles.
+"""
+
+HOST_COMPILERS = ["gcc", "clang"]
+
+
+class Optimization:
+    """Profile-guided and link-time optimization of the application builds.
+
+    # Parameters
+
+    pgo: "generate" to instrument the builds, "use" to optimize them with
+    the profiles, or empty (default) not to use profiles.
+
+    profile_dir: folder of the profiles (default /var/tmp/pgo-profile).
+
+    lto: whether to use link-time optimization (default False).
+    """
+
+    def __init__(self, pgo="", profile_dir="/var/tmp/pgo-profile", lto=False):
+        if pgo not in ["", "generate", "use"]:
+            raise ValueError("Invalid profile-guided optimization: {}".format(pgo))
+        self.pgo = pgo
+        self.profile_dir = profile_dir.rstrip("/")
+        self.lto = lto
+
+    @property
+    def generate(self):
+        """Whether the default builds are instrumented"""
+        return self.pgo == "generate"
+
+    @property
+    def optimized(self):
+        """Whether optimized builds are added next to the default ones"""
+        return self.pgo == "use" or self.lto
+
+    @property
+    def suffix(self):
+        """Suffix of the install prefixes of the optimized builds"""
+        return "_pgo" if self.pgo == "use" else "_lto"
+
+    def description(self):
+        """Return a short description of the optimizations"""
+        names = [
+            name
+            for name, enabled in [
+                ("profile-guided", self.pgo == "use"),
+                ("link-time", self.lto),
+            ]
+            if enabled
+        ]
+        return "{} optimizations".format(" and ".join(names))
+
+    def flags(self, name, compiler="gcc", rpath=False):
+        """Return the compile and link flags of a build (the profiles of each
+        build are kept in their own subfolder). With rpath, the rpath of the
+        binaries takes precedence over LD_LIBRARY_PATH, so that optimized
+        builds do not load the libraries of the default ones."""
+        if compiler not in HOST_COMPILERS:
+            raise ValueError("Invalid host compiler: {}".format(compiler))
+        profile = "{}/{}".format(self.profile_dir, name)
+        cflags, ldflags = [], []
+        if self.generate:
+            cflags = ["-fprofile-generate={}".format(profile)]
+            ldflags = ["-fprofile-generate={}".format(profile)]
+            if compiler == "gcc":
+                # Counters are updated by all threads
+                cflags.append("-fprofile-update=atomic")
+        elif self.pgo == "use" and compiler == "gcc":
+            cflags = [
+                "-fprofile-use={}".format(profile),
+                "-fprofile-partial-training",
+                "-Wno-missing-profile",
+            ]
+        elif self.pgo == "use":
+            cflags = [
+                "-fprofile-use={}".format(self.__profdata(name)),
+                "-Wno-profile-instr-unprofiled",
+                "-Wno-profile-instr-out-of-date",
+            ]
+        if compiler == "clang":
+            # Leave the code offloaded to GPUs alone
+            cflags = ["-Xarch_host {}".format(flag) for flag in cflags]
+            if self.lto and not self.generate:
+                ldflags.append("-fuse-ld=lld")
+        if rpath:
+            ldflags.append("-Wl,--disable-new-dtags")
+        return " ".join(cflags), " ".join(ldflags)
+
+    def toolchain(self, toolchain, name, rpath=False):
+        """Return a copy of a (gcc) toolchain with the flags of a build"""
+        cflags, ldflags = self.flags(name, rpath=rpath)
+        toolchain = toolchain.__copy__()
+        for variable, flags in [
+            ("CFLAGS", cflags),
+            ("CXXFLAGS", cflags),
+            ("LDFLAGS", ldflags),
+        ]:
+            if flags:
+                value = getattr(toolchain, variable)
+                setattr(toolchain, variable, " ".join(filter(None, [value, flags])))
+        return toolchain
+
+    def cmake_opts(self, name=None, compiler="gcc", rpath=None):
+        """Return the CMake options of a build: its flags, unless set in its
+        toolchain (no name), its rpath, if given, and LTO"""
+        opts = []
+        if name:
+            cflags, ldflags = self.flags(name, compiler=compiler, rpath=bool(rpath))
+            if cflags:
+                opts += [
+                    '-DCMAKE_C_FLAGS="{}"'.format(cflags),
+                    '-DCMAKE_CXX_FLAGS="{}"'.format(cflags),
+                ]
+            if ldflags:
+                opts += [
+                    '-DCMAKE_EXE_LINKER_FLAGS="{}"'.format(ldflags),
+                    '-DCMAKE_SHARED_LINKER_FLAGS="{}"'.format(ldflags),
+                ]
+        if rpath:
+            opts += [
+                "-DCMAKE_BUILD_RPATH={}".format(rpath),
+                "-DCMAKE_INSTALL_RPATH={}".format(rpath),
+            ]
+        if self.lto and not self.generate:
+            opts.append("-DCMAKE_INTERPROCEDURAL_OPTIMIZATION=ON")
+        return opts
+
+    def merge_commands(self, name, llvm_profdata="llvm-profdata"):
+        """Return the commands merging the raw profiles of a clang build"""
+        if self.pgo != "use":
+            return []
+        return [
+            "{} merge -output={} {}/{}".format(
+                llvm_profdata, self.__profdata(name), self.profile_dir, name
+            )
+        ]
+
+    def __profdata(self, name):
+        return "/var/tmp/{}.profdata".format(name)
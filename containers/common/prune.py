@@ -0,0 +1,163 @@
+"""Prune the files copied into the runtime image down to what the
+application binaries need.
+
+The runtime stage copies the install prefixes of the building blocks (and
+the application folders) from the devel stage as they are, with headers,
+static libraries, tools and build objects. When pruning, a last step of the
+devel stage runs the prune-runtime script, which computes the shared
+library closure (with ldd) of the ELF files matching the kept paths, and
+removes from the pruned folders every file outside of it:
+
+    prune-runtime --keep '/usr/local/app/bin/*' /usr/local/app /usr/local/lib1
+
+Kept directories are kept as a whole, except build objects (*.o, *.a, ...).
+Libraries loaded with dlopen (e.g. the plugins of Open MPI, UCX or
+AdaptiveCpp) are not found by ldd, and must be kept explicitly. The size of
+each pruned folder before and after pruning is printed in the build log.
+"""
+
+import shlex
+
+from hpccm.primitives import comment, shell
+
+from scripts import install_commands
+
+PRUNE_RUNTIME = "/usr/local/bin/prune-runtime"
+
+PRUNE_RUNTIME_SCRIPT = [
+    "#!/usr/bin/env python3",
+    "# Usage: prune-runtime --keep <glob> [--keep <glob>...] <folder>...",
+    "import argparse, fnmatch, glob, os, re, subprocess, sys",
+    "",
+    "# Build objects removed from kept directories",
+    "DROP = ['*.o', '*.a', '*.la', '*.d', 'CMakeFiles', '.git']",
+    "LDD_RE = re.compile(r'(/\\S+) \\(0x')",
+    "",
+    "def size(path):",
+    "    total = 0",
+    "    for base, dirs, names in os.walk(path):",
+    "        for name in names:",
+    "            total += os.lstat(os.path.join(base, name)).st_size",
+    "    return total",
+    "",
+    "def is_elf(path):",
+    "    try:",
+    "        with open(path, 'rb') as f:",
+    "            return f.read(4) == b'\\x7fELF'",
+    "    except OSError:",
+    "        return False",
+    "",
+    "def dropped(name):",
+    "    return any(fnmatch.fnmatch(name, pattern) for pattern in DROP)",
+    "",
+    "def kept_files(patterns):",
+    "    files = set()",
+    "    for pattern in patterns:",
+    "        for match in glob.glob(pattern):",
+    "            match = os.path.normpath(match)",
+    "            if os.path.isdir(match) and not os.path.islink(match):",
+    "                for base, dirs, names in os.walk(match):",
+    "                    dirs[:] = [d for d in dirs if not dropped(d)]",
+    "                    links = [d for d in dirs if os.path.islink(os.path.join(base, d))]",
+    "                    for name in names + links:",
+    "                        if not dropped(name):",
+    "                            files.add(os.path.join(base, name))",
+    "            else:",
+    "                files.add(match)",
+    "    return files",
+    "",
+    "def with_links(path):",
+    "    # A path and the paths its symbolic links point to",
+    "    paths = {path}",
+    "    while os.path.islink(path):",
+    "        path = os.path.normpath(os.path.join(os.path.dirname(path), os.readlink(path)))",
+    "        paths.add(path)",
+    "    paths.add(os.path.realpath(path))",
+    "    return paths",
+    "",
+    "def closure(files, env):",
+    "    keep = set()",
+    "    for path in files:",
+    "        keep.update(with_links(path))",
+    "    todo = sorted(path for path in keep if is_elf(path))",
+    "    scanned = set(todo)",
+    "    while todo:",
+    "        ldd = subprocess.run(['ldd', todo.pop()], capture_output=True, text=True, env=env)",
+    "        for lib in LDD_RE.findall(ldd.stdout):",
+    "            paths = with_links(os.path.normpath(lib))",
+    "            keep.update(paths)",
+    "            real = os.path.realpath(lib)",
+    "            if real not in scanned:",
+    "                scanned.add(real)",
+    "                todo.append(real)",
+    "    return keep",
+    "",
+    "def prune(folder, keep):",
+    "    for base, dirs, names in os.walk(folder, topdown=False):",
+    "        for name in names + dirs:",
+    "            path = os.path.join(base, name)",
+    "            if os.path.islink(path) or not os.path.isdir(path):",
+    "                if path not in keep:",
+    "                    os.remove(path)",
+    "            elif not os.listdir(path):",
+    "                os.rmdir(path)",
+    "",
+    "parser = argparse.ArgumentParser()",
+    "parser.add_argument('--keep', action='append', default=[])",
+    "parser.add_argument('folders', nargs='+')",
+    "args = parser.parse_args()",
+    "folders = [os.path.normpath(folder) for folder in args.folders if os.path.isdir(folder)]",
+    "",
+    "files = kept_files(args.keep)",
+    "if not any(is_elf(path) for path in files):",
+    "    sys.exit('prune-runtime: no binaries matching {}'.format(' '.join(args.keep)))",
+    "",
+    "# Resolve the libraries of the pruned folders, also if not in the environment",
+    "env = dict(os.environ)",
+    "libdirs = [d for f in folders for d in glob.glob(f + '/lib*') if os.path.isdir(d)]",
+    "env['LD_LIBRARY_PATH'] = ':'.join(libdirs + [env.get('LD_LIBRARY_PATH', '')])",
+    "keep = closure(files, env)",
+    "",
+    "print('{:<48} {:>12} {:>12}'.format('folder', 'before MiB', 'after MiB'))",
+    "before = after = 0",
+    "for folder in folders:",
+    "    folder_before = size(folder)",
+    "    prune(folder, keep)",
+    "    folder_after = size(folder)",
+    "    print('{:<48} {:>12.1f} {:>12.1f}'.format(folder, folder_before / 2**20, folder_after / 2**20))",
+    "    before += folder_before",
+    "    after += folder_after",
+    "print('{:<48} {:>12.1f} {:>12.1f}'.format('total', before / 2**20, after / 2**20))",
+]
+
+
+class RuntimePruning:
+    """Pruning of the files copied into the runtime image.
+
+    # Parameters
+
+    enabled: whether to prune the runtime files (default False).
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+
+    def layers(self, folders, keep):
+        """Return the layers removing the files of the given folders which
+        are neither kept (list of globs) nor needed by the kept binaries
+        and libraries"""
+        if not self.enabled:
+            return []
+        return [
+            comment("Remove the runtime files not needed by the applications"),
+            shell(
+                commands=install_commands(PRUNE_RUNTIME, PRUNE_RUNTIME_SCRIPT)
+                + [
+                    "{} {} {}".format(
+                        PRUNE_RUNTIME,
+                        " ".join("--keep {}".format(shlex.quote(path)) for path in keep),
+                        " ".join(folders),
+                    ),
+                ]
+            ),
+        ]
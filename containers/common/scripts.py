@@ -0,0 +1,26 @@
+"""Install shell scripts, given as lists of lines, into the image.
+
+A script is written with printf, each line quoted for the shell of the
+build, so that the recipe holds the whole script and the image needs no
+file copied from the build context.
+"""
+
+import shlex
+
+from hpccm.primitives import shell
+
+
+def install_commands(path, lines):
+    """Return the commands writing the script of the given lines to path,
+    and making it executable"""
+    return [
+        "printf '%s\\n' {} > {}".format(
+            " ".join(shlex.quote(line) for line in lines), path
+        ),
+        "chmod +x {}".format(path),
+    ]
+
+
+def install_script(path, lines):
+    """Return the layer installing the script of the given lines as path"""
+    return shell(commands=install_commands(path, lines))
@@ -5,6 +5,18 @@ import hpccm.building_blocks as bb
 from hpccm.primitives import baseimage, comment, copy, environment, shell
 import json
 from pathlib import Path
+import sys
+
+# Shared recipe helpers
+sys.path.insert(0, str(Path(include.prepend_path).resolve().parent / "common"))  # noqa: F821
+from buildjobs import BuildJobs  # noqa: E402
+from buildlog import BuildLog  # noqa: E402
+from buildsteps import BuildSteps  # noqa: E402
+from ccache import CompilerCache  # noqa: E402
+from mirror import SourceMirror  # noqa: E402
+from multiarch import HostTargets  # noqa: E402
+from pgo import Optimization  # noqa: E402
+from prune import RuntimePruning  # noqa: E402
 
 
 # Get correct config
@@ -28,15 +40,81 @@ Stage0 += baseimage(  # noqa: F821
 # Microarchitecture specification
 hpccm.config.set_cpu_target(config["march"])
 
+# Build steps ("linear", "layered" or "graph", see containers/common/buildsteps.py)
+steps = BuildSteps(
+    mode=USERARG.get("build-mode", "linear"),  # noqa: F821
+    coalesce=USERARG.get("coalesce-apt", "0") == "1",  # noqa: F821
+)
+Stage0 += steps  # noqa: F821
+
+# Local source mirror (see containers/common/mirror.py)
+mirror = SourceMirror(
+    USERARG.get("mirror", ""),  # noqa: F821
+    git_url=USERARG.get("mirror-git"),  # noqa: F821
+    pip_offline=USERARG.get("pip-offline", "0") == "1",  # noqa: F821
+)
+
+# Compiler cache, mounted during the build (see containers/common/ccache.py)
+ccache = CompilerCache(
+    USERARG.get("ccache", ""),  # noqa: F821
+    max_size=USERARG.get("ccache-size", "50G"),  # noqa: F821
+)
+steps.wrap(start=ccache.start_layers(), end=ccache.end_layers())
+
+# Build parallelism: "nproc", "auto" (derived from the memory available at
+# build time) or a fixed number of jobs (see containers/common/buildjobs.py)
+jobs = BuildJobs(USERARG.get("build-jobs", "nproc"))  # noqa: F821
+
+# Log of the time and resources used by each building block, if requested
+# (see containers/common/buildlog.py)
+build_log = BuildLog(USERARG.get("build-log", ""))  # noqa: F821
+if build_log.enabled:
+    steps.instrument(build_log.instrument)
+
+# Pruning of the runtime files down to what the applications need, if
+# requested (see containers/common/prune.py)
+pruning = RuntimePruning(USERARG.get("prune-runtime", "0") == "1")  # noqa: F821
+
+# Ship the application in an overlay of a runtime image built without it, if
+# requested (see containers/common/buildsteps.py)
+app_overlay = USERARG.get("app-overlay", "0") == "1"  # noqa: F821
+
+# Profile-guided and link-time optimized builds of the applications, if
+# requested (see containers/common/pgo.py)
+optimization = Optimization(
+    USERARG.get("pgo", ""),  # noqa: F821
+    profile_dir=USERARG.get("pgo-profile", "/var/tmp/pgo-profile"),  # noqa: F821
+    lto=USERARG.get("lto", "0") == "1",  # noqa: F821
+)
+
+# Builds of the applications for other host microarchitectures, next to the
+# default ones, dispatched at launch (see containers/common/multiarch.py)
+host_targets = HostTargets(
+    config["march"], USERARG.get("extra-march", "")  # noqa: F821
+)
+
+# Expected memory (MiB) of each compile and link job of the building blocks,
+# used to derive their parallelism in "auto" mode
+build_memory = {
+    "xpmem": (200, 200),
+    "ucx": (400, 600),
+    "pmix": (300, 500),
+    "openmpi": (400, 800),
+    "llvm": (1500, 8000),
+    "boost": (1000, 1500),
+    "adaptive_cpp": (1500, 3000),
+    "hdf5": (400, 800),
+    "peano": (2500, 5000),
+}
+
 
 ################################################################################
-Stage0 += comment("step1: start")
-Stage0 += comment("Install build tools over base image")
+tools = steps.start("Install build tools over base image")
 
 # Install Python with virtual environments support
 python = bb.python(python2=False)
-Stage0 += python
-Stage0 += bb.packages(
+steps += python
+steps += bb.packages(
     ospackages=[
         "python3-pip",
         "python3-venv",
@@ -46,37 +124,52 @@ Stage0 += bb.packages(
 )
 
 # Install CMake
-Stage0 += bb.cmake(eula=True, version="3.31.4")
+steps += bb.cmake(eula=True, version="3.31.4")
 
 # Install Git and pkgconf
-Stage0 += comment("Git, Pkgconf")
-Stage0 += bb.packages(ospackages=["git", "pkgconf"])
+steps += comment("Git, Pkgconf")
+steps += bb.packages(ospackages=["git", "pkgconf"])
+
+# Redirect git clones and pip installs to the source mirror, if any
+steps += mirror.layers()
+
+# Install compiler cache, if enabled
+steps += ccache.layers()
+
+# Install build-jobs script, if needed
+steps += jobs.layers()
+
+# Install build-log script, if needed
+steps += build_log.layers()
 
 
 ################################################################################
-Stage0 += comment("step2: start")
-Stage0 += comment("Install network stack packages and OpenMPI")
+network = steps.start(
+    "Install network stack packages and OpenMPI", after=[tools], site_specific=True
+)
 
 # Get network stack configuration
 netconfig = config["network_stack"]
 
 # Install Mellanox OFED userspace libraries
 mlnx_ofed = bb.mlnx_ofed(version=netconfig["mlnx_ofed"])
-Stage0 += mlnx_ofed
+steps += mlnx_ofed
 
 # Install KNEM headers
 if netconfig["knem"]:
     knem_prefix = "/usr/local/knem"
     knem = bb.knem(prefix=knem_prefix)
-    Stage0 += knem
+    steps += knem
 else:
     knem_prefix = False
 
 # Install XPMEM userspace library
 if netconfig["xpmem"]:
     xpmem_prefix = "/usr/local/xpmem"
-    xpmem = bb.xpmem(prefix=xpmem_prefix)
-    Stage0 += xpmem
+    xpmem = bb.xpmem(
+        prefix=xpmem_prefix, parallel=jobs.parallel(*build_memory["xpmem"])
+    )
+    steps += xpmem
 else:
     xpmem_prefix = False
 
@@ -84,7 +177,7 @@ else:
 if netconfig["gdrcopy"]:
     gdrcopy_prefix = "/usr/local/gdrcopy"
     gdrcopy = bb.gdrcopy(prefix=gdrcopy_prefix)
-    Stage0 += gdrcopy
+    steps += gdrcopy
 else:
     gdrcopy_prefix = False
 
@@ -100,8 +193,9 @@ ucx = bb.ucx(
     xpmem=xpmem_prefix,
     gdrcopy=gdrcopy_prefix,
     enable_mt=True,
+    parallel=jobs.parallel(*build_memory["ucx"]),
 )
-Stage0 += ucx
+steps += ucx
 
 # Install PMIx
 match netconfig["pmix"]:
@@ -109,8 +203,12 @@ match netconfig["pmix"]:
         pmix_prefix = "internal"
     case version:
         pmix_prefix = "/usr/local/pmix"
-        pmix = bb.pmix(prefix=pmix_prefix, version=netconfig["pmix"])
-        Stage0 += pmix
+        pmix = bb.pmix(
+            prefix=pmix_prefix,
+            version=netconfig["pmix"],
+            parallel=jobs.parallel(*build_memory["pmix"]),
+        )
+        steps += pmix
 
 # Install OpenMPI
 ompi = bb.openmpi(
@@ -118,13 +216,13 @@ ompi = bb.openmpi(
     version=netconfig["ompi"],
     ucx=ucx_prefix,
     pmix=pmix_prefix,
+    parallel=jobs.parallel(*build_memory["openmpi"]),
 )
-Stage0 += ompi
+steps += ompi
 
 
 ################################################################################
-Stage0 += comment("step3: start")
-Stage0 += comment("Enable OpenMP offload and SYCL support")
+toolchain = steps.start("Enable OpenMP offload and SYCL support", after=[tools])
 
 # Install LLVM with NVPTX support (2-stage build)
 match config["arch"]:
@@ -133,7 +231,10 @@ match config["arch"]:
     case "aarch64":
         llvm_host_target = "AArch64"
 
-llvm_build_parallelism = USERARG.get("llvm-build-par", "")  # noqa: F821
+llvm_build_parallelism = USERARG.get(  # noqa: F821
+    "llvm-build-par", jobs.parallel(*build_memory["llvm"], default="")
+)
+llvm_version = "18.1.8"
 llvm_prefix = "/usr/local/llvm"
 llvm_env = {
     "PATH": "{}/bin:$PATH".format(llvm_prefix),
@@ -182,10 +283,10 @@ llvm_stage_2 = [
     "-DLLVM_INCLUDE_TESTS=OFF",
     "-DLLVM_TEMPORARILY_ALLOW_OLD_TOOLCHAIN=OFF",
     "-DLIBOMPTARGET_DEVICE_ARCHITECTURES=sm_90",
-]
+] + ccache.launcher_opts()
 llvm = bb.generic_build(
     repository="https://github.com/llvm/llvm-project.git",
-    branch="llvmorg-18.1.8",
+    branch="llvmorg-{}".format(llvm_version),
     prefix=llvm_prefix,
     build=[
         "echo 'Start stage 1 build ...'",
@@ -202,7 +303,7 @@ llvm = bb.generic_build(
     devel_environment=llvm_env,
     runtime_environment=llvm_env,
 )
-Stage0 += llvm
+steps += llvm
 
 # Install Boost
 match config["arch"]:
@@ -245,9 +346,10 @@ boost = bb.boost(
         "--prefix=/usr/local/boost",
     ],
     environment=False,
+    parallel=jobs.parallel(*build_memory["boost"]),
 )
-Stage0 += boost
-Stage0 += environment(
+steps += boost
+steps += environment(
     variables=boost_env,
 )
 
@@ -270,13 +372,13 @@ adaptive_cpp = bb.generic_cmake(
     ],
     devel_environment=adaptive_cpp_env,
     runtime_environment=adaptive_cpp_env,
+    parallel=jobs.parallel(*build_memory["adaptive_cpp"]),
 )
-Stage0 += adaptive_cpp
+steps += adaptive_cpp
 
 
 ################################################################################
-Stage0 += comment("step4: start")
-Stage0 += comment("Install optional dependencies")
+io = steps.start("Install optional dependencies", after=[network])
 
 
 # Install parallel HDF5
@@ -315,8 +417,9 @@ hdf5 = bb.hdf5(
     disable_fortran=True,
     disable_java=True,
     disable_cxx=True,
+    parallel=jobs.parallel(*build_memory["hdf5"]),
 )
-Stage0 += hdf5
+steps += hdf5
 
 
 # Install NetCDF
@@ -344,8 +447,8 @@ netcdf = bb.netcdf(
     enable_shared=True,
     disable_libxml2=True,
 )
-Stage0 += netcdf
-Stage0 += environment(
+steps += netcdf
+steps += environment(
     variables={
         "PKG_CONFIG_PATH": "{}/lib/pkgconfig:$PKG_CONFIG_PATH".format(netcdf_prefix),
         "CMAKE_PREFIX_PATH": "{}:$CMAKE_PREFIX_PATH".format(netcdf_prefix),
@@ -354,11 +457,10 @@ Stage0 += environment(
 
 
 ################################################################################
-Stage0 += comment("step5: start")
-Stage0 += comment("Build Peano")
+peano_step = steps.start("Build Peano", after=[io, toolchain])
 
 # Install Git large files storage (for ExaHyPe meshes)
-Stage0 += bb.packages(
+steps += bb.packages(
     ospackages=[
         "git-lfs",
     ],
@@ -378,7 +480,7 @@ peano_build = [
     "-DENABLE_EXAHYPE=ON",
     "-DENABLE_LOADBALANCING=ON",
     "-DENABLE_BLOCKSTRUCTURED=ON",
-    "-DUSE_CCACHE=OFF",
+    "-DUSE_CCACHE={}".format("ON" if ccache.enabled else "OFF"),
     "-DWITH_NETCDF=ON",
     "-DWITH_MPI=ON",
     "-DWITH_MULTITHREADING=omp",
@@ -386,13 +488,16 @@ peano_build = [
     "-DWITH_USM=ON",
     "-DWITH_GPU_ARCH=sm_90",  # set to 'none' when using AdaptiveCpp to default to 'generic' target
 ]
+if optimization.generate:
+    # Instrumented (the applications are built with the flags of Peano)
+    peano_build += optimization.cmake_opts("peano", compiler="clang")
 peano_venv = "{}/Peano/codegen".format(peano_workspace)
 peano_env = {
     "PATH": "{}/bin:$PATH".format(peano_venv),
     "LIBRARY_PATH": "{}/Peano/build/lib:$LIBRARY_PATH".format(peano_workspace),
     "LD_LIBRARY_PATH": "{}/Peano/build/lib:$LD_LIBRARY_PATH".format(peano_workspace),
 }
-Stage0 += shell(
+steps += shell(
     commands=[
         "git lfs install",
         "mkdir -p {0} && cd {0} && git clone --branch {1} --depth 1 https://gitlab.lrz.de/hpcsoftware/Peano.git Peano".format(
@@ -400,7 +505,9 @@ Stage0 += shell(
             peano_branch,
         ),
         " ".join(peano_build),
-        "cmake --build {}/Peano/build --parallel".format(peano_workspace),
+        "cmake --build {}/Peano/build --parallel {}".format(
+            peano_workspace, jobs.parallel(*build_memory["peano"], default="")
+        ).rstrip(),
         "sed -i '8,10 D' {}/Peano/requirements.txt".format(
             peano_workspace
         ),  # remove vtk and co. from requirements.txt
@@ -410,14 +517,77 @@ Stage0 += shell(
         ),
     ],
 )
-Stage0 += environment(
+steps += environment(
     variables=peano_env,
 )
 
+# Peano trees next to the default one, each with its own virtual
+# environment: optimized (see containers/common/pgo.py), and for the other
+# host microarchitectures of the image (see containers/common/multiarch.py)
+peano_trees = []
+peano_march_trees = []
+if optimization.optimized:
+    peano_tree = "{}/{}".format(peano_workspace, optimization.suffix.lstrip("_"))
+    peano_trees.append(
+        (
+            peano_tree,
+            "with {}".format(optimization.description()),
+            optimization.merge_commands(
+                "peano", llvm_profdata="{}/bin/llvm-profdata".format(llvm_prefix)
+            ),
+            optimization.cmake_opts(
+                "peano",
+                compiler="clang",
+                rpath="{}/Peano/build/lib".format(peano_tree),
+            ),
+        )
+    )
+for peano_march in host_targets.extra:
+    peano_tree = "{}/{}".format(peano_workspace, peano_march)
+    peano_march_trees.append((peano_march, peano_tree))
+    peano_trees.append(
+        (
+            peano_tree,
+            "for {}".format(peano_march),
+            [],
+            host_targets.cmake_opts(
+                peano_march,
+                compiler="clang",
+                version=llvm_version,
+                rpath="{}/Peano/build/lib".format(peano_tree),
+            ),
+        )
+    )
+for peano_tree, peano_tree_note, peano_tree_setup, peano_tree_opts in peano_trees:
+    peano_tree_build = []
+    for arg in peano_build:
+        peano_tree_build.append(
+            arg.replace(
+                "{}/Peano".format(peano_workspace), "{}/Peano".format(peano_tree)
+            )
+        )
+    steps += comment("Peano {} in {}".format(peano_tree_note, peano_tree))
+    steps += shell(
+        commands=peano_tree_setup
+        + [
+            "mkdir -p {0} && cd {0} && git clone --branch {1} --depth 1 https://gitlab.lrz.de/hpcsoftware/Peano.git Peano".format(
+                peano_tree,
+                peano_branch,
+            ),
+            " ".join(peano_tree_build + peano_tree_opts),
+            "cmake --build {}/Peano/build --parallel {}".format(
+                peano_tree,
+                jobs.parallel(*build_memory["peano"], default=""),
+            ).rstrip(),
+            "sed -i '8,10 D' {}/Peano/requirements.txt".format(peano_tree),
+            "python3 -m venv {0}/Peano/codegen && . {0}/Peano/codegen/bin/activate && pip install -e {0}/Peano".format(
+                peano_tree
+            ),
+        ],
+    )
 
 ################################################################################
-Stage0 += comment("step6: start")
-Stage0 += comment("Build ExaHyPE Apps")
+apps_step = steps.start("Build ExaHyPE Apps", after=[peano_step])
 
 exahype_prefix = "{}/Peano/applications/exahype2".format(peano_workspace)
 exahype_bindirs = []
@@ -428,7 +598,7 @@ elastic_pe_build = [
     "cd {}".format(elastic_pe_dir),
     "python point-explosion.py -md 8 -ns 0",
 ]
-Stage0 += shell(
+steps += shell(
     commands=[
         " && ".join(elastic_pe_build),
     ],
@@ -441,7 +611,7 @@ euler_pe_build = [
     "cd {}".format(euler_pe_dir),
     "python point-explosion.py -md 8 -ns 0",
 ]
-Stage0 += shell(
+steps += shell(
     commands=[
         " && ".join(euler_pe_build),
     ],
@@ -455,21 +625,99 @@ tafjord_landslide_build = [
     "sed -i 's/end_time=50.0,/end_time=6.0,/' tafjord-landslide.py",
     "python tafjord-landslide.py -md 8 -ns 0",
 ]
-Stage0 += shell(
+steps += shell(
     commands=[
         " && ".join(tafjord_landslide_build),
     ],
 )
 
+# Same applications with the other Peano trees (the optimized ones are run
+# with their full path)
+for peano_tree, peano_tree_note, peano_tree_setup, peano_tree_opts in peano_trees:
+    exahype_tree_prefix = exahype_prefix.replace(peano_workspace, peano_tree, 1)
+    steps += comment(
+        "ExaHyPE applications {} in {}".format(
+            peano_tree_note, exahype_tree_prefix
+        )
+    )
+    exahype_tree_build = []
+    for build in [elastic_pe_build, euler_pe_build, tafjord_landslide_build]:
+        commands = [". {}/Peano/codegen/bin/activate".format(peano_tree)]
+        for command in build:
+            commands.append(command.replace(exahype_prefix, exahype_tree_prefix))
+        exahype_tree_build.append(" && ".join(commands))
+    steps += shell(
+        commands=exahype_tree_build,
+    )
+
 # Set ExaHyPe environment
 exahype_env = {
     "PATH": "{}:$PATH".format(":".join(exahype_bindirs)),
 }
 
+# Peano trees and application folders of the runtime image, and the
+# application folders of each host microarchitecture (for the launcher)
+peano_dirs = ["{}/Peano".format(peano_workspace)]
+exahype_dirs = exahype_bindirs + [tafjord_landslide_dir]
+exahype_launcher_builds = []
+for path in exahype_dirs:
+    exahype_launcher_builds.append((config["march"], path, config["march"]))
+for peano_tree, peano_tree_note, peano_tree_setup, peano_tree_opts in peano_trees:
+    peano_dirs.append("{}/Peano".format(peano_tree))
+    for path in exahype_bindirs + [tafjord_landslide_dir]:
+        exahype_dirs.append(path.replace(peano_workspace, peano_tree, 1))
+for peano_march, peano_tree in peano_march_trees:
+    for path in exahype_bindirs + [tafjord_landslide_dir]:
+        exahype_launcher_builds.append(
+            (peano_march, path.replace(peano_workspace, peano_tree, 1), peano_march)
+        )
+
 
 ################################################################################
-Stage0 += comment("step7: start")
-Stage0 += comment("Generate runtime image")
+runtime_after = [apps_step]
+if pruning.enabled:
+    runtime_after = [steps.start("Prune runtime files", after=[apps_step])]
+
+    # Keep the application folders (without build objects), the OpenMP
+    # offloading plugins, and the files of the MPI stack and of AdaptiveCpp
+    # loaded at runtime without being linked (plugins, help texts and
+    # configuration)
+    steps += pruning.layers(
+        steps.prefixes() + peano_dirs,
+        keep=exahype_dirs
+        + [
+            "{}/lib/libomptarget*".format(llvm_prefix),
+            "{}/lib/*/libomptarget*".format(llvm_prefix),
+            "{}/bin".format(ucx_prefix),
+            "{}/etc".format(ucx_prefix),
+            "{}/lib/ucx".format(ucx_prefix),
+            "/usr/local/pmix/lib/pmix",
+            "/usr/local/pmix/share/pmix",
+            "/usr/local/pmix/etc",
+            "/usr/local/openmpi/bin",
+            "/usr/local/openmpi/etc",
+            "/usr/local/openmpi/lib/openmpi",
+            "/usr/local/openmpi/lib/pmix",
+            "/usr/local/openmpi/share/openmpi",
+            "/usr/local/openmpi/share/pmix",
+            "/usr/local/openmpi/share/prte",
+            "{}/etc".format(adaptive_cpp_prefix),
+            "{}/lib/hipSYCL".format(adaptive_cpp_prefix),
+        ],
+    )
+
+if host_targets.enabled:
+    runtime_after = [steps.start("Install launcher", after=runtime_after)]
+
+    # Launcher of the ExaHyPE application build for the CPU of the node,
+    # under the name of each binary
+    steps += host_targets.layers(exahype_launcher_builds)
+
+
+################################################################################
+if app_overlay:
+    steps.overlay(peano_dirs + host_targets.prefixes(), after=peano_step.after)
+steps.start("Generate runtime image", after=runtime_after)
 
 Stage1 += baseimage(  # noqa: F821
     image="docker.io/{}@{}".format(config["base_image"], config["digest_runtime"]),
@@ -480,14 +728,13 @@ Stage1 += baseimage(  # noqa: F821
 # Copy all default runtimes
 Stage1 += Stage0.runtime()
 
-# Copy Peano/ExaHyPe folder
+# Copy Peano/ExaHyPe folder (unless shipped in the application overlay)
 Stage1 += comment("Copy ExaHyPE build files and setup environment")
-Stage1 += copy(
-    _from="devel",
-    files={
-        "{0}/Peano".format(peano_workspace): "{0}/Peano".format(peano_workspace),
-    },
-)
+if not app_overlay:
+    Stage1 += copy(
+        _from="devel",
+        files={path: path for path in peano_dirs},
+    )
 Stage1 += environment(
     variables=peano_env,
 )
@@ -495,6 +742,9 @@ Stage1 += environment(
     variables=exahype_env,
 )
 
+# Launcher first in the PATH (shipped in the application overlay, if any)
+Stage1 += host_targets.runtime_layers(copy_files=not app_overlay)
+
 # Manually add missing libraries
 Stage1 += comment("Libraries missing from CUDA runtime image")
 Stage1 += bb.packages(
@@ -504,7 +754,10 @@ Stage1 += bb.packages(
     ]
 )
 
-# Run Tafjord landslide by default
+# Run Tafjord landslide by default (through the launcher, if any)
+tafjord_landslide_bin = "TafjordLandslide.Release"
+if not host_targets.enabled:
+    tafjord_landslide_bin = "./" + tafjord_landslide_bin
 Stage1 += comment("Set workdir and entrypoint")
 Stage1 += shell(
     commands=[
@@ -512,7 +765,7 @@ Stage1 += shell(
         "echo 'cd {0}/shallow-water/tafjord-landslide' >> {1}/runscript.sh".format(
             exahype_prefix, peano_workspace
         ),
-        "echo './TafjordLandslide.Release' >> {}/runscript.sh".format(peano_workspace),
+        "echo '{}' >> {}/runscript.sh".format(tafjord_landslide_bin, peano_workspace),
         "chmod +x {}/runscript.sh".format(peano_workspace),
     ]
 )
@@ -520,3 +773,6 @@ Stage1 += hpccm.primitives.runscript(
     commands=["{}/runscript.sh".format(peano_workspace)],
     _args=False,
 )
+
+# Install all OS packages of the runtime image at once, if requested
+steps.coalesce_runtime(Stage1)  # noqa: F821
@@ -1,10 +1,24 @@
 #!/usr/bin/env python
 
+import hashlib
 import hpccm
 import hpccm.building_blocks as bb
 from hpccm.primitives import baseimage, comment, copy, environment, shell
+import itertools
 import json
 from pathlib import Path
+import sys
+
+# Shared recipe helpers
+sys.path.insert(0, str(Path(include.prepend_path).resolve().parent / "common"))  # noqa: F821
+from buildjobs import BuildJobs  # noqa: E402
+from buildlog import BuildLog  # noqa: E402
+from buildsteps import BuildSteps  # noqa: E402
+from ccache import CompilerCache  # noqa: E402
+from mirror import SourceMirror  # noqa: E402
+from multiarch import HostTargets  # noqa: E402
+from pgo import Optimization  # noqa: E402
+from prune import RuntimePruning  # noqa: E402
 
 
 # Get correct config
@@ -28,15 +42,87 @@ Stage0 += baseimage(  # noqa: F821
 # Microarchitecture specification
 hpccm.config.set_cpu_target(config["march"])
 
+# Build steps ("linear", "layered" or "graph", see containers/common/buildsteps.py)
+steps = BuildSteps(
+    mode=USERARG.get("build-mode", "linear"),  # noqa: F821
+    coalesce=USERARG.get("coalesce-apt", "0") == "1",  # noqa: F821
+)
+Stage0 += steps  # noqa: F821
+
+# Local source mirror (see containers/common/mirror.py)
+mirror = SourceMirror(
+    USERARG.get("mirror", ""),  # noqa: F821
+    git_url=USERARG.get("mirror-git"),  # noqa: F821
+    pip_offline=USERARG.get("pip-offline", "0") == "1",  # noqa: F821
+)
+
+# Compiler cache, mounted during the build (see containers/common/ccache.py)
+ccache = CompilerCache(
+    USERARG.get("ccache", ""),  # noqa: F821
+    max_size=USERARG.get("ccache-size", "50G"),  # noqa: F821
+)
+steps.wrap(start=ccache.start_layers(), end=ccache.end_layers())
+
+# Build parallelism: "nproc", "auto" (derived from the memory available at
+# build time) or a fixed number of jobs (see containers/common/buildjobs.py)
+jobs = BuildJobs(USERARG.get("build-jobs", "nproc"))  # noqa: F821
+
+# Log of the time and resources used by each building block, if requested
+# (see containers/common/buildlog.py)
+build_log = BuildLog(USERARG.get("build-log", ""))  # noqa: F821
+if build_log.enabled:
+    steps.instrument(build_log.instrument)
+
+# Pruning of the runtime files down to what the applications need, if
+# requested (see containers/common/prune.py)
+pruning = RuntimePruning(USERARG.get("prune-runtime", "0") == "1")  # noqa: F821
+
+# Ship the application in an overlay of a runtime image built without it, if
+# requested (see containers/common/buildsteps.py)
+app_overlay = USERARG.get("app-overlay", "0") == "1"  # noqa: F821
+
+# Profile-guided and link-time optimized builds of the applications, if
+# requested (see containers/common/pgo.py)
+optimization = Optimization(
+    USERARG.get("pgo", ""),  # noqa: F821
+    profile_dir=USERARG.get("pgo-profile", "/var/tmp/pgo-profile"),  # noqa: F821
+    lto=USERARG.get("lto", "0") == "1",  # noqa: F821
+)
+
+# Builds of the applications for other host microarchitectures, next to the
+# default ones, dispatched at launch (see containers/common/multiarch.py)
+host_targets = HostTargets(
+    config["march"], USERARG.get("extra-march", "")  # noqa: F821
+)
+
+# Expected memory (MiB) of each compile and link job of the building blocks,
+# used to derive their parallelism in "auto" mode
+build_memory = {
+    "xpmem": (200, 200),
+    "ucx": (400, 600),
+    "pmix": (300, 500),
+    "openmpi": (400, 800),
+    "boost": (1000, 1500),
+    "adaptive_cpp": (1500, 3000),
+    "hdf5": (400, 800),
+    "parmetis": (300, 600),
+    "eigen": (500, 500),
+    "asagi": (600, 800),
+    "impalajit": (600, 800),
+    "yamlcpp": (800, 1000),
+    "easi": (1500, 2000),
+    "libxsmm": (1000, 1500),
+    "seissol": (3000, 6000),
+}
+
 
 ################################################################################
-Stage0 += comment("step1: start")
-Stage0 += comment("Install build tools over base image")
+tools = steps.start("Install build tools over base image")
 
 # Install Python with virtual environments support
 python = bb.python(python2=False)
-Stage0 += python
-Stage0 += bb.packages(
+steps += python
+steps += bb.packages(
     ospackages=[
         "python3-pip",
         "python3-venv",
@@ -46,37 +132,52 @@ Stage0 += bb.packages(
 )
 
 # Install CMake
-Stage0 += bb.cmake(eula=True, version="3.31.4")
+steps += bb.cmake(eula=True, version="3.31.4")
 
 # Install Git and pkgconf
-Stage0 += comment("Git, Pkgconf")
-Stage0 += bb.packages(ospackages=["git", "pkgconf"])
+steps += comment("Git, Pkgconf")
+steps += bb.packages(ospackages=["git", "pkgconf"])
+
+# Redirect git clones and pip installs to the source mirror, if any
+steps += mirror.layers()
+
+# Install compiler cache, if enabled
+steps += ccache.layers()
+
+# Install build-jobs script, if needed
+steps += jobs.layers()
+
+# Install build-log script, if needed
+steps += build_log.layers()
 
 
 ################################################################################
-Stage0 += comment("step2: start")
-Stage0 += comment("Install network stack packages and OpenMPI")
+network = steps.start(
+    "Install network stack packages and OpenMPI", after=[tools], site_specific=True
+)
 
 # Get network stack configuration
 netconfig = config["network_stack"]
 
 # Install Mellanox OFED userspace libraries
 mlnx_ofed = bb.mlnx_ofed(version=netconfig["mlnx_ofed"])
-Stage0 += mlnx_ofed
+steps += mlnx_ofed
 
 # Install KNEM headers
 if netconfig["knem"]:
     knem_prefix = "/usr/local/knem"
     knem = bb.knem(prefix=knem_prefix)
-    Stage0 += knem
+    steps += knem
 else:
     knem_prefix = False
 
 # Install XPMEM userspace library
 if netconfig["xpmem"]:
     xpmem_prefix = "/usr/local/xpmem"
-    xpmem = bb.xpmem(prefix=xpmem_prefix)
-    Stage0 += xpmem
+    xpmem = bb.xpmem(
+        prefix=xpmem_prefix, parallel=jobs.parallel(*build_memory["xpmem"])
+    )
+    steps += xpmem
 else:
     xpmem_prefix = False
 
@@ -84,7 +185,7 @@ else:
 if netconfig["gdrcopy"]:
     gdrcopy_prefix = "/usr/local/gdrcopy"
     gdrcopy = bb.gdrcopy(prefix=gdrcopy_prefix)
-    Stage0 += gdrcopy
+    steps += gdrcopy
 else:
     gdrcopy_prefix = False
 
@@ -100,8 +201,9 @@ ucx = bb.ucx(
     xpmem=xpmem_prefix,
     gdrcopy=gdrcopy_prefix,
     enable_mt=True,
+    parallel=jobs.parallel(*build_memory["ucx"]),
 )
-Stage0 += ucx
+steps += ucx
 
 # Install PMIx
 match netconfig["pmix"]:
@@ -109,8 +211,12 @@ match netconfig["pmix"]:
         pmix_prefix = "internal"
     case version:
         pmix_prefix = "/usr/local/pmix"
-        pmix = bb.pmix(prefix=pmix_prefix, version=netconfig["pmix"])
-        Stage0 += pmix
+        pmix = bb.pmix(
+            prefix=pmix_prefix,
+            version=netconfig["pmix"],
+            parallel=jobs.parallel(*build_memory["pmix"]),
+        )
+        steps += pmix
 
 # Install OpenMPI
 ompi = bb.openmpi(
@@ -118,19 +224,19 @@ ompi = bb.openmpi(
     version=netconfig["ompi"],
     ucx=ucx_prefix,
     pmix=pmix_prefix,
+    parallel=jobs.parallel(*build_memory["openmpi"]),
 )
-Stage0 += ompi
+steps += ompi
 
 
 ################################################################################
-Stage0 += comment("step3: start")
-Stage0 += comment("Install AdaptiveCpp for SYCL compilation support")
+sycl = steps.start("Install AdaptiveCpp for SYCL compilation support", after=[tools])
 
 # Install LLVM
 ## Passing _trunk_version="0.1" to force correct toolchain installation from upstream
 ## repos, which otherwise fails due to incorrect package name specification
 llvm = bb.llvm(version="18", upstream=True, toolset=True, _trunk_version="0.1")
-Stage0 += llvm
+steps.hoist(llvm)
 
 # Install Boost
 match config["arch"]:
@@ -173,9 +279,10 @@ boost = bb.boost(
         "--prefix=/usr/local/boost",
     ],
     environment=False,
+    parallel=jobs.parallel(*build_memory["boost"]),
 )
-Stage0 += boost
-Stage0 += environment(
+steps += boost
+steps += environment(
     variables=boost_env,
 )
 
@@ -199,13 +306,15 @@ adaptive_cpp = bb.generic_cmake(
     ],
     devel_environment=adaptive_cpp_env,
     runtime_environment=adaptive_cpp_env,
+    parallel=jobs.parallel(*build_memory["adaptive_cpp"]),
 )
-Stage0 += adaptive_cpp
+steps += adaptive_cpp
 
 
 ################################################################################
-Stage0 += comment("step4: start")
-Stage0 += comment("Install I/O, meshing and math libraries required by SeisSol")
+io = steps.start(
+    "Install I/O, meshing and math libraries required by SeisSol", after=[network]
+)
 
 
 # Install parallel HDF5
@@ -242,8 +351,9 @@ hdf5 = bb.hdf5(
     enable_parallel=True,
     disable_shared=True,
     with_zlib=True,
+    parallel=jobs.parallel(*build_memory["hdf5"]),
 )
-Stage0 += hdf5
+steps += hdf5
 
 
 # Install NetCDF
@@ -277,8 +387,8 @@ netcdf = bb.netcdf(
     disable_libxml2=True,
     disable_byterange=True,
 )
-Stage0 += netcdf
-Stage0 += environment(
+steps += netcdf
+steps += environment(
     variables={
         "PKG_CONFIG_PATH": "{}/lib/pkgconfig:$PKG_CONFIG_PATH".format(netcdf_prefix),
         "CMAKE_PREFIX_PATH": "{}:$CMAKE_PREFIX_PATH".format(netcdf_prefix),
@@ -302,24 +412,25 @@ parmetis = bb.generic_build(
         "CC=mpicc CXX=mpicxx F77=mpif77 F90=mpif90 FC=mpifort make config prefix={}".format(
             parmetis_prefix
         ),
-        "make -j$(nproc)",
-        "make -j$(nproc) install",
+        "make -j{}".format(jobs.parallel(*build_memory["parmetis"])),
+        "make -j{} install".format(jobs.parallel(*build_memory["parmetis"])),
         "cp ./build/Linux-*/libmetis/libmetis.a {}/lib".format(parmetis_prefix),
         "cp ./metis/include/metis.h {}/include".format(parmetis_prefix),
     ],
     devel_environment=parmetis_env,
     runtime_environment=parmetis_env,
 )
-Stage0 += parmetis
+steps += parmetis
 
 # Install OpenBLAS
+openblas_step = steps.branch("Install OpenBLAS", after=[tools])
 openblas_prefix = "/usr/local/openblas"
 openblas = bb.openblas(
     version="0.3.27",
     prefix=openblas_prefix,
 )
-Stage0 += openblas
-Stage0 += environment(
+steps += openblas
+steps += environment(
     variables={
         "PATH": "{}/bin:$PATH".format(openblas_prefix),
         "CPATH": "{}/include:$CPATH".format(openblas_prefix),
@@ -331,6 +442,7 @@ Stage0 += environment(
 )
 
 # Install Eigen
+eigen_step = steps.branch("Install Eigen", after=[tools])
 eigen_prefix = "/usr/local/eigen"
 eigen_env = {
     "CPATH": "{}/include:$CPATH".format(eigen_prefix),
@@ -347,15 +459,16 @@ eigen = bb.generic_cmake(
     ],
     devel_environment=eigen_env,
     runtime_environment=eigen_env,
+    parallel=jobs.parallel(*build_memory["eigen"]),
 )
-Stage0 += eigen
+steps += eigen
 
 
 ################################################################################
-Stage0 += comment("step5: start")
-Stage0 += comment("Install geospatial data acquisition tools")
+steps.start("Install geospatial data acquisition tools", after=[io])
 
 # Install LUA
+lua_step = steps.branch("Install Lua", after=[tools])
 lua_prefix = "/usr/local/lua"
 lua_env = {
     "PATH": "{}/bin:$PATH".format(lua_prefix),
@@ -371,9 +484,10 @@ lua = bb.generic_build(
     devel_environment=lua_env,
     runtime_environment=lua_env,
 )
-Stage0 += lua
+steps += lua
 
 # Install ASAGI
+asagi_step = steps.branch("Install ASAGI", after=[io])
 asagi_prefix = "/usr/local/asagi"
 asagi_env = {
     "CPATH": "{}/include:$CPATH".format(asagi_prefix),
@@ -396,10 +510,12 @@ asagi = bb.generic_cmake(
     ],
     devel_environment=asagi_env,
     runtime_Environment=asagi_env,
+    parallel=jobs.parallel(*build_memory["asagi"]),
 )
-Stage0 += asagi
+steps += asagi
 
 # Install ImpalaJIT
+impalajit_step = steps.branch("Install ImpalaJIT", after=[tools])
 impalajit_prefix = "/usr/local/impalajit"
 impalajit_env = {
     "CPATH": "{}/include:$CPATH".format(impalajit_prefix),
@@ -421,10 +537,12 @@ impalajit = bb.generic_cmake(
     ],
     devel_environment=impalajit_env,
     runtime_environment=impalajit_env,
+    parallel=jobs.parallel(*build_memory["impalajit"]),
 )
-Stage0 += impalajit
+steps += impalajit
 
 # Install yaml-cpp
+yamlcpp_step = steps.branch("Install yaml-cpp", after=[tools])
 yamlcpp_prefix = "/usr/local/yaml-cpp"
 yamlcpp_env = {
     "CPATH": "{}/include:$CPATH".format(yamlcpp_prefix),
@@ -442,10 +560,14 @@ yamlcpp = bb.generic_cmake(
     ],
     devel_environment=yamlcpp_env,
     runtime_environment=yamlcpp_env,
+    parallel=jobs.parallel(*build_memory["yamlcpp"]),
 )
-Stage0 += yamlcpp
+steps += yamlcpp
 
 # Install easi
+easi_step = steps.branch(
+    "Install easi", after=[asagi_step, lua_step, impalajit_step, yamlcpp_step]
+)
 easi_prefix = "/usr/local/easi"
 easi_env = {
     "CPATH": "{}/include:$CPATH".format(easi_prefix),
@@ -467,13 +589,13 @@ easi = bb.generic_cmake(
     ],
     devel_environment=easi_env,
     runtime_environment=easi_env,
+    parallel=jobs.parallel(*build_memory["easi"]),
 )
-Stage0 += easi
+steps += easi
 
 
 ################################################################################
-Stage0 += comment("step6: start")
-Stage0 += comment("Install CPU and GPU code generators")
+codegen = steps.start("Install CPU and GPU code generators", after=[tools])
 
 # Install libxsmm
 match config["arch"]:
@@ -500,28 +622,36 @@ libxsmm = bb.generic_build(
     commit="419f7ec32d5bb2004f8a4ff1cf3b93c32d4e1227",  # last commit as of 28/01/2025
     prefix=libxsmm_prefix,
     build=[
-        "make PREFIX={0} {1} -j$(nproc) install-minimal".format(
-            libxsmm_prefix, libxsmm_extra_build_opts
+        "make PREFIX={0} {1} -j{2} install-minimal".format(
+            libxsmm_prefix,
+            libxsmm_extra_build_opts,
+            jobs.parallel(*build_memory["libxsmm"]),
         ),
     ],
     devel_environment=libxsmm_env,
     runtime_environment=libxsmm_env,
 )
-Stage0 += libxsmm
+steps += libxsmm
 
 # Install PSpaMM, gemmforge, chainforge
-Stage0 += comment("PSpaMM, gemmforge, chainforge")
-Stage0 += shell(
+codegen_venv_step = steps.branch(
+    "Install Python code generators", after=[tools], prefix=["/usr/local/codegen"]
+)
+codegen_packages = [
+    "git+https://github.com/SeisSol/PSpaMM.git@v0.3.0",
+    "git+https://github.com/SeisSol/gemmforge.git@00d2101e32069267ecd4067133fdb0d34e9ae807",
+    "git+https://github.com/SeisSol/chainforge.git@f9d053e811d4410f78964d8a9eae7e1a632aa1fb",
+]
+steps += comment("PSpaMM, gemmforge, chainforge")
+steps += shell(
     commands=[
         "python3 -m venv /usr/local/codegen",
         ". /usr/local/codegen/bin/activate",
         "pip install --upgrade pip",
-        "pip install git+https://github.com/SeisSol/PSpaMM.git@v0.3.0",
-        "pip install git+https://github.com/SeisSol/gemmforge.git@00d2101e32069267ecd4067133fdb0d34e9ae807",
-        "pip install git+https://github.com/SeisSol/chainforge.git@f9d053e811d4410f78964d8a9eae7e1a632aa1fb",
-    ],
+    ]
+    + ["pip install {}".format(package) for package in codegen_packages],
 )
-Stage0 += environment(
+steps += environment(
     variables={
         "PATH": "/usr/local/codegen/bin:$PATH",
         "VIRTUAL_ENV": "/usr/local/codegen",
@@ -530,53 +660,286 @@ Stage0 += environment(
 
 
 ################################################################################
-Stage0 += comment("step7: start")
-Stage0 += comment("Install SeisSol (order 4/5/6, double precision)")
+# SeisSol build matrix: defaults, overridden by the "seissol" section of the
+# config file, if any, and by the seissol-<key> userargs (comma-separated)
+seissol_matrix = {
+    "orders": [4, 5, 6],
+    "precisions": ["single"],
+    "equations": ["elastic"],
+    "backends": ["cuda"],
+}
+seissol_matrix.update(config.get("seissol", {}))
+for key in seissol_matrix:
+    userarg = USERARG.get("seissol-{}".format(key))  # noqa: F821
+    if userarg:
+        seissol_matrix[key] = userarg.split(",")
+
+# Build each distinct variant once
+seissol_variants = list(
+    dict.fromkeys(
+        itertools.product(
+            [int(order) for order in seissol_matrix["orders"]],
+            seissol_matrix["precisions"],
+            seissol_matrix["equations"],
+            seissol_matrix["backends"],
+        )
+    )
+)
+
+seissol_description = "order {0}, {1} precision".format(
+    "/".join(str(order) for order in dict.fromkeys(v[0] for v in seissol_variants)),
+    "/".join(dict.fromkeys(v[1] for v in seissol_variants)),
+)
+if seissol_matrix["equations"] != ["elastic"]:
+    seissol_description += ", {} equations".format(
+        "/".join(seissol_matrix["equations"])
+    )
+if seissol_matrix["backends"] != ["cuda"]:
+    seissol_description += ", {} backend".format(
+        "/".join(seissol_matrix["backends"])
+    )
+
+seissol_step = steps.start(
+    "Install SeisSol ({})".format(seissol_description),
+    after=[
+        easi_step,
+        io,
+        sycl,
+        openblas_step,
+        eigen_step,
+        codegen,
+        codegen_venv_step,
+    ],
+)
 
 # Install SeisSol
-match config["march"]:
-    case "skylake":
-        seissol_host_arch = "skx"
-    case "neoverse_v2":
-        seissol_host_arch = "neon"
-    case "zen2":
-        seissol_host_arch = "rome"
-    case _:
+# SeisSol host architecture of each microarchitecture, and the
+# microarchitecture whose instructions it uses
+seissol_host_archs = {
+    "skylake": ("skx", "skylake_avx512"),
+    "skylake_avx512": ("skx", "skylake_avx512"),
+    "icelake": ("skx", "skylake_avx512"),
+    "haswell": ("hsw", "haswell"),
+    "x86_64_v3": ("hsw", "x86_64_v3"),
+    "zen2": ("rome", "zen2"),
+    "zen3": ("milan", "zen3"),
+    "neoverse_v2": ("neon", "neoverse_v2"),
+}
+seissol_marches = [config["march"]] + host_targets.extra
+for seissol_march in seissol_marches:
+    if seissol_march not in seissol_host_archs:
         raise ValueError(
-            "Invalid or unsupported microarchitecture: {}".format(config["march"])
+            "Invalid or unsupported microarchitecture: {}".format(seissol_march)
         )
 
+# Kernels generated by the code generators are cached (in a directory
+# bind-mounted during the build, if given), keyed by everything they
+# depend on, and copied into the build directory of identical variants
+seissol_branch = "v1.3.0"
+seissol_kernel_cache = USERARG.get(  # noqa: F821
+    "seissol-kernel-cache", ""
+).rstrip("/")
+seissol_generated_dir = "/var/tmp/SeisSol/build/src/generated_code"
+
 seissol_base_prefix = "/usr/local/seissol"
 seissol_toolchain = hpccm.toolchain(LDFLAGS="-lcurl")
-for order in [4, 5, 6]:
-    seissol_prefix = "{}_O{}".format(seissol_base_prefix, order)
+seissol_variant_steps = []
+seissol_launcher_builds = []
+for order, precision, equations, backend in seissol_variants:
+    # Default variants keep the seissol_O<order> prefix
+    seissol_prefix = "_".join(
+        ["{}_O{}".format(seissol_base_prefix, order)]
+        + [
+            value
+            for value, default in [
+                (precision, "single"),
+                (equations, "elastic"),
+                (backend, "cuda"),
+            ]
+            if value != default
+        ]
+    )
+    seissol_variant_steps.append(
+        steps.branch(
+            "Install SeisSol (order {}, {} precision, {}, {})".format(
+                order, precision, equations, backend
+            ),
+            after=[seissol_step],
+            prefix=[seissol_prefix],
+        )
+    )
     seissol_env = {
         "PATH": "{}/bin:$PATH".format(seissol_prefix),
         "LIBRARY_PATH": "{}/lib:$LIBRARY_PATH".format(seissol_prefix),
         "LD_LIBRARY_PATH": "{}/lib:$LD_LIBRARY_PATH".format(seissol_prefix),
     }
-    seissol = bb.generic_cmake(
-        repository="https://github.com/SeisSol/SeisSol.git",
-        branch="v1.3.0",
-        recursive=True,
-        toolchain=seissol_toolchain,
-        prefix=seissol_prefix,
-        cmake_opts=[
-            "-DCMAKE_BUILD_TYPE=Release",
-            "-DDEVICE_BACKEND=cuda",
-            "-DDEVICE_ARCH=sm_{}".format(config["cuda_arch"]),
+
+    # Default build for the microarchitecture of the config file, and builds
+    # for the other ones of the image, run by the launcher
+    for seissol_march in seissol_marches:
+        seissol_host_arch, seissol_host_target = seissol_host_archs[seissol_march]
+        seissol_opts = ["-DCMAKE_BUILD_TYPE=Release"]
+        if backend != "none":
+            seissol_opts += [
+                "-DDEVICE_BACKEND={}".format(backend),
+                "-DDEVICE_ARCH=sm_{}".format(config["cuda_arch"]),
+            ]
+        seissol_opts += [
             "-DHOST_ARCH={}".format(seissol_host_arch),
-            "-DPRECISION=single",
+            "-DPRECISION={}".format(precision),
             "-DORDER={}".format(order),
+        ]
+        if equations != "elastic":
+            seissol_opts.append("-DEQUATIONS={}".format(equations))
+        if equations.startswith("viscoelastic"):
+            seissol_opts.append("-DNUMBER_OF_MECHANISMS=3")
+
+        seissol_cache_opts = {}
+        if seissol_kernel_cache:
+            seissol_kernel_key = hashlib.sha256(
+                " ".join(
+                    [seissol_branch, seissol_host_arch, config["cuda_arch"]]
+                    + seissol_opts
+                    + codegen_packages
+                ).encode()
+            ).hexdigest()[:16]
+            seissol_kernel_dir = "{}/{}".format(
+                seissol_kernel_cache, seissol_kernel_key
+            )
+            seissol_cache_opts = {
+                "preconfigure": [
+                    "if [ -d {0} ]; then echo 'Using cached kernels {0}'; mkdir -p {1} && cp -r {0}/. {1}; fi".format(
+                        seissol_kernel_dir, seissol_generated_dir
+                    ),
+                ],
+                "postinstall": [
+                    "if [ -d {0} ] && [ ! -d {1} ]; then cp -r {2} {1}.partial.$$ && mv {1}.partial.$$ {1}; fi".format(
+                        seissol_kernel_cache, seissol_kernel_dir, seissol_generated_dir
+                    ),
+                ],
+            }
+
+        if seissol_march != config["march"]:
+            seissol_march_prefix = "{}_{}".format(seissol_prefix, seissol_march)
+            seissol_variant_steps[-1].prefix.append(seissol_march_prefix)
+            seissol_launcher_builds.append(
+                (
+                    seissol_march,
+                    "{}/bin".format(seissol_march_prefix),
+                    seissol_host_target,
+                )
+            )
+            steps += comment(
+                "SeisSol for {} in {}".format(seissol_march, seissol_march_prefix)
+            )
+            steps += bb.generic_cmake(
+                repository="https://github.com/SeisSol/SeisSol.git",
+                branch=seissol_branch,
+                recursive=True,
+                toolchain=hpccm.toolchain(LDFLAGS="-lcurl -Wl,--disable-new-dtags"),
+                prefix=seissol_march_prefix,
+                cmake_opts=seissol_opts
+                + ["-DCMAKE_INSTALL_RPATH={}/lib".format(seissol_march_prefix)],
+                parallel=jobs.parallel(*build_memory["seissol"]),
+                **seissol_cache_opts,
+            )
+            continue
+        seissol_launcher_builds.append(
+            (seissol_march, "{}/bin".format(seissol_prefix), seissol_host_target)
+        )
+
+        # Instrumented when generating profiles
+        seissol_profile = Path(seissol_prefix).name
+        seissol = bb.generic_cmake(
+            repository="https://github.com/SeisSol/SeisSol.git",
+            branch=seissol_branch,
+            recursive=True,
+            toolchain=(
+                optimization.toolchain(seissol_toolchain, seissol_profile)
+                if optimization.generate
+                else seissol_toolchain
+            ),
+            prefix=seissol_prefix,
+            cmake_opts=seissol_opts,
+            runtime_environment=seissol_env,
+            parallel=jobs.parallel(*build_memory["seissol"]),
+            **seissol_cache_opts,
+        )
+        steps += seissol
+
+        # Optimized build next to the default one (same build directory, as
+        # gcc looks up the profiles by object file path), run with its full
+        # path
+        if optimization.optimized:
+            seissol_optimized_prefix = seissol_prefix + optimization.suffix
+            seissol_variant_steps[-1].prefix.append(seissol_optimized_prefix)
+            steps += comment(
+                "SeisSol with {} in {}".format(
+                    optimization.description(), seissol_optimized_prefix
+                )
+            )
+            steps += bb.generic_cmake(
+                repository="https://github.com/SeisSol/SeisSol.git",
+                branch=seissol_branch,
+                recursive=True,
+                toolchain=optimization.toolchain(
+                    seissol_toolchain, seissol_profile, rpath=True
+                ),
+                prefix=seissol_optimized_prefix,
+                cmake_opts=seissol_opts
+                + optimization.cmake_opts(
+                    rpath="{}/lib".format(seissol_optimized_prefix)
+                ),
+                parallel=jobs.parallel(*build_memory["seissol"]),
+                **seissol_cache_opts,
+            )
+
+################################################################################
+runtime_after = seissol_variant_steps
+if pruning.enabled:
+    runtime_after = [steps.start("Prune runtime files", after=seissol_variant_steps)]
+
+    # Keep the SeisSol binaries, and the files of the MPI stack and of
+    # AdaptiveCpp loaded at runtime without being linked (plugins, help
+    # texts and configuration)
+    steps += pruning.layers(
+        steps.prefixes(),
+        keep=[
+            "{}_O*/bin".format(seissol_base_prefix),
+            "{}/bin".format(ucx_prefix),
+            "{}/etc".format(ucx_prefix),
+            "{}/lib/ucx".format(ucx_prefix),
+            "/usr/local/pmix/lib/pmix",
+            "/usr/local/pmix/share/pmix",
+            "/usr/local/pmix/etc",
+            "/usr/local/openmpi/bin",
+            "/usr/local/openmpi/etc",
+            "/usr/local/openmpi/lib/openmpi",
+            "/usr/local/openmpi/lib/pmix",
+            "/usr/local/openmpi/share/openmpi",
+            "/usr/local/openmpi/share/pmix",
+            "/usr/local/openmpi/share/prte",
+            "{}/etc".format(adaptive_cpp_prefix),
+            "{}/lib/hipSYCL".format(adaptive_cpp_prefix),
         ],
-        runtime_environment=seissol_env,
     )
-    Stage0 += seissol
+
+if host_targets.enabled:
+    runtime_after = [steps.start("Install launcher", after=runtime_after)]
+
+    # Launcher of the SeisSol build for the CPU of the node, under the name
+    # of each binary
+    steps += host_targets.layers(seissol_launcher_builds)
 
 
 ################################################################################
-Stage0 += comment("step8: start")
-Stage0 += comment("Generate runtime image")
+if app_overlay:
+    steps.overlay(
+        [prefix for step in seissol_variant_steps for prefix in step.prefix]
+        + host_targets.prefixes(),
+        after=seissol_step.after,
+    )
+steps.start("Generate runtime image", after=runtime_after)
 
 Stage1 += baseimage(  # noqa: F821
     image="docker.io/{}@{}".format(config["base_image"], config["digest_runtime"]),
@@ -587,20 +950,24 @@ Stage1 += baseimage(  # noqa: F821
 # Copy all default runtimes
 Stage1 += Stage0.runtime()
 
-# Copy python virtualenv
-Stage1 += comment("Code generators")
-Stage1 += copy(
-    _from="devel",
-    files={
-        "/usr/local/codegen": "/usr/local/codegen",
-    },
-)
-Stage1 += environment(
-    variables={
-        "PATH": "/usr/local/codegen/bin:$PATH",
-        "VIRTUAL_ENV": "/usr/local/codegen",
-    }
-)
+# Copy python virtualenv (only needed to generate kernels, not when pruning)
+if not pruning.enabled:
+    Stage1 += comment("Code generators")
+    Stage1 += copy(
+        _from="devel",
+        files={
+            "/usr/local/codegen": "/usr/local/codegen",
+        },
+    )
+    Stage1 += environment(
+        variables={
+            "PATH": "/usr/local/codegen/bin:$PATH",
+            "VIRTUAL_ENV": "/usr/local/codegen",
+        }
+    )
+
+# Launcher first in the PATH (shipped in the application overlay, if any)
+Stage1 += host_targets.runtime_layers(copy_files=not app_overlay)
 
 # Manually add missing libraries
 Stage1 += comment("Libraries missing from CUDA runtime image")
@@ -611,3 +978,6 @@ Stage1 += bb.packages(
         "libcurl4",
     ]
 )
+
+# Install all OS packages of the runtime image at once, if requested
+steps.coalesce_runtime(Stage1)  # noqa: F821
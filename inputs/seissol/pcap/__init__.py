@@ -0,0 +1,8 @@
+"""Tools for the power-capping runs of SeisSol.
+
+Run from the workspace folder (the copy of inputs/seissol, next to the input
+folder), e.g.:
+
+    python3 -m pcap.sweep create sweeps/caps --caps none,300,400 --nodes 4,8
+    python3 -m pcap.sweep submit sweeps/caps
+"""
@@ -0,0 +1,313 @@
+"""Compute the time and energy-to-solution of SeisSol runs from their job
+output and power telemetry, and write one table per sweep.
+
+For each run directory, the analysis reads:
+
+- the job output (<job_id>.out): the start and end of the application
+  printed by submit.slurm, and from the SeisSol log the wall time of the
+  time stepping ("Elapsed time"), the time of its phases ("Time spent
+  in/for ...") and its throughput (GFLOP/s, TFLOP/s or PFLOP/s),
+- the telemetry of each node (telemetry/<node>.tel, see pcap/telemetry.py).
+
+It integrates the power of each node over the run and over the time
+stepping (trapezoidal rule): the module power of hwmon if the node reports
+it (e.g. Grace Hopper, the module includes the GPU), otherwise the sum of
+the GPU and hwmon power, and the GPU power alone. It writes the result of
+each run with telemetry to its result.json (source "telemetry"), unless the
+run has a result of another source (e.g. sacct), and a results.csv table
+per sweep folder, with the average and peak power, the energy-delay
+product (EDP) and the speedup and energy relative to the uncapped runs of
+the same node count and order (mean over repetitions). Arrays of samples are
+handled with NumPy only, so that sweeps of hundreds of runs with hours of
+telemetry take seconds.
+
+A folder without manifest.json is analysed as a single run if it holds a
+job output, or else as a set of runs (e.g. folders of setup-sim.sh).
+
+Example:
+    python3 -m pcap.analysis sweeps/caps-4n sweeps/caps-8n
+"""
+
+import argparse
+import csv
+import re
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from . import runs, telemetry
+
+FLOAT = r"([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)"
+RUN_MARK = re.compile(r"^run: (start|end) " + FLOAT, re.M)
+ELAPSED = re.compile(r"^(.*?),? Info:\s+Elapsed time \(via \w+\):\s*" + FLOAT, re.M)
+PHASE = re.compile(r"Info:\s+Time spent (?:in|for) ([^:]+?):\s*" + FLOAT)
+THROUGHPUT = re.compile(r"Info:\s+.*?" + FLOAT + r"\s*([GTP])FLOP/s")
+FLOP_PREFIX = {"G": 1, "T": 1e3, "P": 1e6}
+RESULTS = "results.csv"
+COLUMNS = [
+    "id",
+    "gpu_power_limit",
+    "nodes",
+    "order",
+    "repetition",
+    "job_id",
+    "time_s",
+    "energy_j",
+    "gpu_energy_j",
+    "avg_power_w",
+    "peak_node_power_w",
+    "edp_js",
+    "stepping_time_s",
+    "stepping_energy_j",
+    "gflops",
+    "speedup",
+    "relative_energy",
+    "samples",
+]
+
+
+def log_time(prefix, year):
+    """Return the Unix time of the date prefix of a SeisSol log line (e.g.
+    "Thu Sep 28 10:45:03"), in the year given"""
+    try:
+        parsed = time.strptime(
+            "{} {}".format(" ".join(prefix.split()[:4]), year), "%a %b %d %H:%M:%S %Y"
+        )
+    except ValueError:
+        return None
+    return time.mktime(parsed)
+
+
+def parse_log(text):
+    """Return the timings of the job output of a run"""
+    marks = {name: float(value) for name, value in RUN_MARK.findall(text)}
+    log = dict(start=marks.get("start"), end=marks.get("end"), phases={})
+    elapsed = ELAPSED.findall(text)
+    if elapsed:
+        prefix, value = elapsed[-1]
+        log["stepping_time_s"] = float(value)
+        if log["start"] is not None:
+            log["stepping_end"] = log_time(
+                prefix, time.localtime(log["start"]).tm_year
+            )
+    for name, value in PHASE.findall(text):
+        log["phases"][name.strip()] = float(value)
+    throughput = THROUGHPUT.findall(text)
+    if throughput:
+        value, prefix = throughput[-1]
+        log["gflops"] = float(value) * FLOP_PREFIX[prefix]
+    return log
+
+
+def read_telemetry(run_dir):
+    """Return, for each node of a run, the sample times, the node power and
+    the GPU power of the samples read correctly, as NumPy arrays"""
+    nodes = []
+    for path in sorted((Path(run_dir) / "telemetry").glob("*.tel")):
+        _, columns = telemetry.read(path)
+        names = list(columns)
+        data = {name: np.frombuffer(columns[name], dtype=np.float64) for name in names}
+        gpu = [name for name in names if re.fullmatch(r"gpu\d+_power_w", name)]
+        module = [name for name in names if name.startswith("hwmon_module")]
+        other = [name for name in names if name.startswith("hwmon_")]
+        gpu_power = np.zeros_like(data["time"])
+        for name in gpu:
+            gpu_power += data[name]
+        if module:
+            node_power = np.sum([data[name] for name in module], axis=0)
+        else:
+            node_power = gpu_power + np.sum(
+                [data[name] for name in other] or [np.zeros_like(gpu_power)], axis=0
+            )
+        # Samples with a failed read (NaN) are left out: the power is
+        # interpolated between the samples around them
+        order = np.argsort(data["time"], kind="stable")
+        order = order[np.isfinite(node_power[order] + gpu_power[order])]
+        nodes.append((data["time"][order], node_power[order], gpu_power[order]))
+    return nodes
+
+
+def integrate(times, power, start, end):
+    """Return the energy in J of a power signal between start and end,
+    interpolating the power at both ends"""
+    if end <= start or len(times) < 2:
+        return np.nan
+    inside = (times > start) & (times < end)
+    edge = np.interp([start, end], times, power)
+    power = np.concatenate([edge[:1], power[inside], edge[1:]])
+    times = np.concatenate([[start], times[inside], [end]])
+    return float(np.sum((power[1:] + power[:-1]) * np.diff(times)) / 2)
+
+
+def analyse_run(run_dir, job_id=None):
+    """Return the result of a run, or None if it did not finish"""
+    run_dir = Path(run_dir)
+    outputs = sorted(run_dir.glob("{}.out".format(job_id or "*")))
+    if not outputs:
+        return None
+    log = parse_log(outputs[-1].read_text(errors="replace"))
+    if log["start"] is None or log["end"] is None:
+        return None
+    result = dict(
+        time_s=log["end"] - log["start"],
+        stepping_time_s=log.get("stepping_time_s"),
+        phases=log["phases"],
+        gflops=log.get("gflops"),
+        source="telemetry",
+    )
+    nodes = read_telemetry(run_dir)
+    if not nodes:
+        return dict(result, energy_j=None)
+
+    stepping_end = log.get("stepping_end") or log["end"]
+    windows = [(log["start"], log["end"])]
+    if result["stepping_time_s"]:
+        windows.append((stepping_end - result["stepping_time_s"], stepping_end))
+    energy = np.zeros((len(windows), 2))
+    peak = 0.0
+    samples = 0
+    for times, node_power, gpu_power in nodes:
+        for index, (start, end) in enumerate(windows):
+            energy[index] += [
+                integrate(times, node_power, start, end),
+                integrate(times, gpu_power, start, end),
+            ]
+        inside = (times >= log["start"]) & (times <= log["end"])
+        if inside.any():
+            peak = max(peak, float(node_power[inside].max()))
+        samples += len(times)
+    result.update(
+        energy_j=float(energy[0, 0]),
+        gpu_energy_j=float(energy[0, 1]),
+        avg_power_w=float(energy[0, 0] / result["time_s"]),
+        peak_node_power_w=peak,
+        edp_js=float(energy[0, 0] * result["time_s"]),
+        samples=samples,
+        telemetry_nodes=len(nodes),
+    )
+    if len(windows) > 1:
+        result["stepping_energy_j"] = float(energy[1, 0])
+    return result
+
+
+def find_runs(folder):
+    """Return the runs of a folder (as in a manifest), and the folder of
+    its table"""
+    folder = Path(folder)
+    if (folder / runs.MANIFEST).exists():
+        return runs.read_manifest(folder)["runs"], folder
+    if list(folder.glob("*.out")):
+        dirs = [folder]
+    else:
+        dirs = sorted(path for path in folder.iterdir() if list(path.glob("*.out")))
+    found = []
+    for run_dir in dirs:
+        record = {}
+        if (run_dir / runs.RUN_RECORD).exists():
+            record = runs.read_json(run_dir / runs.RUN_RECORD)
+        found.append(
+            dict(record, id=run_dir.name, dir=str(run_dir.relative_to(folder)))
+        )
+    return found, folder
+
+
+def relative(rows):
+    """Add the speedup and energy relative to the uncapped runs with the
+    same node count and order"""
+    groups = {}
+    for row in rows:
+        if row["gpu_power_limit"] in (None, "") and row["time_s"] is not None:
+            key = (row["nodes"], row["order"])
+            groups.setdefault(key, []).append((row["time_s"], row["energy_j"]))
+    for row in rows:
+        reference = groups.get((row["nodes"], row["order"]))
+        if not reference or row["time_s"] is None:
+            continue
+        reference = np.array(reference, dtype=float)
+        reference_time, reference_energy = np.nanmean(reference, axis=0)
+        row["speedup"] = reference_time / row["time_s"]
+        if row["energy_j"] is not None:
+            row["relative_energy"] = row["energy_j"] / reference_energy
+
+
+def analyse(folder, write_results=True):
+    """Analyse the runs of a folder, and return the rows of its table"""
+    found, table_dir = find_runs(folder)
+    rows = []
+    for run in found:
+        result = analyse_run(table_dir / run["dir"], run.get("job_id"))
+        if result is None:
+            print("{}: not finished".format(run["id"]), file=sys.stderr)
+            continue
+        run_dir = table_dir / run["dir"]
+        existing = runs.read_result(run_dir)
+        # Only results with energy, and never over a result of another source
+        # (e.g. sacct or the fake Slurm)
+        if (
+            write_results
+            and result["energy_j"] is not None
+            and (existing is None or existing.get("source") == "telemetry")
+        ):
+            runs.write_json(run_dir / runs.RUN_RESULT, result)
+        row = {name: run.get(name) for name in COLUMNS}
+        row.update({name: result[name] for name in COLUMNS if name in result})
+        rows.append(row)
+    relative(rows)
+    with open(table_dir / RESULTS, "w", newline="") as file:
+        writer = csv.DictWriter(file, COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(
+                {
+                    name: "{:.6g}".format(value) if isinstance(value, float) else value
+                    for name, value in row.items()
+                }
+            )
+    return rows, table_dir
+
+
+def number(value, digits, scale=1):
+    return "-" if value is None else "{:.{}f}".format(value * scale, digits)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("folders", type=Path, nargs="+", help="sweep or run folders")
+    parser.add_argument(
+        "--no-results",
+        action="store_true",
+        help="do not write result.json in the run directories",
+    )
+    args = parser.parse_args()
+
+    for folder in args.folders:
+        start = time.monotonic()
+        rows, table_dir = analyse(folder, write_results=not args.no_results)
+        print(
+            "{}: {} runs in {:.1f}s".format(
+                table_dir / RESULTS, len(rows), time.monotonic() - start
+            )
+        )
+        print(
+            "{:<28} {:>10} {:>10} {:>12} {:>10} {:>8} {:>8}".format(
+                "run", "limit W", "time s", "energy kJ", "avg W", "speedup", "energy"
+            )
+        )
+        for row in rows:
+            print(
+                "{:<28} {:>10} {:>10.1f} {:>12} {:>10} {:>8} {:>8}".format(
+                    row["id"],
+                    row["gpu_power_limit"] or "none",
+                    row["time_s"],
+                    number(row["energy_j"], 1, 1e-3),
+                    number(row["avg_power_w"], 0),
+                    number(row["speedup"], 3),
+                    number(row["relative_energy"], 3),
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
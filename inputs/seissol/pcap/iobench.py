@@ -0,0 +1,388 @@
+"""Benchmark the output settings of SeisSol (XDMF writer alignment and block
+size, asynchronous output mode and buffer alignment) on the filesystem of a
+cluster, and write the best ones into submit.slurm and the cluster config.
+
+The benchmark runs a short SeisSol simulation (--end-time) with wave field
+and surface output (XDMF, --backend), for each combination of
+XDMFWRITER_ALIGNMENT (--alignment), XDMFWRITER_BLOCK_SIZE (--block-size),
+ASYNC_BUFFER_ALIGNMENT (--buffer-alignment) and ASYNC_MODE (--modes), and
+the same simulation without output as reference, at one GPU power limit
+(--cap), in run directories of a sweep folder (see pcap/sweep.py). The time
+lost to output is the wall time of the time stepping (see pcap/analysis.py)
+beyond the one of the reference, averaged over --repetitions, and the write
+bandwidth is the size of the output over the time lost ("hidden" when the
+output does not slow down the simulation). The settings losing the least
+time are written into a block of submit.slurm (replaced when benchmarking
+again), and into the "io" section of the config file of the cluster
+(--config), so that they are kept with its profile. Settings of run.env
+still take precedence. Running the benchmark again on the same folder
+reuses the finished runs.
+
+Benchmark on each cluster, in its workspace, on the filesystem of the runs,
+e.g. on Thea:
+    python3 -m pcap.iobench iobench/thea --config ../configs/thea.json \\
+        --alignment 1M,8M,16M --block-size 1M,8M --modes THREAD,SYNC \\
+        --nodes 4 --end-time 2
+"""
+
+import argparse
+import itertools
+import json
+import statistics
+import sys
+from pathlib import Path
+
+from . import analysis, runs, slurm, sweep
+
+BEGIN = "# BEGIN pcap.iobench"
+END = "# END pcap.iobench"
+BLOCK_BEFORE = "# Recommended I/O setup"
+OUTPUT = "output/iobench"
+REFERENCE = "noout-"
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+# ASYNC_MODE=MPI is left out: it needs dedicated I/O ranks (ASYNC_GROUP_SIZE),
+# with their own cores, so that its runs are not comparable with these
+MODES = ["THREAD", "SYNC"]
+
+
+def size_list(value):
+    """Sizes in bytes, with an optional K, M or G suffix (powers of 1024)"""
+    sizes = []
+    for item in value.upper().split(","):
+        unit = item[-1] if item[-1] in UNITS else ""
+        sizes.append(int(item[: len(item) - len(unit)]) * UNITS[unit])
+    return sizes
+
+
+def size_text(size):
+    for unit in ["G", "M", "K"]:
+        if size % UNITS[unit] == 0:
+            return "{}{}".format(size // UNITS[unit], unit)
+    return str(size)
+
+
+def combinations(args):
+    """Return the settings (run.env values) of the benchmark runs"""
+    return [
+        dict(
+            XDMFWRITER_ALIGNMENT=alignment,
+            XDMFWRITER_BLOCK_SIZE=block_size,
+            ASYNC_BUFFER_ALIGNMENT=buffer_alignment,
+            ASYNC_MODE=mode,
+        )
+        for alignment, block_size, buffer_alignment, mode in itertools.product(
+            args.alignment, args.block_size, args.buffer_alignment, args.modes
+        )
+    ]
+
+
+def prefix(settings):
+    return "a{}-b{}-ba{}-{}-".format(
+        size_text(settings["XDMFWRITER_ALIGNMENT"]),
+        size_text(settings["XDMFWRITER_BLOCK_SIZE"]),
+        size_text(settings["ASYNC_BUFFER_ALIGNMENT"]),
+        settings["ASYNC_MODE"].lower(),
+    )
+
+
+def output_parameters(args):
+    """Return the &Output values of the parameter file of the runs with
+    output"""
+    return dict(
+        OutputFile=OUTPUT,
+        Format=10,
+        xdmfWriterBackend=args.backend,
+        WavefieldOutput=1,
+        TimeInterval=args.wavefield_interval or args.end_time / 4,
+        SurfaceOutput=1,
+        SurfaceOutputInterval=args.surface_interval or args.end_time / 20,
+    )
+
+
+def output_size(run_dir):
+    """Return the size in bytes of the output files of a run"""
+    run_dir = Path(run_dir)
+    folder = (run_dir / OUTPUT).parent
+    return sum(
+        path.stat().st_size
+        for path in folder.rglob("*")
+        if path.is_file()
+        and str(path.relative_to(run_dir)).startswith(OUTPUT)
+    )
+
+
+def io_block(best, cluster):
+    """Return the lines of submit.slurm with the best output settings"""
+    return (
+        [
+            BEGIN,
+            "# Output settings losing the least time, measured by pcap/iobench.py "
+            "({})".format(", ".join(filter(None, [cluster, runs.timestamp()]))),
+        ]
+        + [
+            "{name}=${{{name}:-{value}}}".format(name=name, value=value)
+            for name, value in best.items()
+        ]
+        + [END]
+    )
+
+
+def write_submit(path, block):
+    """Write the output settings block into a submit.slurm"""
+    lines = path.read_text().splitlines()
+    if BEGIN in lines:
+        del lines[lines.index(BEGIN) : lines.index(END) + 2]
+    index = next(
+        (index for index, line in enumerate(lines) if line.startswith(BLOCK_BEFORE)),
+        None,
+    )
+    if index is None:
+        sys.exit("{}: no line starting with {!r}".format(path, BLOCK_BEFORE))
+    lines[index:index] = block + [""]
+    path.write_text("\n".join(lines) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("sweep", type=Path, help="sweep folder of the benchmark runs")
+    parser.add_argument(
+        "--config",
+        type=Path,
+        help="config file of the cluster, to store the best settings in",
+    )
+    parser.add_argument(
+        "--alignment",
+        type=size_list,
+        default=[1 << 20, 8 << 20],
+        help="XDMFWRITER_ALIGNMENT values (default 1M,8M)",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=size_list,
+        default=[1 << 20, 8 << 20],
+        help="XDMFWRITER_BLOCK_SIZE values (default 1M,8M)",
+    )
+    parser.add_argument(
+        "--buffer-alignment",
+        type=size_list,
+        default=[8 << 20],
+        help="ASYNC_BUFFER_ALIGNMENT values (default 8M)",
+    )
+    parser.add_argument(
+        "--modes",
+        type=lambda value: value.upper().split(","),
+        default=MODES,
+        help="ASYNC_MODE values (default {})".format(",".join(MODES)),
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["hdf5", "posix"],
+        default="hdf5",
+        help="XDMF writer backend (default hdf5)",
+    )
+    parser.add_argument(
+        "--cap", type=int, help="GPU power limit in W (default uncapped)"
+    )
+    parser.add_argument("--nodes", type=int, default=4, help="node count (default 4)")
+    parser.add_argument(
+        "--order", type=int, default=6, help="convergence order (default 6)"
+    )
+    parser.add_argument(
+        "--repetitions", type=int, default=2, help="runs per setting (default 2)"
+    )
+    parser.add_argument(
+        "--end-time", type=float, default=2.0, help="simulated time in s (default 2)"
+    )
+    parser.add_argument(
+        "--wavefield-interval",
+        type=float,
+        help="simulated time between wave field outputs (default end time / 4)",
+    )
+    parser.add_argument(
+        "--surface-interval",
+        type=float,
+        help="simulated time between surface outputs (default end time / 20)",
+    )
+    parser.add_argument(
+        "--binary",
+        help="SeisSol binary, {order} is replaced (default the one of the image "
+        "built for --config, or the default of submit.slurm without --config)",
+    )
+    parser.add_argument(
+        "--input-dir", type=Path, default=runs.INPUT_DIR, help="input folder"
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="submit script to write the settings to (default submit.slurm of the "
+        "input folder)",
+    )
+    parser.add_argument(
+        "--no-write", action="store_true", help="only print the results"
+    )
+    parser.add_argument(
+        "--max-queued", type=int, default=4, help="maximum jobs in the queue"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=10, help="seconds between submissions"
+    )
+    parser.add_argument(
+        "--poll", type=float, default=60, help="seconds between queue checks"
+    )
+    parser.add_argument(
+        "--fake-slurm", action="store_true", help="run the jobs locally"
+    )
+    args = parser.parse_args()
+    args.binary = args.binary or runs.binary(args.config)
+
+    if not set(args.modes) <= set(MODES):
+        sys.exit(
+            "ASYNC_MODE must be one of {} (MPI needs dedicated I/O ranks, which "
+            "the benchmark runs do not have)".format(", ".join(MODES))
+        )
+    env = None
+    if args.fake_slurm:
+        env = slurm.fake_slurm(args.sweep / ".fake-slurm")
+    if (args.sweep / runs.MANIFEST).exists():
+        manifest = runs.read_manifest(args.sweep)
+    else:
+        args.sweep.mkdir(parents=True, exist_ok=True)
+        manifest = dict(sweep=args.sweep.name, created=runs.timestamp(), runs=[])
+    manifest["iobench"] = dict(
+        config=str(args.config or ""),
+        alignment=args.alignment,
+        block_size=args.block_size,
+        buffer_alignment=args.buffer_alignment,
+        modes=args.modes,
+        backend=args.backend,
+        cap=args.cap,
+        nodes=args.nodes,
+        order=args.order,
+        repetitions=args.repetitions,
+        end_time=args.end_time,
+        parameters=output_parameters(args),
+    )
+
+    # Reference and benchmark runs, repetition by repetition
+    existing = {run["id"]: run for run in manifest["runs"]}
+    points = []
+    for repetition in range(1, args.repetitions + 1):
+        for settings in [None] + combinations(args):
+            if settings is None:
+                run_prefix = REFERENCE
+                parameters = dict(WavefieldOutput=0, SurfaceOutput=0)
+            else:
+                run_prefix = prefix(settings)
+                parameters = output_parameters(args)
+            run_id = run_prefix + sweep.run_id(
+                args.cap, args.nodes, args.order, repetition
+            )
+            run = existing.get(run_id)
+            if run is None:
+                run = sweep.add_run(
+                    args.sweep,
+                    manifest,
+                    args.cap,
+                    args.nodes,
+                    args.order,
+                    repetition,
+                    end_time=args.end_time,
+                    binary=args.binary,
+                    input_dir=args.input_dir,
+                    settings=settings,
+                    prefix=run_prefix,
+                    parameters=parameters,
+                )
+                # SeisSol does not create the folder of its output
+                (args.sweep / run["dir"] / OUTPUT).parent.mkdir(exist_ok=True)
+            points.append((settings, run))
+    runs.write_manifest(args.sweep, manifest)
+    slurm.submit_runs(
+        args.sweep,
+        manifest,
+        [run for _, run in points if not run["job_id"]],
+        env=env,
+        max_queued=args.max_queued,
+        interval=args.interval,
+        poll=args.poll,
+    )
+    slurm.wait([run["job_id"] for _, run in points], env=env, poll=args.poll)
+
+    # Time and energy of the time stepping, and output size, of each setting
+    measures = {}
+    for settings, run in points:
+        result = analysis.analyse_run(args.sweep / run["dir"], run["job_id"])
+        if result is None:
+            sys.exit("{}: the run did not finish".format(run["id"]))
+        key = tuple(settings.items()) if settings else None
+        measures.setdefault(key, []).append(
+            (
+                result["stepping_time_s"] or result["time_s"],
+                result.get("stepping_energy_j"),
+                output_size(args.sweep / run["dir"]),
+            )
+        )
+    reference = measures.pop(None)
+    reference_time = statistics.mean(time for time, _, _ in reference)
+    reference_energy = None
+    if all(energy is not None for _, energy, _ in reference):
+        reference_energy = statistics.mean(energy for _, energy, _ in reference)
+    print(
+        "reference without output: {:.2f} s of time stepping".format(reference_time)
+    )
+    print(
+        "{:>6} {:>6} {:>6} {:>7} {:>10} {:>8} {:>10} {:>10}".format(
+            "align", "block", "buffer", "mode", "output MB", "lost s", "MB/s", "lost kJ"
+        )
+    )
+    results = []
+    for settings, values in measures.items():
+        settings = dict(settings)
+        lost = statistics.mean(time for time, _, _ in values) - reference_time
+        size = statistics.mean(size for _, _, size in values)
+        energy = None
+        if reference_energy is not None and all(
+            value[1] is not None for value in values
+        ):
+            energy = statistics.mean(value[1] for value in values) - reference_energy
+        results.append(
+            dict(settings, output_bytes=size, lost_s=lost, lost_energy_j=energy)
+        )
+        print(
+            "{:>6} {:>6} {:>6} {:>7} {:>10.1f} {:>8.2f} {:>10} {:>10}".format(
+                size_text(settings["XDMFWRITER_ALIGNMENT"]),
+                size_text(settings["XDMFWRITER_BLOCK_SIZE"]),
+                size_text(settings["ASYNC_BUFFER_ALIGNMENT"]),
+                settings["ASYNC_MODE"],
+                size / 1e6,
+                lost,
+                analysis.number(size / lost, 0, 1e-6) if lost > 0 else "hidden",
+                analysis.number(energy, 2, 1e-3),
+            )
+        )
+    best = min(results, key=lambda result: result["lost_s"])
+    best = {name: best[name] for name in combinations(args)[0]}
+    manifest["iobench"].update(
+        reference_s=reference_time, results=results, best=best
+    )
+    runs.write_manifest(args.sweep, manifest)
+    print(
+        "least time lost: {}".format(
+            " ".join("{}={}".format(*item) for item in best.items())
+        )
+    )
+    if args.no_write:
+        return
+    cluster = args.config.stem if args.config else ""
+    output = args.output or args.input_dir / "submit.slurm"
+    write_submit(output, io_block(best, cluster))
+    print("{}: output settings written".format(output))
+    if args.config:
+        config = runs.read_json(args.config)
+        config["io"] = best
+        args.config.write_text(json.dumps(config, indent=4))
+        print("{}: output settings stored".format(args.config))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""Run directories and manifests.
+
+A run directory holds everything a SeisSol run needs, like the folders
+created by setup-sim.sh (links to the image, the input files and the mesh,
+the parameter file and submit.slurm), and:
+
+- run.env: settings of the run sourced by submit.slurm (e.g. the GPU power
+  limit and the SeisSol binary),
+- run.json: the record of the run (its parameters, the values changed in
+  its parameter file and its job),
+- result.json: the result of the run, with at least its time-to-solution
+  (time_s) and energy-to-solution (energy_j), and the source of the values.
+
+A sweep folder holds the run directories of a sweep, and its manifest.json
+listing them, in submission order.
+"""
+
+import json
+import os
+import re
+import shlex
+import time
+from pathlib import Path
+
+# Input folder of the workspace (image, Turkey inputs and submit.slurm)
+INPUT_DIR = Path(__file__).resolve().parents[1] / "input"
+
+RUN_ENV = "run.env"
+RUN_RECORD = "run.json"
+RUN_RESULT = "result.json"
+MANIFEST = "manifest.json"
+
+# Run profiles: values of the &Output namelist of the parameter file, with
+# "interval" standing for the output interval of the profile
+PROFILES = {
+    # Outputs of the Turkey case
+    "full": {},
+    # Outputs every interval of simulated time, without checkpoints
+    "sparse": dict(
+        TimeInterval="interval",
+        SurfaceOutputInterval="interval",
+        ReceiverOutputInterval="interval",
+        Checkpoint=0,
+    ),
+    # Compute and communication only, without output besides the log
+    "compute": dict(WavefieldOutput=0, SurfaceOutput=0, ReceiverOutput=0, Checkpoint=0),
+}
+
+# SeisSol binary run without a cluster config: the default of submit.slurm
+# (Thea), with {order} standing for the convergence order
+BINARY = "SeisSol_Release_ssm_90_cuda_{order}_elastic"
+
+# SeisSol host architecture of each microarchitecture, as in the SeisSol
+# recipe (containers/seissol/recipe.py)
+HOST_ARCHS = {
+    "skylake": "skx",
+    "skylake_avx512": "skx",
+    "icelake": "skx",
+    "haswell": "hsw",
+    "x86_64_v3": "hsw",
+    "zen2": "rome",
+    "zen3": "milan",
+    "neoverse_v2": "neon",
+}
+# Convergence order in the name of a SeisSol binary
+BINARY_ORDER = re.compile(r"_(\d+)_[a-z]+\d*$")
+
+
+def read_json(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def binary(config_file=None):
+    """Return the name of the default SeisSol binary of the image built for
+    the config file of a cluster (the first precision, equations and backend
+    of its build matrix), with {order} standing for the convergence order,
+    or BINARY without config file"""
+    if config_file is None:
+        return BINARY
+    config = read_json(config_file)
+    matrix = dict(precisions=["single"], equations=["elastic"], backends=["cuda"])
+    matrix.update(config.get("seissol", {}))
+    precision = matrix["precisions"][0][0]
+    equations, backend = matrix["equations"][0], matrix["backends"][0]
+    if backend == "none":
+        if config["march"] not in HOST_ARCHS:
+            raise ValueError(
+                "Invalid or unsupported microarchitecture: {}".format(config["march"])
+            )
+        return "SeisSol_Release_{}{}_{{order}}_{}".format(
+            precision, HOST_ARCHS[config["march"]], equations
+        )
+    return "SeisSol_Release_{}sm_{}_{}_{{order}}_{}".format(
+        precision, config["cuda_arch"], backend, equations
+    )
+
+
+def binary_order(binary):
+    """Return the convergence order of a SeisSol binary, or None"""
+    match = BINARY_ORDER.search(binary)
+    return int(match.group(1)) if match else None
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def cap_list(value):
+    """Power limits in W, "none" for uncapped runs"""
+    return [None if item == "none" else int(item) for item in value.split(",")]
+
+
+def write_json(path, data):
+    """Write a JSON file atomically, so that readers never see half of it"""
+    path = Path(path)
+    partial = path.with_name(".{}.partial".format(path.name))
+    with open(partial, "w") as file:
+        json.dump(data, file, indent=2)
+        file.write("\n")
+    os.replace(partial, path)
+
+
+def timestamp():
+    return time.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def set_end_time(parameters, end_time):
+    """Return a parameter file with the given EndTime"""
+    parameters, count = re.subn(
+        r"(\bEndTime\s*=\s*)[-+0-9.eE]+",
+        r"\g<1>{}".format(end_time),
+        parameters,
+    )
+    if count != 1:
+        raise ValueError("No EndTime in the parameter file")
+    return parameters
+
+
+def profile_parameters(profile, end_time, interval=None):
+    """Return the &Output values of a run profile, the sparse outputs being
+    written every interval of simulated time (default a quarter of
+    end_time)"""
+    interval = interval or end_time / 4
+    return {
+        name: interval if value == "interval" else value
+        for name, value in PROFILES[profile].items()
+    }
+
+
+def get_parameter(parameters, name):
+    """Return the value of a parameter file (as written, without quotes), or
+    None if it is not set"""
+    match = re.search(
+        r"^\s*{}\s*=\s*([^!\n]*?)\s*(?:!.*)?$".format(name),
+        parameters,
+        flags=re.M | re.I,
+    )
+    return match.group(1).strip("'\"") if match else None
+
+
+def set_parameters(parameters, values, namelist="Output"):
+    """Return a parameter file with the given values (dict), added to the
+    namelist if they are not set yet"""
+    for name, value in values.items():
+        if isinstance(value, str):
+            value = "'{}'".format(value)
+        parameters, count = re.subn(
+            r"(^\s*{}\s*=\s*)[^!\n]*?(\s*(?:!.*)?)$".format(name),
+            r"\g<1>{}\g<2>".format(value),
+            parameters,
+            flags=re.M | re.I,
+        )
+        if count == 0:
+            parameters, count = re.subn(
+                r"(^&{}\b.*?\n)(\s*/)".format(namelist),
+                r"\g<1>{} = {}\n\g<2>".format(name, value),
+                parameters,
+                count=1,
+                flags=re.M | re.I | re.S,
+            )
+        if count == 0:
+            raise ValueError("No &{} namelist in the parameter file".format(namelist))
+    return parameters
+
+
+def create_run(
+    run_dir,
+    record,
+    env,
+    end_time,
+    input_dir=INPUT_DIR,
+    parameters=None,
+    time_limit=None,
+):
+    """Create a run directory, for record["nodes"] nodes, with the settings
+    of run.env (dict), the simulation length end_time, other values of the
+    &Output namelist of the parameter file (dict) and the time limit of the
+    job (Slurm time), if any, and return the values changed in the
+    parameter file (name: [old, new])"""
+    run_dir = Path(run_dir)
+    input_dir = Path(input_dir).resolve()
+    turkey_dir = input_dir / "Turkey"
+    run_dir.mkdir(parents=True)
+
+    # Container image and application overlay, input files and mesh
+    for image in ["seissol.sif", "seissol-overlay.sqsh"]:
+        if (input_dir / image).exists():
+            (run_dir / image).symlink_to(input_dir / image)
+    for file in sorted(turkey_dir.rglob("*.yaml")):
+        (run_dir / file.name).symlink_to(file)
+    (run_dir / "mesh").mkdir()
+    for file in sorted((turkey_dir / "mesh").iterdir()):
+        if file.is_file():
+            (run_dir / "mesh" / file.name).symlink_to(file)
+
+    # Parameter file and slurm script
+    original = (turkey_dir / "parameters.par").read_text()
+    text = set_end_time(original, end_time)
+    if parameters:
+        text = set_parameters(text, parameters)
+    (run_dir / "parameters.par").write_text(text)
+    changes = {}
+    for name in ["EndTime"] + list(parameters or {}):
+        old, new = get_parameter(original, name), get_parameter(text, name)
+        if old != new:
+            changes[name] = [old, new]
+    submit = re.sub(
+        r"^#SBATCH --nodes=\d+",
+        "#SBATCH --nodes={}".format(record["nodes"]),
+        (input_dir / "submit.slurm").read_text(),
+        flags=re.M,
+    )
+    if time_limit:
+        submit = re.sub(
+            r"^#SBATCH --time=\S+",
+            "#SBATCH --time={}".format(time_limit),
+            submit,
+            flags=re.M,
+        )
+    (run_dir / "submit.slurm").write_text(submit)
+
+    env = dict(env, INPUT_DIR=str(input_dir))
+    (run_dir / RUN_ENV).write_text(
+        "".join(
+            "export {}={}\n".format(name, shlex.quote(str(value)))
+            for name, value in env.items()
+            if value is not None
+        )
+    )
+    write_json(
+        run_dir / RUN_RECORD,
+        dict(
+            record, end_time=end_time, env=env, parameters=changes, created=timestamp()
+        ),
+    )
+    return changes
+
+
+def read_manifest(sweep_dir):
+    return read_json(Path(sweep_dir) / MANIFEST)
+
+
+def write_manifest(sweep_dir, manifest):
+    write_json(Path(sweep_dir) / MANIFEST, manifest)
+
+
+def update_run(sweep_dir, manifest, run, **fields):
+    """Update a run in the manifest and in its record"""
+    run.update(fields)
+    write_manifest(sweep_dir, manifest)
+    record_path = Path(sweep_dir) / run["dir"] / RUN_RECORD
+    write_json(record_path, dict(read_json(record_path), **fields))
+
+
+def read_result(run_dir):
+    """Return the result of a run, if any"""
+    path = Path(run_dir) / RUN_RESULT
+    if not path.exists():
+        return None
+    return read_json(path)
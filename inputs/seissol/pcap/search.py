@@ -0,0 +1,322 @@
+"""Search the energy-optimal GPU power limit of a SeisSol run, instead of
+sweeping a dense grid.
+
+The search brackets the optimum of the objective, the energy-to-solution
+(energy) or the energy-delay product (edp, energy x time-to-solution),
+assumed to be unimodal in the power limit. The first round runs the limits
+at both ends of the range and --parallel limits evenly spaced inside it;
+each following round narrows the bracket to the neighbours of the best
+limit so far, and runs --parallel new limits inside it. With --parallel 2,
+each round narrows the bracket to 2/3 of its width, with 3 to 1/2. The
+search stops when the bracket is narrower than --tolerance.
+
+Each limit is run --repetitions times (objective averaged), in run
+directories of a sweep folder (see pcap/sweep.py), and the result of each
+run is read from its result.json (see pcap/runs.py), computed from its job
+output and telemetry (see pcap/analysis.py), or read from the Slurm
+accounting of its job if the site records energy. The search is
+deterministic given the results, so that running it again on the same
+folder (e.g. after an interruption) resumes it, reusing the finished runs.
+
+Example:
+    python3 -m pcap.search sweeps/search-4n --min-cap 200 --max-cap 700 \\
+        --nodes 4 --order 6 --objective edp --tolerance 25 --reference
+"""
+
+import argparse
+import statistics
+import sys
+from pathlib import Path
+
+from . import analysis, runs, slurm, sweep
+
+OBJECTIVES = {
+    "energy": lambda result: result["energy_j"],
+    "edp": lambda result: result["energy_j"] * result["time_s"],
+}
+
+
+def inner_caps(low, high, count, step):
+    """Return count limits evenly spaced inside (low, high), rounded to
+    multiples of step"""
+    caps = []
+    for index in range(1, count + 1):
+        cap = step * round((low + (high - low) * index / (count + 1)) / step)
+        if low < cap < high and cap not in caps:
+            caps.append(cap)
+    return caps
+
+
+def narrow(low, high, values):
+    """Return the bracket around the best limit of [low, high], and the
+    best limit"""
+    caps = sorted(cap for cap in values if low <= cap <= high)
+    best = min(caps, key=values.get)
+    index = caps.index(best)
+    return caps[max(index - 1, 0)], caps[min(index + 1, len(caps) - 1)], best
+
+
+class Search:
+    """Runs of a search, reused across rounds and invocations"""
+
+    def __init__(self, folder, settings, env, args):
+        self.folder = folder
+        self.settings = settings
+        self.env = env
+        self.args = args
+        if (folder / runs.MANIFEST).exists():
+            self.manifest = runs.read_manifest(folder)
+            self.settings = self.manifest["search"]
+            print("{}: resuming search".format(folder))
+        else:
+            folder.mkdir(parents=True, exist_ok=True)
+            self.manifest = dict(
+                sweep=folder.name, created=runs.timestamp(), search=settings, runs=[]
+            )
+            runs.write_manifest(folder, self.manifest)
+        self.results = {}
+
+    def run(self, cap, repetition):
+        """Return the run of a limit (None for uncapped), creating it if
+        needed"""
+        run_id = sweep.run_id(
+            cap, self.settings["nodes"], self.settings["order"], repetition
+        )
+        for run in self.manifest["runs"]:
+            if run["id"] == run_id:
+                return run
+        return sweep.add_run(
+            self.folder,
+            self.manifest,
+            cap,
+            self.settings["nodes"],
+            self.settings["order"],
+            repetition,
+            end_time=self.settings["end_time"],
+            binary=self.settings["binary"],
+            input_dir=self.args.input_dir,
+            parameters=runs.profile_parameters(
+                self.settings.get("profile", "full"), self.settings["end_time"]
+            ),
+        )
+
+    def result(self, run):
+        run_dir = self.folder / run["dir"]
+        result = runs.read_result(run_dir)
+        if result is None:
+            result = analysis.analyse_run(run_dir, run["job_id"])
+            if result is not None and result["energy_j"] is not None:
+                runs.write_json(run_dir / runs.RUN_RESULT, result)
+            else:
+                result = None
+        if result is None:
+            result = slurm.accounting(run["job_id"], env=self.env)
+        if result is None:
+            sys.exit(
+                "{}: no result in {}, telemetry nor Slurm accounting of job {}".format(
+                    run["id"], runs.RUN_RESULT, run["job_id"]
+                )
+            )
+        return result
+
+    def evaluate(self, caps):
+        """Run the given limits, if not done yet, and keep the mean result
+        of each of them"""
+        todo = [cap for cap in caps if cap not in self.results]
+        if not todo:
+            return
+        caps_runs = {
+            cap: [
+                self.run(cap, repetition)
+                for repetition in range(1, self.settings["repetitions"] + 1)
+            ]
+            for cap in todo
+        }
+        runs.write_manifest(self.folder, self.manifest)
+        pending = [
+            run for cap in todo for run in caps_runs[cap] if not run["job_id"]
+        ]
+        slurm.submit_runs(
+            self.folder,
+            self.manifest,
+            pending,
+            env=self.env,
+            max_queued=self.args.max_queued,
+            interval=self.args.interval,
+            poll=self.args.poll,
+        )
+        slurm.wait(
+            [run["job_id"] for cap in todo for run in caps_runs[cap]],
+            env=self.env,
+            poll=self.args.poll,
+        )
+        for cap in todo:
+            results = [self.result(run) for run in caps_runs[cap]]
+            self.results[cap] = {
+                key: statistics.mean(result[key] for result in results)
+                for key in ["time_s", "energy_j"]
+            }
+
+
+def print_results(results, objective, reference):
+    print(
+        "{:>10} {:>12} {:>14} {:>14} {:>10} {:>10}".format(
+            "limit W", "time s", "energy J", objective, "time %", "energy %"
+        )
+    )
+    for cap in sorted(results, key=lambda cap: (cap is None, cap)):
+        result = results[cap]
+        relative = ["-", "-"]
+        if reference:
+            relative = [
+                "{:+.1f}".format(100 * (result[key] / reference[key] - 1))
+                for key in ["time_s", "energy_j"]
+            ]
+        print(
+            "{:>10} {:>12.1f} {:>14.0f} {:>14.4g} {:>10} {:>10}".format(
+                "none" if cap is None else cap,
+                result["time_s"],
+                result["energy_j"],
+                OBJECTIVES[objective](result),
+                *relative
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("sweep", type=Path, help="sweep folder of the search")
+    parser.add_argument(
+        "--min-cap", type=int, required=True, help="lowest GPU power limit in W"
+    )
+    parser.add_argument(
+        "--max-cap", type=int, required=True, help="highest GPU power limit in W"
+    )
+    parser.add_argument(
+        "--objective",
+        choices=sorted(OBJECTIVES),
+        default="energy",
+        help="minimized objective (default energy)",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=int,
+        default=25,
+        help="width of the final bracket in W (default 25)",
+    )
+    parser.add_argument(
+        "--step", type=int, default=5, help="resolution of the limits in W (default 5)"
+    )
+    parser.add_argument(
+        "--parallel", type=int, default=2, help="new limits per round (default 2)"
+    )
+    parser.add_argument(
+        "--reference", action="store_true", help="also run uncapped, for comparison"
+    )
+    parser.add_argument("--nodes", type=int, default=4, help="node count (default 4)")
+    parser.add_argument(
+        "--order", type=int, default=6, help="convergence order (default 6)"
+    )
+    parser.add_argument(
+        "--repetitions", type=int, default=1, help="runs per limit (default 1)"
+    )
+    parser.add_argument(
+        "--end-time", type=float, default=40.0, help="simulated time in s (default 40)"
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(runs.PROFILES),
+        default="full",
+        help="outputs of the runs (default full, see pcap/sweep.py)",
+    )
+    parser.add_argument(
+        "--config",
+        type=Path,
+        help="config file of the cluster, for the default --binary",
+    )
+    parser.add_argument(
+        "--binary",
+        help="SeisSol binary, {order} is replaced (default the one of the image "
+        "built for --config, or the default of submit.slurm without --config)",
+    )
+    parser.add_argument(
+        "--input-dir", type=Path, default=runs.INPUT_DIR, help="input folder"
+    )
+    parser.add_argument(
+        "--max-queued", type=int, default=4, help="maximum jobs in the queue"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=10, help="seconds between submissions"
+    )
+    parser.add_argument(
+        "--poll", type=float, default=60, help="seconds between queue checks"
+    )
+    parser.add_argument(
+        "--fake-slurm", action="store_true", help="run the jobs locally"
+    )
+    args = parser.parse_args()
+    args.binary = args.binary or runs.binary(args.config)
+
+    if not 0 < args.min_cap < args.max_cap:
+        sys.exit("Invalid range of power limits")
+    settings = dict(
+        min_cap=args.min_cap,
+        max_cap=args.max_cap,
+        objective=args.objective,
+        tolerance=args.tolerance,
+        step=args.step,
+        parallel=args.parallel,
+        reference=args.reference,
+        nodes=args.nodes,
+        order=args.order,
+        repetitions=args.repetitions,
+        end_time=args.end_time,
+        profile=args.profile,
+        binary=args.binary,
+    )
+    env = None
+    if args.fake_slurm:
+        env = slurm.fake_slurm(args.sweep / ".fake-slurm")
+    search = Search(args.sweep, settings, env, args)
+    settings = search.settings
+    objective = OBJECTIVES[settings["objective"]]
+
+    low, high = settings["min_cap"], settings["max_cap"]
+    caps = [low, high] + inner_caps(low, high, settings["parallel"], settings["step"])
+    if settings["reference"]:
+        caps.append(None)
+    round_index = 1
+    while True:
+        search.evaluate(caps)
+        values = {
+            cap: objective(result)
+            for cap, result in search.results.items()
+            if cap is not None
+        }
+        low, high, best = narrow(low, high, values)
+        print(
+            "round {}: best {} W, bracket [{}, {}] W".format(
+                round_index, best, low, high
+            ),
+            flush=True,
+        )
+        caps = inner_caps(low, high, settings["parallel"], settings["step"])
+        caps = [cap for cap in caps if cap not in search.results]
+        if high - low <= settings["tolerance"] or not caps:
+            break
+        round_index += 1
+
+    search.manifest["search"] = dict(
+        settings, best=best, bracket=[low, high], rounds=round_index
+    )
+    runs.write_manifest(args.sweep, search.manifest)
+    print_results(search.results, settings["objective"], search.results.get(None))
+    print(
+        "{}-optimal GPU power limit: {} W (within [{}, {}] W), {} runs".format(
+            settings["objective"], best, low, high, len(search.manifest["runs"])
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""Submission of run directories to Slurm, and a fake Slurm running the jobs
+on the local machine to test the workflow.
+
+The fake Slurm puts stubs of sbatch, squeue, srun, sbcast, nvidia-smi and
+apptainer first in the PATH: sbatch runs the job script in the background
+(with SLURM_JOB_ID, SLURM_SUBMIT_DIR and SLURM_JOB_NUM_NODES set), srun runs
+its command once, nvidia-smi keeps the power limit in a file per job (as if
+each job had its own nodes), and apptainer prints its command (to stderr)
+and sleeps FAKE_RUN_SECONDS (default 2). Fake SeisSol runs print the end
+of a SeisSol log, and write a result.json with the time and energy of a
+simple model of a GPU under a power limit (lowest energy around 400 W), so
+that searches over the power limit can be tested too. With wave field
+output enabled, they write FAKE_OUTPUT_BYTES (default 4 MiB) to the output
+prefix of the parameter file, and take one second more with ASYNC_MODE=SYNC.
+"""
+
+import getpass
+import os
+import subprocess
+import time
+from pathlib import Path
+
+from . import runs
+
+FAKE_SLURM_STUBS = {
+    "sbatch": [
+        "#!/bin/bash",
+        "# Fake sbatch: run the job script in the background",
+        "state={state}",
+        "script=${{@: -1}}",
+        "id=$(( $(cat $state/last_id 2>/dev/null || echo 1000) + 1 ))",
+        "echo $id > $state/last_id",
+        "nodes=$(sed -n 's/^#SBATCH --nodes=//p' $script | head -n 1)",
+        "SLURM_JOB_ID=$id SLURM_SUBMIT_DIR=$PWD SLURM_JOB_NUM_NODES=${{nodes:-1}} \\",
+        "    nohup bash $script > $PWD/$id.out 2>&1 &",
+        "echo $! > $state/$id.pid",
+        'if [[ " $* " == *" --parsable "* ]]',
+        "then",
+        "    echo $id",
+        "else",
+        '    echo "Submitted batch job $id"',
+        "fi",
+    ],
+    "squeue": [
+        "#!/bin/bash",
+        "# Fake squeue: print the ids of the running jobs",
+        "for pid_file in {state}/*.pid",
+        "do",
+        "    [[ -e $pid_file ]] || continue",
+        "    if kill -0 $(cat $pid_file) 2> /dev/null",
+        "    then",
+        "        basename $pid_file .pid",
+        "    else",
+        "        rm -f $pid_file",
+        "    fi",
+        "done",
+    ],
+    "srun": [
+        "#!/bin/bash",
+        "# Fake srun: run the command once",
+        "while [[ $1 == -* ]]; do shift; done",
+        'exec "$@"',
+    ],
+    "sbcast": [
+        "#!/bin/bash",
+        "# Fake sbcast: copy the file",
+        "while [[ $1 == -* ]]; do shift; done",
+        "mkdir -p $(dirname $2) && cp $1 $2",
+    ],
+    "nvidia-smi": [
+        "#!/bin/bash",
+        "# Fake nvidia-smi: keep the power limit in a file, one per job",
+        "limit_file={state}/power_limit.${{SLURM_JOB_ID:-0}}",
+        "default=${{FAKE_GPU_DEFAULT_LIMIT:-700}}",
+        'case "$1" in',
+        "    -pl) echo $2 > $limit_file;;",
+        "    --query-gpu=power.default_limit) echo $default;;",
+        "    --query-gpu=power.limit) cat $limit_file 2> /dev/null || echo $default;;",
+        "esac",
+    ],
+    "apptainer": [
+        "#!/bin/bash",
+        "# Fake apptainer: print the command and wait",
+        'echo "fake apptainer: $*" >&2',
+        "sleep ${{FAKE_RUN_SECONDS:-2}}",
+        'if [[ " $* " == *" SeisSol_"* ]]',
+        "then",
+        "    elapsed=${{FAKE_RUN_SECONDS:-2}}",
+        "    if grep -qi '^ *wavefieldoutput *= *1' parameters.par 2> /dev/null",
+        "    then",
+        "        # Output of the simulation, blocking it in synchronous mode",
+        "        prefix=$(sed -n \"s/^ *outputfile *= *'\\(.*\\)'.*/\\1/Ip\" "
+        "parameters.par)",
+        "        head -c ${{FAKE_OUTPUT_BYTES:-4194304}} /dev/zero "
+        "> $prefix-wavefield.h5",
+        '        if [[ "$APPTAINERENV_ASYNC_MODE" == SYNC ]]',
+        "        then",
+        "            elapsed=$(( elapsed + 1 ))",
+        "        fi",
+        "    fi",
+        "    date=$(date '+%a %b %d %H:%M:%S')",
+        '    echo "$date, Info:  Elapsed time (via clock_gettime):'
+        ' $elapsed seconds."',
+        '    echo "$date, Info:  Performance since the start: 12.5 TFLOP/s"',
+        "    cap=$(cat {state}/power_limit.$SLURM_JOB_ID 2> /dev/null || echo 700)",
+        "    awk -v cap=$cap 'BEGIN {{",
+        "        time = 100 * (1 + 90000 / cap ^ 2)",
+        '        printf "{{\\"time_s\\": %.1f, ", time',
+        '        printf "\\"energy_j\\": %.0f, ", time * (cap + 150)',
+        '        printf "\\"source\\": \\"fake\\"}}\\n"',
+        "    }}' > result.json",
+        "fi",
+    ],
+}
+
+
+def fake_slurm(state_dir):
+    """Install the fake Slurm in state_dir, and return the environment
+    using it"""
+    bin_dir = Path(state_dir).resolve() / "bin"
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    for name, lines in FAKE_SLURM_STUBS.items():
+        stub = bin_dir / name
+        stub.write_text(
+            "\n".join(lines).format(state=Path(state_dir).resolve()) + "\n"
+        )
+        stub.chmod(0o755)
+    return dict(os.environ, PATH="{}:{}".format(bin_dir, os.environ["PATH"]))
+
+
+def submit(run_dir, env=None):
+    """Submit the job of a run directory, and return its id"""
+    output = subprocess.run(
+        ["sbatch", "--parsable", "submit.slurm"],
+        cwd=run_dir,
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return output.strip().split(";")[0]
+
+
+def submit_runs(
+    sweep_dir, manifest, todo, env=None, max_queued=4, interval=10, poll=60
+):
+    """Submit runs of a manifest in order, keeping at most max_queued jobs
+    of the user in the queue, and waiting interval seconds between
+    submissions"""
+    for index, run in enumerate(todo):
+        while len(queued(env)) >= max_queued:
+            time.sleep(poll)
+        job_id = submit(Path(sweep_dir) / run["dir"], env=env)
+        runs.update_run(
+            sweep_dir, manifest, run, job_id=job_id, submitted=runs.timestamp()
+        )
+        print("{}: job {}".format(run["id"], job_id), flush=True)
+        if index + 1 < len(todo):
+            time.sleep(interval)
+
+
+def wait(job_ids, env=None, poll=60):
+    """Wait for jobs to leave the queue"""
+    while queued(env) & set(job_ids):
+        time.sleep(poll)
+
+
+def queued(env=None):
+    """Return the ids of the pending and running jobs of the user"""
+    output = subprocess.run(
+        ["squeue", "-h", "-o", "%i", "-u", getpass.getuser()],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return set(output.split())
+
+
+def accounting(job_id, env=None):
+    """Return the time and energy of the longest step of a job (the
+    application) from the Slurm accounting, if the site records energy
+    (None without accounting, as when sacct is missing or fails)"""
+    try:
+        output = subprocess.run(
+            [
+                "sacct",
+                "-n",
+                "-P",
+                "-j",
+                job_id,
+                "-o",
+                "JobID,ElapsedRaw,ConsumedEnergyRaw",
+            ],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return None
+    steps = []
+    for line in output.splitlines():
+        step, elapsed, energy = line.split("|")
+        if "." in step and elapsed and energy:
+            steps.append((int(elapsed), int(energy)))
+    if not steps:
+        return None
+    elapsed, energy = max(steps)
+    return dict(time_s=elapsed, energy_j=energy, source="sacct")
@@ -0,0 +1,377 @@
+"""Collect the results of runs of all clusters in a SQLite database, and
+query and export them.
+
+The "ingest" command adds the runs of sweep folders and of folders created
+by setup-sim.sh (see pcap/analysis.py) to the database, for the cluster and
+application given, with their metadata: the config file of the cluster
+(configs/*.json), the SHA-256 digest of the container image (and overlay),
+the environment of submit.slurm and run.env, the simulated time (EndTime)
+and their result (result.json, or the analysis of the run if it has none).
+Ingesting again only updates the runs whose files changed, and image
+digests are only computed for new or modified images.
+
+The "query" command prints the runs matching filters on the cluster,
+application, node count, power limit and order (indexed), averaged over
+repetitions, or one per line with --runs; "export" writes them to CSV or
+JSON.
+
+Example:
+    python3 -m pcap.store ingest sweeps/caps-4n --config ../configs/thea.json
+    python3 -m pcap.store query --cluster thea,jedi --cap 400 --order 6 --nodes 8
+    python3 -m pcap.store export --cluster thea --format csv --output thea.csv
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import re
+import shlex
+import sqlite3
+import sys
+from pathlib import Path
+
+from . import analysis, runs
+
+DATABASE = "results.db"
+METRICS = [
+    "time_s",
+    "energy_j",
+    "gpu_energy_j",
+    "avg_power_w",
+    "peak_node_power_w",
+    "edp_js",
+    "stepping_time_s",
+    "stepping_energy_j",
+    "gflops",
+]
+KEYS = ["cluster", "app", "nodes", "gpu_power_limit", "conv_order"]
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    path TEXT PRIMARY KEY,
+    cluster TEXT NOT NULL,
+    app TEXT NOT NULL,
+    nodes INTEGER,
+    gpu_power_limit INTEGER,
+    conv_order INTEGER,
+    end_time REAL,
+    sweep TEXT,
+    run TEXT,
+    repetition INTEGER,
+    job_id TEXT,
+    binary TEXT,
+    image_digest TEXT,
+    config TEXT,
+    env TEXT,
+    source TEXT,
+    result TEXT,
+    {metrics},
+    stamp REAL,
+    ingested TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_by_cluster
+    ON runs (cluster, app, nodes, gpu_power_limit, conv_order);
+CREATE INDEX IF NOT EXISTS runs_by_point
+    ON runs (app, gpu_power_limit, conv_order, nodes);
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime REAL,
+    digest TEXT
+);
+""".format(
+    metrics=",\n    ".join("{} REAL".format(name) for name in METRICS)
+)
+SLURM_EXPORT = re.compile(r"^export (\w+)=(.*)$", re.M)
+SLURM_NODES = re.compile(r"^#SBATCH --nodes=(\d+)", re.M)
+SLURM_BINARY = re.compile(r"SEISSOL_BIN:-([^}]+)\}")
+
+
+def connect(path):
+    database = sqlite3.connect(path)
+    database.row_factory = sqlite3.Row
+    database.executescript(SCHEMA)
+    return database
+
+
+def image_digest(database, path):
+    """Return the SHA-256 digest of an image, computed again only if the
+    image changed since the last time"""
+    path = Path(path).resolve()
+    stat = path.stat()
+    row = database.execute(
+        "SELECT size, mtime, digest FROM images WHERE path = ?", [str(path)]
+    ).fetchone()
+    if row and (row["size"], row["mtime"]) == (stat.st_size, stat.st_mtime):
+        return row["digest"]
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 24), b""):
+            digest.update(block)
+    digest = "sha256:{}".format(digest.hexdigest())
+    database.execute(
+        "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)",
+        [str(path), stat.st_size, stat.st_mtime, digest],
+    )
+    return digest
+
+
+def run_env(run_dir):
+    """Return the environment of a run: the exports of submit.slurm, then
+    the settings of run.env"""
+    env = {}
+    submit = run_dir / "submit.slurm"
+    if submit.exists():
+        env.update(SLURM_EXPORT.findall(submit.read_text()))
+    if (run_dir / runs.RUN_ENV).exists():
+        for name, value in SLURM_EXPORT.findall((run_dir / runs.RUN_ENV).read_text()):
+            env[name] = " ".join(shlex.split(value))
+    return env
+
+
+def stamp(run_dir):
+    """Return the last modification time of the files of a run"""
+    files = [runs.RUN_RESULT, runs.RUN_RECORD, runs.RUN_ENV]
+    files = [run_dir / name for name in files] + list(run_dir.glob("*.out"))
+    return max([file.stat().st_mtime for file in files if file.exists()], default=0)
+
+
+def run_row(database, run_dir, run, cluster, app, config):
+    """Return the row of a run, or None if it has no result"""
+    record = run
+    if (run_dir / runs.RUN_RECORD).exists():
+        record = dict(runs.read_json(run_dir / runs.RUN_RECORD), **run)
+    result = runs.read_result(run_dir)
+    if result is None:
+        result = analysis.analyse_run(run_dir, record.get("job_id"))
+    if result is None:
+        return None
+
+    env = run_env(run_dir)
+    submit = (run_dir / "submit.slurm").read_text()
+    binary = env.get("SEISSOL_BIN")
+    if binary is None and SLURM_BINARY.search(submit):
+        binary = SLURM_BINARY.search(submit).group(1)
+    nodes = record.get("nodes")
+    if nodes is None and SLURM_NODES.search(submit):
+        nodes = int(SLURM_NODES.search(submit).group(1))
+    order = record.get("order")
+    if order is None and binary:
+        order = runs.binary_order(binary)
+    cap = record.get("gpu_power_limit", env.get("GPU_POWER_LIMIT") or None)
+    end_time = record.get("end_time")
+    if end_time is None and (run_dir / "parameters.par").exists():
+        end_time = runs.get_parameter(
+            (run_dir / "parameters.par").read_text(), "EndTime"
+        )
+    digests = [
+        image_digest(database, run_dir / image)
+        for image in ["seissol.sif", "seissol-overlay.sqsh"]
+        if (run_dir / image).exists()
+    ]
+    return dict(
+        path=str(run_dir.resolve()),
+        cluster=cluster,
+        app=app,
+        nodes=nodes,
+        gpu_power_limit=None if cap is None else int(cap),
+        conv_order=order,
+        end_time=None if end_time is None else float(end_time),
+        sweep=record.get("sweep"),
+        run=record.get("id", run_dir.name),
+        repetition=record.get("repetition"),
+        job_id=record.get("job_id"),
+        binary=binary,
+        image_digest=" ".join(digests) or None,
+        config=config,
+        env=json.dumps(env, sort_keys=True),
+        source=result.get("source"),
+        result=json.dumps(result, sort_keys=True),
+        stamp=stamp(run_dir),
+        ingested=runs.timestamp(),
+        **{name: result.get(name) for name in METRICS}
+    )
+
+
+def ingest(args):
+    config = None
+    cluster = args.cluster
+    if args.config:
+        config = json.dumps(runs.read_json(args.config), sort_keys=True)
+        cluster = cluster or args.config.stem
+    if not cluster:
+        sys.exit("No cluster: use --cluster or --config")
+    database = connect(args.db)
+    added = unchanged = unfinished = 0
+    for folder in args.folders:
+        found, table_dir = analysis.find_runs(folder)
+        for run in found:
+            run_dir = (table_dir / run["dir"]).resolve()
+            row = database.execute(
+                "SELECT stamp FROM runs WHERE path = ?", [str(run_dir)]
+            ).fetchone()
+            if row and row["stamp"] == stamp(run_dir):
+                unchanged += 1
+                continue
+            row = run_row(database, run_dir, run, cluster, args.app, config)
+            if row is None:
+                unfinished += 1
+                continue
+            database.execute(
+                "INSERT OR REPLACE INTO runs ({}) VALUES ({})".format(
+                    ", ".join(row), ", ".join("?" * len(row))
+                ),
+                list(row.values()),
+            )
+            added += 1
+        database.commit()
+    print(
+        "{}: {} runs added or updated, {} unchanged, {} not finished".format(
+            args.db, added, unchanged, unfinished
+        )
+    )
+
+
+def select(database, args, columns, group_by=None):
+    """Return the rows of the runs matching the filters of args"""
+    conditions = []
+    parameters = []
+    for column, values in [
+        ("cluster", args.cluster),
+        ("app", args.app),
+        ("nodes", args.nodes),
+        ("conv_order", args.order),
+    ]:
+        if values:
+            conditions.append("{} IN ({})".format(column, ", ".join("?" * len(values))))
+            parameters += values
+    if args.cap:
+        caps = [cap for cap in args.cap if cap is not None]
+        cap_conditions = []
+        if caps:
+            cap_conditions.append(
+                "gpu_power_limit IN ({})".format(", ".join("?" * len(caps)))
+            )
+            parameters += caps
+        if None in args.cap:
+            cap_conditions.append("gpu_power_limit IS NULL")
+        conditions.append("({})".format(" OR ".join(cap_conditions)))
+    query = "SELECT {} FROM runs".format(", ".join(columns))
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if group_by:
+        query += " GROUP BY " + ", ".join(group_by)
+    query += " ORDER BY " + ", ".join(KEYS)
+    return database.execute(query, parameters).fetchall()
+
+
+def cell_text(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return "{:.6g}".format(value)
+    return value
+
+
+def query(args):
+    database = connect(args.db)
+    if args.runs:
+        rows = select(database, args, ["*"])
+        columns = ["run"] + KEYS + ["job_id", "time_s", "energy_j", "edp_js"]
+    else:
+        rows = select(
+            database,
+            args,
+            KEYS
+            + ["COUNT(*) AS runs"]
+            + ["AVG({0}) AS {0}".format(name) for name in ["time_s", "energy_j"]]
+            + ["AVG(edp_js) AS edp_js"],
+            group_by=KEYS,
+        )
+        columns = KEYS + ["runs", "time_s", "energy_j", "edp_js"]
+    widths = ["<28" if column == "run" else ">15" for column in columns]
+    print(" ".join("{:{}}".format(*cell) for cell in zip(columns, widths)))
+    for row in rows:
+        print(
+            " ".join(
+                "{:{}}".format(cell_text(row[column]), width)
+                for column, width in zip(columns, widths)
+            )
+        )
+
+
+def export(args):
+    database = connect(args.db)
+    rows = [dict(row) for row in select(database, args, ["*"])]
+    for row in rows:
+        for name in ["config", "env", "result"]:
+            if args.format == "json" and row[name] is not None:
+                row[name] = json.loads(row[name])
+    with open(args.output, "w", newline="") as file:
+        if args.format == "json":
+            json.dump(rows, file, indent=2)
+            file.write("\n")
+        elif rows:
+            writer = csv.DictWriter(file, list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    print("{}: {} runs".format(args.output, len(rows)))
+
+
+def str_list(value):
+    return value.split(",")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--db", type=Path, default=Path(DATABASE), help="database (default results.db)"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = commands.add_parser("ingest", help="add or update runs")
+    ingest_parser.add_argument(
+        "folders", type=Path, nargs="+", help="sweep or run folders"
+    )
+    ingest_parser.add_argument("--cluster", help="cluster (default config name)")
+    ingest_parser.add_argument(
+        "--config", type=Path, help="config file of the cluster"
+    )
+    ingest_parser.add_argument(
+        "--app", default="seissol", help="application (default seissol)"
+    )
+
+    filter_parser = argparse.ArgumentParser(add_help=False)
+    filter_parser.add_argument("--cluster", type=str_list, help="clusters")
+    filter_parser.add_argument("--app", type=str_list, help="applications")
+    filter_parser.add_argument("--nodes", type=runs.int_list, help="node counts")
+    filter_parser.add_argument(
+        "--cap", type=runs.cap_list, help='GPU power limits, "none" for uncapped'
+    )
+    filter_parser.add_argument("--order", type=runs.int_list, help="orders")
+
+    query_parser = commands.add_parser(
+        "query", parents=[filter_parser], help="print runs"
+    )
+    query_parser.add_argument(
+        "--runs", action="store_true", help="print each run instead of the means"
+    )
+    export_parser = commands.add_parser(
+        "export", parents=[filter_parser], help="write runs to a file"
+    )
+    export_parser.add_argument(
+        "--format", choices=["csv", "json"], default="csv", help="default csv"
+    )
+    export_parser.add_argument("--output", type=Path, required=True, help="file")
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        ingest(args)
+    elif args.command == "query":
+        query(args)
+    else:
+        export(args)
+
+
+if __name__ == "__main__":
+    main()
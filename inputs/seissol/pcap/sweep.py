@@ -0,0 +1,315 @@
+"""Create and submit a sweep of SeisSol runs over GPU power limits, node
+counts, convergence orders and repetitions.
+
+The "create" command creates one run directory per point of the grid (see
+pcap/runs.py), and the manifest of the sweep. With --profile sparse or
+compute, the parameter file of the runs writes sparse outputs or none (see
+runs.PROFILES), to measure compute and communication without the noise of
+the filesystem, and the manifest records the changed values of each run.
+With --walltime, the simulated time and the time limit of each run are set
+for a run of that wall time, from the throughput of earlier runs of the
+cluster at the same order and power limit (see pcap/walltime.py).
+Runs are ordered repetition by repetition, so that drifts of the machine
+over time (e.g. other jobs or temperature) spread over all points instead of
+biasing some of them. The "submit" command submits the runs not submitted
+yet, in order, keeping at most --max-queued jobs of the user in the queue
+and waiting --interval seconds between submissions. It can be interrupted
+and run again. With --fake-slurm, the jobs run on the local machine with
+stubs of Slurm, the GPU and the container (see pcap/slurm.py), to test the
+workflow. The "status" command lists the runs and their jobs.
+
+Example:
+    python3 -m pcap.sweep create sweeps/caps --caps none,300,400,500 \\
+        --nodes 4,8 --orders 6 --repetitions 3
+    python3 -m pcap.sweep submit sweeps/caps --max-queued 2
+    python3 -m pcap.sweep status sweeps/caps
+"""
+
+import argparse
+import itertools
+import sys
+from pathlib import Path
+
+from . import runs, slurm, store, walltime
+
+
+def run_id(cap, nodes, order, repetition):
+    return "o{}-n{}-{}-r{}".format(
+        order, nodes, "uncapped" if cap is None else "cap{}".format(cap), repetition
+    )
+
+
+def add_run(
+    sweep_dir,
+    manifest,
+    cap,
+    nodes,
+    order,
+    repetition,
+    end_time,
+    binary=runs.BINARY,
+    input_dir=runs.INPUT_DIR,
+    settings=None,
+    prefix="",
+    parameters=None,
+    time_limit=None,
+):
+    """Create the directory of a run, and add it to the manifest, with
+    settings added to its run.env, values of the &Output namelist of its
+    parameter file (the changes are recorded in the manifest), the time
+    limit of its job, and its id starting with prefix"""
+    run = dict(
+        id=prefix + run_id(cap, nodes, order, repetition),
+        sweep=manifest["sweep"],
+        gpu_power_limit=cap,
+        nodes=nodes,
+        order=order,
+        repetition=repetition,
+    )
+    if time_limit:
+        run["time_limit"] = time_limit
+    changes = runs.create_run(
+        Path(sweep_dir) / run["id"],
+        run,
+        env=dict(
+            settings or {}, GPU_POWER_LIMIT=cap, SEISSOL_BIN=binary.format(order=order)
+        ),
+        end_time=end_time,
+        input_dir=input_dir,
+        parameters=parameters,
+        time_limit=time_limit,
+    )
+    run = dict(run, parameters=changes, dir=run["id"], job_id=None)
+    manifest["runs"].append(run)
+    return run
+
+
+def create(args):
+    if args.sweep.exists():
+        sys.exit("{} already exists".format(args.sweep))
+    manifest = dict(
+        sweep=args.sweep.name,
+        created=runs.timestamp(),
+        grid=dict(
+            caps=args.caps,
+            nodes=args.nodes,
+            orders=args.orders,
+            repetitions=args.repetitions,
+            end_time=args.end_time,
+            binary=args.binary,
+            profile=args.profile,
+            output_interval=args.output_interval,
+        ),
+        runs=[],
+    )
+    plans = {}
+    if args.walltime:
+        if not args.cluster:
+            sys.exit("--walltime needs the --cluster of the earlier runs")
+        manifest["grid"].update(
+            end_time=None,
+            walltime=walltime.time_text(args.walltime),
+            margin=args.margin,
+            cluster=args.cluster,
+        )
+        database = store.connect(args.db)
+        for order in args.orders:
+            found = walltime.measurements(database, args.cluster, order)
+            for nodes, cap in itertools.product(args.nodes, args.caps):
+                plans[nodes, order, cap] = walltime.plan(
+                    found, nodes, cap, args.walltime, args.margin
+                )
+                if plans[nodes, order, cap] is None:
+                    sys.exit(
+                        "{}: no runs of {} with order {}".format(
+                            args.db, args.cluster, order
+                        )
+                    )
+    for repetition, nodes, order, cap in itertools.product(
+        range(1, args.repetitions + 1), args.nodes, args.orders, args.caps
+    ):
+        end_time, time_limit = args.end_time, None
+        if plans:
+            end_time, time_limit, _ = plans[nodes, order, cap]
+        add_run(
+            args.sweep,
+            manifest,
+            cap,
+            nodes,
+            order,
+            repetition,
+            end_time=end_time,
+            binary=args.binary,
+            input_dir=args.input_dir,
+            parameters=runs.profile_parameters(
+                args.profile, end_time, args.output_interval
+            ),
+            time_limit=time_limit,
+        )
+    runs.write_manifest(args.sweep, manifest)
+    print("{}: {} runs".format(args.sweep, len(manifest["runs"])))
+
+
+def submit(args):
+    manifest = runs.read_manifest(args.sweep)
+    env = None
+    if args.fake_slurm:
+        env = slurm.fake_slurm(args.sweep / ".fake-slurm")
+    todo = [run for run in manifest["runs"] if not run["job_id"]]
+    if args.limit:
+        todo = todo[: args.limit]
+    slurm.submit_runs(
+        args.sweep,
+        manifest,
+        todo,
+        env=env,
+        max_queued=args.max_queued,
+        interval=args.interval,
+        poll=args.poll,
+    )
+    if args.wait:
+        slurm.wait([run["job_id"] for run in manifest["runs"]], env=env, poll=args.poll)
+
+
+def status(args):
+    manifest = runs.read_manifest(args.sweep)
+    env = None
+    if args.fake_slurm:
+        env = slurm.fake_slurm(args.sweep / ".fake-slurm")
+    in_queue = slurm.queued(env)
+    print("{:<28} {:>10} {:>10}".format("run", "job", "state"))
+    for run in manifest["runs"]:
+        if not run["job_id"]:
+            state = "created"
+        elif run["job_id"] in in_queue:
+            state = "queued"
+        else:
+            state = "finished"
+        print("{:<28} {:>10} {:>10}".format(run["id"], run["job_id"] or "-", state))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    create_parser = commands.add_parser("create", help="create the run directories")
+    create_parser.add_argument("sweep", type=Path, help="sweep folder")
+    create_parser.add_argument(
+        "--caps",
+        type=runs.cap_list,
+        default=[None],
+        help='GPU power limits in W, "none" for uncapped (default none)',
+    )
+    create_parser.add_argument(
+        "--nodes", type=runs.int_list, default=[4], help="node counts (default 4)"
+    )
+    create_parser.add_argument(
+        "--orders",
+        type=runs.int_list,
+        default=[6],
+        help="convergence orders (default 6)",
+    )
+    create_parser.add_argument(
+        "--repetitions", type=int, default=1, help="runs per point (default 1)"
+    )
+    create_parser.add_argument(
+        "--end-time",
+        type=float,
+        default=40.0,
+        help="simulated time in s (default 40, about 1h on 4 Thea nodes)",
+    )
+    create_parser.add_argument(
+        "--walltime",
+        type=walltime.parse_time,
+        help="target wall time of a run (e.g. 1:00:00): sets the simulated time "
+        "and the time limit of each run from the throughput of earlier runs of "
+        "--cluster (see pcap/walltime.py)",
+    )
+    create_parser.add_argument("--cluster", help="cluster of the earlier runs")
+    create_parser.add_argument(
+        "--db",
+        type=Path,
+        default=Path(store.DATABASE),
+        help="results database of the earlier runs (default results.db)",
+    )
+    create_parser.add_argument(
+        "--margin",
+        type=float,
+        default=0.2,
+        help="time limit above --walltime, as a fraction (default 0.2)",
+    )
+    create_parser.add_argument(
+        "--profile",
+        choices=list(runs.PROFILES),
+        default="full",
+        help="outputs of the runs: as in the Turkey case (full, default), every "
+        "--output-interval without checkpoints (sparse), or none (compute)",
+    )
+    create_parser.add_argument(
+        "--output-interval",
+        type=float,
+        help="simulated time between outputs of the sparse profile (default end "
+        "time / 4)",
+    )
+    create_parser.add_argument(
+        "--config",
+        type=Path,
+        help="config file of the cluster, for the default --binary",
+    )
+    create_parser.add_argument(
+        "--binary",
+        help="SeisSol binary, {order} is replaced (default the one of the image "
+        "built for --config, or the default of submit.slurm without --config)",
+    )
+    create_parser.add_argument(
+        "--input-dir", type=Path, default=runs.INPUT_DIR, help="input folder"
+    )
+
+    submit_parser = commands.add_parser("submit", help="submit the runs")
+    submit_parser.add_argument("sweep", type=Path, help="sweep folder")
+    submit_parser.add_argument(
+        "--max-queued",
+        type=int,
+        default=4,
+        help="maximum number of jobs of the user in the queue (default 4)",
+    )
+    submit_parser.add_argument(
+        "--interval",
+        type=float,
+        default=10,
+        help="seconds between submissions (default 10)",
+    )
+    submit_parser.add_argument(
+        "--poll",
+        type=float,
+        default=60,
+        help="seconds between queue checks when it is full (default 60)",
+    )
+    submit_parser.add_argument(
+        "--limit", type=int, default=0, help="submit at most this many runs"
+    )
+    submit_parser.add_argument(
+        "--wait", action="store_true", help="wait for the jobs to finish"
+    )
+    submit_parser.add_argument(
+        "--fake-slurm", action="store_true", help="run the jobs locally"
+    )
+
+    status_parser = commands.add_parser("status", help="list the runs")
+    status_parser.add_argument("sweep", type=Path, help="sweep folder")
+    status_parser.add_argument(
+        "--fake-slurm", action="store_true", help="jobs run locally"
+    )
+    args = parser.parse_args()
+
+    if args.command == "create":
+        args.binary = args.binary or runs.binary(args.config)
+        create(args)
+    elif args.command == "submit":
+        submit(args)
+    else:
+        status(args)
+
+
+if __name__ == "__main__":
+    main()
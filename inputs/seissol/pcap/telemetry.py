@@ -0,0 +1,372 @@
+"""Sample the power of the GPUs and of the CPU of a node while a job runs.
+
+The sampler reads, --rate times per second:
+
+- the power draw (W), SM clock (MHz), temperature (C) and total energy (J)
+  of each GPU, from NVML (libnvidia-ml, through ctypes),
+- the power sensors of hwmon (W), e.g. the module, Grace and CPU power of
+  each socket of a Grace Hopper node, from /sys/class/hwmon.
+
+The samples go to a ring buffer preallocated for --flush seconds of
+samples, which is written out every --flush seconds (or when it is full) as
+a binary chunk of float64 columns, so that sampling formats no text and
+rarely writes. The sysfs files stay open and are read with pread. The
+sampler stops on SIGTERM or SIGINT, writes the last chunk, and prints its
+own CPU use.
+
+A telemetry file starts with MAGIC, the length of a JSON header (uint32)
+and the header (node, rate, columns and units). Each chunk is CHUNK, the
+number of rows and of columns (uint32 each), then each column as rows
+float64 values. All numbers are little-endian. Columns are "time" (Unix
+time in s), gpu<i>_<quantity> and hwmon_<label> (see read()). Values of
+failed NVML reads are NaN.
+
+With --mock DIR, the sampler reads a fake hwmon tree created in DIR and a
+fake NVML, to test it on machines without GPUs.
+
+Example:
+    srun --overlap --ntasks-per-node=1 --cpus-per-task=1 \\
+        python3 -m pcap.telemetry --output telemetry --rate 10 &
+"""
+
+import argparse
+import array
+import ctypes
+import json
+import math
+import os
+import re
+import signal
+import socket
+import struct
+import sys
+import time
+from pathlib import Path
+
+MAGIC = b"PCAPTEL1"
+CHUNK = b"CHNK"
+HWMON_ROOT = "/sys/class/hwmon"
+
+# NVML constants (nvml.h)
+NVML_CLOCK_SM = 1
+NVML_TEMPERATURE_GPU = 0
+
+
+class Nvml:
+    """GPUs of the node, read with NVML"""
+
+    QUANTITIES = [
+        ("power_w", "W"),
+        ("sm_clock_mhz", "MHz"),
+        ("temp_c", "C"),
+        ("energy_j", "J"),
+    ]
+
+    def __init__(self):
+        self.lib = ctypes.CDLL("libnvidia-ml.so.1")
+        self.check(self.lib.nvmlInit_v2())
+        count = ctypes.c_uint()
+        self.check(self.lib.nvmlDeviceGetCount_v2(ctypes.byref(count)))
+        self.handles = []
+        for index in range(count.value):
+            handle = ctypes.c_void_p()
+            self.check(
+                self.lib.nvmlDeviceGetHandleByIndex_v2(index, ctypes.byref(handle))
+            )
+            self.handles.append(handle)
+        # Reused output arguments, so that reading allocates nothing
+        self.value = ctypes.c_uint()
+        self.energy = ctypes.c_ulonglong()
+        self.value_ref = ctypes.byref(self.value)
+        self.energy_ref = ctypes.byref(self.energy)
+        self.columns = [
+            ("gpu{}_{}".format(index, name), unit)
+            for index in range(len(self.handles))
+            for name, unit in self.QUANTITIES
+        ]
+
+    @staticmethod
+    def check(status):
+        if status != 0:
+            raise OSError("NVML error {}".format(status))
+
+    def read(self, values):
+        """Append the values of the GPUs, NaN for the failed reads (instead of
+        the value of the previous read left in the output argument)"""
+        lib, value, energy = self.lib, self.value, self.energy
+        for handle in self.handles:
+            status = lib.nvmlDeviceGetPowerUsage(handle, self.value_ref)
+            values.append(value.value / 1000 if status == 0 else math.nan)
+            status = lib.nvmlDeviceGetClockInfo(handle, NVML_CLOCK_SM, self.value_ref)
+            values.append(value.value if status == 0 else math.nan)
+            status = lib.nvmlDeviceGetTemperature(
+                handle, NVML_TEMPERATURE_GPU, self.value_ref
+            )
+            values.append(value.value if status == 0 else math.nan)
+            status = lib.nvmlDeviceGetTotalEnergyConsumption(handle, self.energy_ref)
+            values.append(energy.value / 1000 if status == 0 else math.nan)
+
+    def close(self):
+        self.lib.nvmlShutdown()
+
+
+class MockNvml:
+    """Fake GPUs, drawing a slowly varying power"""
+
+    QUANTITIES = Nvml.QUANTITIES
+
+    def __init__(self, count=1):
+        self.count = count
+        self.start = time.time()
+        self.columns = [
+            ("gpu{}_{}".format(index, name), unit)
+            for index in range(count)
+            for name, unit in self.QUANTITIES
+        ]
+
+    def read(self, values):
+        elapsed = time.time() - self.start
+        for index in range(self.count):
+            power = 400 + 150 * math.sin(elapsed / 10 + index)
+            values.append(power)
+            values.append(1500 + power)
+            values.append(40 + power / 20)
+            values.append(550 * elapsed)
+
+    def close(self):
+        pass
+
+
+class Hwmon:
+    """Power sensors of hwmon, in W"""
+
+    def __init__(self, root=HWMON_ROOT):
+        self.files = []
+        self.columns = []
+        for device in sorted(Path(root).glob("hwmon*")):
+            for sensor in sorted(device.glob("power*_average")) + sorted(
+                device.glob("power*_input")
+            ):
+                label = self.label(device, sensor.name.split("_")[0])
+                name = "hwmon_{}".format(re.sub(r"\W+", "_", label).strip("_").lower())
+                if any(name == column for column, _ in self.columns):
+                    continue
+                self.files.append(os.open(sensor, os.O_RDONLY))
+                self.columns.append((name, "W"))
+
+    @staticmethod
+    def label(device, sensor):
+        """Return the label of a sensor (e.g. "Module Power Socket 0" on
+        Grace), or the device name and the sensor"""
+        for path in [
+            device / "{}_label".format(sensor),
+            device / "device" / "{}_oem_info".format(sensor),
+        ]:
+            if path.exists():
+                return path.read_text().strip()
+        name = (device / "name").read_text().strip()
+        return "{}_{}".format(name, sensor)
+
+    def read(self, values):
+        for file in self.files:
+            values.append(int(os.pread(file, 32, 0)) / 1e6)
+
+    def close(self):
+        for file in self.files:
+            os.close(file)
+
+
+def mock_hwmon(root):
+    """Create a fake hwmon tree in root, like the one of a Grace Hopper
+    node, and return root"""
+    device = Path(root) / "hwmon0"
+    (device / "device").mkdir(parents=True, exist_ok=True)
+    (device / "name").write_text("power_meter\n")
+    for index, (label, power) in enumerate(
+        [
+            ("Module Power Socket 0", 620),
+            ("Grace Power Socket 0", 95),
+            ("CPU Power Socket 0", 70),
+        ],
+        start=1,
+    ):
+        (device / "device" / "power{}_oem_info".format(index)).write_text(label + "\n")
+        (device / "power{}_average".format(index)).write_text(
+            "{}\n".format(power * 1000000)
+        )
+    return Path(root)
+
+
+class Ring:
+    """Preallocated ring buffer of float64 columns, flushed as chunks"""
+
+    def __init__(self, columns, capacity, file):
+        self.columns = [array.array("d", bytes(8 * capacity)) for _ in columns]
+        self.capacity = capacity
+        self.file = file
+        self.head = 0
+        self.size = 0
+
+    def append(self, values):
+        for column, value in zip(self.columns, values):
+            column[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.size += 1
+        if self.size == self.capacity:
+            self.flush()
+
+    def flush(self):
+        if not self.size:
+            return
+        start = (self.head - self.size) % self.capacity
+        self.file.write(struct.pack("<4sII", CHUNK, self.size, len(self.columns)))
+        for column in self.columns:
+            if start + self.size <= self.capacity:
+                self.file.write(memoryview(column)[start : start + self.size])
+            else:
+                self.file.write(memoryview(column)[start:])
+                self.file.write(memoryview(column)[: self.head])
+        self.file.flush()
+        self.size = 0
+
+
+def read(path):
+    """Return the header and the columns (name: array of float64) of a
+    telemetry file"""
+    with open(path, "rb") as file:
+        data = file.read()
+    if data[: len(MAGIC)] != MAGIC:
+        raise ValueError("{} is not a telemetry file".format(path))
+    offset = len(MAGIC)
+    (length,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    header = json.loads(data[offset : offset + length])
+    offset += length
+    names = [name for name, _ in header["columns"]]
+    columns = {name: array.array("d") for name in names}
+    while offset + 12 <= len(data):
+        tag, rows, count = struct.unpack_from("<4sII", data, offset)
+        offset += 12
+        if tag != CHUNK or count != len(names):
+            raise ValueError("{}: corrupted chunk".format(path))
+        if offset + 8 * rows * count > len(data):
+            break  # Chunk cut by the end of the job
+        for name in names:
+            columns[name].frombytes(data[offset : offset + 8 * rows])
+            offset += 8 * rows
+    if sys.byteorder == "big":
+        for column in columns.values():
+            column.byteswap()
+    return header, columns
+
+
+def sample(sources, output, rate, flush, node):
+    """Sample the sources until SIGTERM or SIGINT, and return the number
+    of samples"""
+    columns = [("time", "s")]
+    for source in sources:
+        columns += source.columns
+    header = json.dumps(
+        dict(node=node, rate=rate, columns=columns, started=time.time())
+    ).encode()
+
+    stop = []
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+        signal.signal(signum, lambda *args: stop.append(True))
+
+    if sys.byteorder == "big":
+        raise OSError("Telemetry files are little-endian")
+    with open(output, "wb") as file:
+        file.write(MAGIC + struct.pack("<I", len(header)) + header)
+        ring = Ring(columns, max(1, int(rate * flush)), file)
+        period = 1 / rate
+        next_sample = next_flush = time.monotonic()
+        count = 0
+        values = []
+        while not stop:
+            values.clear()
+            values.append(time.time())
+            for source in sources:
+                source.read(values)
+            ring.append(values)
+            count += 1
+            now = time.monotonic()
+            if now - next_flush >= flush:
+                ring.flush()
+                next_flush = now
+            # Absolute deadlines, so that the rate does not drift
+            next_sample += period
+            if next_sample > now:
+                time.sleep(next_sample - now)
+            else:
+                next_sample = now
+        ring.flush()
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=Path("telemetry"),
+        help="output folder, with a <node>.tel file per node (default telemetry)",
+    )
+    parser.add_argument(
+        "--rate", type=float, default=10, help="samples per second (default 10)"
+    )
+    parser.add_argument(
+        "--flush", type=float, default=30, help="seconds between writes (default 30)"
+    )
+    parser.add_argument(
+        "--hwmon-root", default=HWMON_ROOT, help="hwmon folder (default %(default)s)"
+    )
+    parser.add_argument(
+        "--mock", type=Path, help="read a fake hwmon tree and NVML created in MOCK"
+    )
+    parser.add_argument(
+        "--mock-gpus", type=int, default=1, help="fake GPUs (default 1)"
+    )
+    args = parser.parse_args()
+
+    node = socket.gethostname().split(".")[0]
+    sources = []
+    if args.mock:
+        sources.append(MockNvml(args.mock_gpus))
+        args.hwmon_root = mock_hwmon(args.mock / node)
+    else:
+        try:
+            sources.append(Nvml())
+        except OSError as error:
+            print(
+                "telemetry: {}: no GPU data ({})".format(node, error), file=sys.stderr
+            )
+    hwmon = Hwmon(args.hwmon_root)
+    if hwmon.columns:
+        sources.append(hwmon)
+    if not sources:
+        sys.exit("telemetry: {}: no sensors".format(node))
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    output = args.output / "{}.tel".format(node)
+    start, cpu_start = time.monotonic(), time.process_time()
+    count = sample(sources, output, args.rate, args.flush, node)
+    elapsed = time.monotonic() - start
+    for source in sources:
+        source.close()
+    print(
+        "telemetry: {}: {} samples of {} sensors in {:.0f}s to {}, {:.2f}% of a "
+        "core".format(
+            node,
+            count,
+            sum(len(source.columns) for source in sources),
+            elapsed,
+            output,
+            100 * (time.process_time() - cpu_start) / max(elapsed, 1e-9),
+        ),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
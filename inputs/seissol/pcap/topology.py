@@ -0,0 +1,228 @@
+"""Generate the submit.slurm of a cluster from the node topology of its
+config file, with one rank per GPU.
+
+The "node" section of a config file (configs/*.json) describes a node:
+
+- partition: Slurm partition of the GPU nodes,
+- cores: physical cores of a node,
+- numa: cores of each NUMA domain (cpulist, e.g. "48-63"),
+- gpus: NUMA domain of each GPU, in PCI bus order, and the InfiniBand
+  device nearest to it (nic, optional),
+- compute_cores: default compute cores of a rank (the remaining cores of
+  the rank are left to the communication thread and I/O of SeisSol).
+
+The "generate" command sets the partition, one task per GPU and the cores
+of a rank in the #SBATCH lines of submit.slurm (and --gres=gpu:N on nodes
+with several GPUs), and writes a block (replaced when generating again)
+with the cores of each rank: the cores of the NUMA domain of its GPU,
+split evenly between the GPUs of the same domain. submit.slurm binds each
+rank to its cores (srun --cpu-bind=mask_cpu), computes the free CPU mask
+of each rank from COMPUTE_CORES, and runs each rank with its own GPU
+(CUDA_VISIBLE_DEVICES) and NIC (UCX_NET_DEVICES).
+
+The "detect" command prints the node section of the node it runs on, from
+sysfs (run it on a compute node, and add the partition).
+
+Example:
+    srun -N 1 -p dc-gpu python3 -m pcap.topology detect
+    python3 -m pcap.topology generate ../configs/jureca.json
+"""
+
+import argparse
+import json
+import re
+import sys
+from pathlib import Path
+
+from . import runs
+
+BEGIN = "# BEGIN pcap.topology"
+END = "# END pcap.topology"
+BLOCK_BEFORE = "# Binding to cores explicitly for performance"
+TUNE_END = "# END pcap.tune"
+NVIDIA = "0x10de"
+PCI_3D_CONTROLLER = "0x0302"
+
+
+def first_range(cpulist):
+    """Return the first and last core of the first range of a cpulist (the
+    physical cores, before their SMT siblings)"""
+    first, _, last = cpulist.split(",")[0].partition("-")
+    return int(first), int(last or first)
+
+
+def rank_cores(node):
+    """Return the first and last core of each rank, one per GPU"""
+    by_numa = {}
+    for index, gpu in enumerate(node["gpus"]):
+        by_numa.setdefault(gpu["numa"], []).append(index)
+    cores = [None] * len(node["gpus"])
+    for numa, gpus in by_numa.items():
+        first, last = first_range(node["numa"][numa])
+        share = (last - first + 1) // len(gpus)
+        for position, index in enumerate(gpus):
+            start = first + position * share
+            cores[index] = (start, start + share - 1)
+    return cores
+
+
+def topology_block(node, cluster):
+    """Return the lines of submit.slurm with the cores, GPU and NIC of
+    each rank"""
+    cores = rank_cores(node)
+    masks = [
+        "0x{:x}".format((1 << (last + 1)) - (1 << first)) for first, last in cores
+    ]
+    lines = [
+        BEGIN,
+        "# Topology of {}: one rank per GPU ({} per node), on the cores of the NUMA "
+        "domain of".format(cluster, len(cores)),
+        "# its GPU (see pcap/topology.py)",
+        "COMPUTE_CORES=${{COMPUTE_CORES:-{}}}".format(node["compute_cores"]),
+        'RANK_CORES="{}"'.format(" ".join("{}-{}".format(*item) for item in cores)),
+        'RANK_CPU_BIND="{}"'.format(",".join(masks)),
+        "export APPTAINERENV_CUDA_DEVICE_ORDER=PCI_BUS_ID",
+    ]
+    rank_env = ["export APPTAINERENV_CUDA_VISIBLE_DEVICES=$SLURM_LOCALID"]
+    if all("nic" in gpu for gpu in node["gpus"]):
+        nics = " ".join(gpu["nic"] for gpu in node["gpus"])
+        lines.append('export RANK_NICS="{}"'.format(nics))
+        rank_env = [
+            "nics=($RANK_NICS)",
+            rank_env[0],
+            "export APPTAINERENV_UCX_NET_DEVICES=${nics[$SLURM_LOCALID]}:1",
+        ]
+    if len(cores) > 1:
+        lines.append(
+            "rank_exec=(bash -c '{}; exec \"$@\"' rank)".format("; ".join(rank_env))
+        )
+    return lines + [END]
+
+
+def write_submit(path, node, cluster):
+    """Write the topology of a node into a submit.slurm"""
+    lines = path.read_text().splitlines()
+    if BEGIN in lines:
+        del lines[lines.index(BEGIN) : lines.index(END) + 2]
+    # After the tuned settings, if any, which take precedence
+    anchor = TUNE_END if TUNE_END in lines else BLOCK_BEFORE
+    index = next(
+        (index for index, line in enumerate(lines) if line.startswith(anchor)), None
+    )
+    if index is None:
+        sys.exit("{}: no line starting with {!r}".format(path, BLOCK_BEFORE))
+    if anchor == TUNE_END:
+        index += 2
+    lines[index:index] = topology_block(node, cluster) + [""]
+
+    gpus = len(node["gpus"])
+    text = "\n".join(lines) + "\n"
+    for option, value in [
+        ("partition", node["partition"]),
+        ("ntasks-per-node", gpus),
+        ("cpus-per-task", min(last - first + 1 for first, last in rank_cores(node))),
+    ]:
+        text = re.sub(
+            r"^#SBATCH --{}=\S+".format(option),
+            "#SBATCH --{}={}".format(option, value),
+            text,
+            flags=re.M,
+        )
+    text = re.sub(r"^#SBATCH --gres=gpu:\d+\n", "", text, flags=re.M)
+    if gpus > 1:
+        text = re.sub(
+            r"^(#SBATCH --cpus-per-task=\d+\n)",
+            r"\g<1>#SBATCH --gres=gpu:{}\n".format(gpus),
+            text,
+            flags=re.M,
+        )
+    path.write_text(text)
+
+
+def detect(root="/sys"):
+    """Return the node section of the node, from sysfs"""
+    root = Path(root)
+    numa = {}
+    for path in sorted((root / "devices/system/node").glob("node[0-9]*")):
+        cpulist = (path / "cpulist").read_text().strip()
+        if cpulist:
+            numa[int(path.name[4:])] = cpulist
+    distances = {
+        index: [
+            int(value)
+            for value in (
+                root / "devices/system/node/node{}/distance".format(index)
+            ).read_text().split()
+        ]
+        for index in numa
+    }
+    nics = {}
+    for path in sorted((root / "class/infiniband").glob("*")):
+        nic_numa = int((path / "device/numa_node").read_text())
+        nics[path.name] = nic_numa if nic_numa in numa else min(numa)
+    gpus = []
+    for path in sorted((root / "bus/pci/devices").glob("*")):
+        if (path / "vendor").read_text().strip() != NVIDIA or not (
+            path / "class"
+        ).read_text().startswith(PCI_3D_CONTROLLER):
+            continue
+        gpu_numa = int((path / "numa_node").read_text())
+        if gpu_numa not in numa:
+            # e.g. a GPU without NUMA information: the nearest CPU domain
+            gpu_numa = min(numa)
+        gpu = dict(numa=gpu_numa)
+        if nics:
+            # Nearest NIC, spreading the GPUs over NICs at the same distance
+            nearest = min(distances[gpu_numa][nics[nic]] for nic in nics)
+            candidates = [
+                nic for nic in sorted(nics) if distances[gpu_numa][nics[nic]] == nearest
+            ]
+            used = [other.get("nic") for other in gpus]
+            gpu["nic"] = min(candidates, key=used.count)
+        gpus.append(gpu)
+    order = sorted(numa)
+    for gpu in gpus:
+        gpu["numa"] = order.index(gpu["numa"])
+    cores = sum(last - first + 1 for first, last in map(first_range, numa.values()))
+    share = cores // max(len(gpus), 1)
+    return dict(
+        cores=cores,
+        numa=[numa[index] for index in order],
+        gpus=gpus,
+        compute_cores=max(share - max(share // 4, 1), 1),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate_parser = commands.add_parser("generate", help="generate submit.slurm")
+    generate_parser.add_argument("config", type=Path, help="config file")
+    generate_parser.add_argument(
+        "--output",
+        type=Path,
+        default=runs.INPUT_DIR / "submit.slurm",
+        help="submit script (default submit.slurm of the input folder)",
+    )
+    detect_parser = commands.add_parser("detect", help="print the node topology")
+    detect_parser.add_argument("--sysfs", default="/sys", help="sysfs root")
+    args = parser.parse_args()
+
+    if args.command == "detect":
+        print(json.dumps(dict(node=detect(args.sysfs)), indent=4))
+        return
+    config = runs.read_json(args.config)
+    if "node" not in config:
+        sys.exit("{}: no node section".format(args.config))
+    write_submit(args.output, config["node"], args.config.stem)
+    print(
+        "{}: {} ranks per node, cores {}".format(
+            args.output,
+            len(config["node"]["gpus"]),
+            " ".join("{}-{}".format(*item) for item in rank_cores(config["node"])),
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
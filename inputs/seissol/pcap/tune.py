@@ -0,0 +1,327 @@
+"""Tune the split of the cores of a node between SeisSol compute threads and
+communication/I/O threads, the OpenMP binding and the device stack memory,
+and write the fastest settings into submit.slurm.
+
+The tuning runs a short SeisSol simulation (--end-time) for each
+combination of compute cores of a rank (--cores, the remaining of its
+--cpus cores are left to the communication thread and the I/O of
+SeisSol), OpenMP binding (--bind) and DEVICE_STACK_MEM_SIZE (--stack-mem),
+at each GPU power limit (--caps), in run directories of a sweep folder
+(see pcap/sweep.py). Runs are compared by the wall time of the time
+stepping (see pcap/analysis.py), averaged over --repetitions, and the
+fastest combination of each power limit is written into a block of
+submit.slurm (replaced when tuning again), which selects the settings
+tuned at the power limit nearest to GPU_POWER_LIMIT. Settings of run.env
+still take precedence. Running the tuning again on the same folder reuses
+the finished runs.
+
+Tune on each cluster, in its workspace, since the best split depends on the
+CPU and the GPU of the nodes (and on the power limit), e.g. on Thea:
+    python3 -m pcap.tune tune/thea --cluster thea --cpus 72 \\
+        --cores 32,40,48,56,64 --bind close,spread --stack-mem 4,6,8 \\
+        --caps none,400 --nodes 4 --end-time 2
+"""
+
+import argparse
+import re
+import statistics
+import sys
+from pathlib import Path
+
+from . import analysis, runs, slurm, sweep
+
+BEGIN = "# BEGIN pcap.tune"
+END = "# END pcap.tune"
+BLOCK_BEFORE = "# Binding to cores explicitly for performance"
+TOPOLOGY_BEGIN = "# BEGIN pcap.topology"
+
+
+def combinations(args):
+    """Return the settings (run.env values) of the tuning runs"""
+    return [
+        dict(COMPUTE_CORES=cores, OMP_PROC_BIND=bind, DEVICE_STACK_MEM_SIZE=stack_mem)
+        for cores in args.cores
+        for bind in args.bind
+        for stack_mem in args.stack_mem
+    ]
+
+
+def prefix(settings):
+    return "c{COMPUTE_CORES}-{OMP_PROC_BIND}-m{DEVICE_STACK_MEM_SIZE}-".format(
+        **settings
+    )
+
+
+def settings_lines(settings, indent):
+    return [
+        "{}{name}=${{{name}:-{value}}}".format(indent, name=name, value=value)
+        for name, value in settings.items()
+    ]
+
+
+def tuned_block(best, cluster):
+    """Return the lines of submit.slurm selecting the settings tuned at the
+    power limit nearest to GPU_POWER_LIMIT"""
+    caps = sorted(cap for cap in best if cap is not None)
+    lines = [
+        BEGIN,
+        "# Fastest settings by GPU power limit, measured by pcap/tune.py ({})".format(
+            ", ".join(filter(None, [cluster, runs.timestamp()]))
+        ),
+    ]
+    if not caps:
+        return lines + settings_lines(best[None], "") + [END]
+    lines += ['if [[ -z "$GPU_POWER_LIMIT" ]]', "then"]
+    lines += settings_lines(best.get(None, best[caps[-1]]), "    ")
+    for low, high in zip(caps, caps[1:]):
+        lines += ["elif (( GPU_POWER_LIMIT < {} ))".format((low + high) // 2), "then"]
+        lines += settings_lines(best[low], "    ")
+    lines += ["else"] + settings_lines(best[caps[-1]], "    ") + ["fi", END]
+    return lines
+
+
+def write_submit(path, block, cpus):
+    """Write the tuned block into a submit.slurm, with the cores of a node"""
+    lines = path.read_text().splitlines()
+    if BEGIN in lines:
+        del lines[lines.index(BEGIN) : lines.index(END) + 2]
+    # Before the topology of the node, if any, so that tuned settings take
+    # precedence over its defaults
+    index = next(
+        (
+            index
+            for index, line in enumerate(lines)
+            if line.startswith(BLOCK_BEFORE) or line == TOPOLOGY_BEGIN
+        ),
+        None,
+    )
+    if index is None:
+        sys.exit("{}: no line starting with {!r}".format(path, BLOCK_BEFORE))
+    lines[index:index] = block + [""]
+    path.write_text("\n".join(lines) + "\n")
+    set_cpus(path, cpus)
+
+
+def set_cpus(path, cpus):
+    """Set the cores of a node requested by a submit.slurm"""
+    path.write_text(
+        re.sub(
+            r"^#SBATCH --cpus-per-task=\d+",
+            "#SBATCH --cpus-per-task={}".format(cpus),
+            path.read_text(),
+            flags=re.M,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("sweep", type=Path, help="sweep folder of the tuning runs")
+    parser.add_argument("--cluster", default="", help="cluster, for the record")
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        help="cores of a rank (default --cpus-per-task of submit.slurm)",
+    )
+    parser.add_argument(
+        "--cores",
+        type=runs.int_list,
+        default=[32, 40, 48, 56, 64],
+        help="compute cores (default 32,40,48,56,64)",
+    )
+    parser.add_argument(
+        "--bind",
+        type=lambda value: value.split(","),
+        default=["close", "spread"],
+        help="OpenMP bindings (default close,spread)",
+    )
+    parser.add_argument(
+        "--stack-mem",
+        type=runs.int_list,
+        default=[6],
+        help="DEVICE_STACK_MEM_SIZE values in GB (default 6)",
+    )
+    parser.add_argument(
+        "--caps",
+        type=runs.cap_list,
+        default=[None],
+        help='GPU power limits in W, "none" for uncapped (default none)',
+    )
+    parser.add_argument("--nodes", type=int, default=4, help="node count (default 4)")
+    parser.add_argument(
+        "--order", type=int, default=6, help="convergence order (default 6)"
+    )
+    parser.add_argument(
+        "--repetitions", type=int, default=1, help="runs per setting (default 1)"
+    )
+    parser.add_argument(
+        "--end-time", type=float, default=2.0, help="simulated time in s (default 2)"
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(runs.PROFILES),
+        default="full",
+        help="outputs of the runs (default full, see pcap/sweep.py)",
+    )
+    parser.add_argument(
+        "--config",
+        type=Path,
+        help="config file of the cluster, for the default --binary",
+    )
+    parser.add_argument(
+        "--binary",
+        help="SeisSol binary, {order} is replaced (default the one of the image "
+        "built for --config, or the default of submit.slurm without --config)",
+    )
+    parser.add_argument(
+        "--input-dir", type=Path, default=runs.INPUT_DIR, help="input folder"
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="submit script to write the settings to (default submit.slurm of the "
+        "input folder)",
+    )
+    parser.add_argument(
+        "--no-write", action="store_true", help="only print the results"
+    )
+    parser.add_argument(
+        "--max-queued", type=int, default=4, help="maximum jobs in the queue"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=10, help="seconds between submissions"
+    )
+    parser.add_argument(
+        "--poll", type=float, default=60, help="seconds between queue checks"
+    )
+    parser.add_argument(
+        "--fake-slurm", action="store_true", help="run the jobs locally"
+    )
+    args = parser.parse_args()
+    args.binary = args.binary or runs.binary(args.config)
+
+    if args.cpus is None:
+        args.cpus = int(
+            re.search(
+                r"^#SBATCH --cpus-per-task=(\d+)",
+                (args.input_dir / "submit.slurm").read_text(),
+                flags=re.M,
+            ).group(1)
+        )
+    if not all(0 < cores < args.cpus for cores in args.cores):
+        sys.exit("Compute cores must leave free cores out of {}".format(args.cpus))
+    env = None
+    if args.fake_slurm:
+        env = slurm.fake_slurm(args.sweep / ".fake-slurm")
+    if (args.sweep / runs.MANIFEST).exists():
+        manifest = runs.read_manifest(args.sweep)
+    else:
+        args.sweep.mkdir(parents=True, exist_ok=True)
+        manifest = dict(sweep=args.sweep.name, created=runs.timestamp(), runs=[])
+    manifest["tune"] = dict(
+        cluster=args.cluster,
+        cpus=args.cpus,
+        cores=args.cores,
+        bind=args.bind,
+        stack_mem=args.stack_mem,
+        caps=args.caps,
+        nodes=args.nodes,
+        order=args.order,
+        repetitions=args.repetitions,
+        end_time=args.end_time,
+        profile=args.profile,
+    )
+
+    # Tuning runs, repetition by repetition
+    existing = {run["id"]: run for run in manifest["runs"]}
+    points = []
+    for repetition in range(1, args.repetitions + 1):
+        for cap in args.caps:
+            for settings in combinations(args):
+                run_id = prefix(settings) + sweep.run_id(
+                    cap, args.nodes, args.order, repetition
+                )
+                run = existing.get(run_id)
+                if run is None:
+                    run = sweep.add_run(
+                        args.sweep,
+                        manifest,
+                        cap,
+                        args.nodes,
+                        args.order,
+                        repetition,
+                        end_time=args.end_time,
+                        binary=args.binary,
+                        input_dir=args.input_dir,
+                        settings=settings,
+                        prefix=prefix(settings),
+                        parameters=runs.profile_parameters(
+                            args.profile, args.end_time
+                        ),
+                    )
+                    set_cpus(args.sweep / run["dir"] / "submit.slurm", args.cpus)
+                points.append((cap, settings, run))
+    runs.write_manifest(args.sweep, manifest)
+    slurm.submit_runs(
+        args.sweep,
+        manifest,
+        [run for _, _, run in points if not run["job_id"]],
+        env=env,
+        max_queued=args.max_queued,
+        interval=args.interval,
+        poll=args.poll,
+    )
+    slurm.wait([run["job_id"] for _, _, run in points], env=env, poll=args.poll)
+
+    # Mean time-stepping time of each setting at each power limit
+    times = {}
+    for cap, settings, run in points:
+        result = analysis.analyse_run(args.sweep / run["dir"], run["job_id"])
+        if result is None:
+            sys.exit("{}: the run did not finish".format(run["id"]))
+        key = (cap, tuple(settings.items()))
+        times.setdefault(key, []).append(
+            result["stepping_time_s"] or result["time_s"]
+        )
+    best = {}
+    print(
+        "{:>10} {:>8} {:>8} {:>10} {:>12}".format(
+            "limit W", "cores", "bind", "stack GB", "stepping s"
+        )
+    )
+    for (cap, settings), values in sorted(
+        times.items(), key=lambda item: (item[0][0] is None, item[0][0] or 0)
+    ):
+        settings = dict(settings)
+        mean = statistics.mean(values)
+        if cap not in best or mean < best[cap][1]:
+            best[cap] = (settings, mean)
+        print(
+            "{:>10} {:>8} {:>8} {:>10} {:>12.2f}".format(
+                "none" if cap is None else cap,
+                settings["COMPUTE_CORES"],
+                settings["OMP_PROC_BIND"],
+                settings["DEVICE_STACK_MEM_SIZE"],
+                mean,
+            )
+        )
+    best = {cap: settings for cap, (settings, _) in best.items()}
+    manifest["tune"]["best"] = [
+        dict(settings, cap=cap) for cap, settings in best.items()
+    ]
+    runs.write_manifest(args.sweep, manifest)
+    for cap, settings in best.items():
+        print(
+            "fastest at {}: {}".format(
+                "no limit" if cap is None else "{} W".format(cap),
+                " ".join("{}={}".format(*item) for item in settings.items()),
+            )
+        )
+    if not args.no_write:
+        output = args.output or args.input_dir / "submit.slurm"
+        write_submit(output, tuned_block(best, args.cluster), args.cpus)
+        print("{}: tuned settings written".format(output))
+
+
+if __name__ == "__main__":
+    main()
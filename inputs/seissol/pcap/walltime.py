@@ -0,0 +1,217 @@
+"""Compute the simulated time (EndTime) and the time limit of SeisSol runs
+for a target wall time, from the throughput of earlier runs.
+
+The throughput of the time stepping (simulated seconds per wall second) and
+the setup time (wall time of the run before and after the time stepping)
+come from the runs of the results database (see pcap/store.py) with the
+same cluster, application and order, at the same GPU power limit, or else
+at the nearest lower one (capped runs are slower), or else at the nearest
+higher one. With runs at the node count asked, the estimate is their mean.
+Otherwise the throughput is extrapolated from the other node counts with a
+power law fitted to them (throughput ~ nodes^b, b between 0 and 1), or with
+ideal scaling (b = 1) from a single node count, and the setup time is the
+one of the nearest node count. The estimate is the EndTime of a run taking
+the target wall time, and the time limit of the job (#SBATCH --time) is the
+target plus --margin, rounded up to minutes.
+
+Example:
+    python3 -m pcap.walltime --cluster thea --order 6 --nodes 2,4,8,16 \\
+        --caps none,300,400 --walltime 1:00:00
+"""
+
+import argparse
+import math
+import statistics
+import sys
+from pathlib import Path
+
+from . import runs, store
+
+
+def parse_time(value):
+    """Return the seconds of a Slurm time ("minutes", "minutes:seconds",
+    "hours:minutes:seconds", "days-hours", "days-hours:minutes" or
+    "days-hours:minutes:seconds")"""
+    days, _, rest = value.rpartition("-")
+    parts = [int(part) for part in rest.split(":")]
+    if days:
+        parts += [0] * (3 - len(parts))
+        hours, minutes, seconds = parts
+    elif len(parts) == 3:
+        hours, minutes, seconds = parts
+    else:
+        hours = 0
+        minutes, seconds = (parts + [0])[:2]
+    return ((int(days or 0) * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def time_text(seconds):
+    """Return a Slurm time, in whole minutes rounded up"""
+    minutes = math.ceil(seconds / 60)
+    days, minutes = divmod(minutes, 24 * 60)
+    text = "{:02d}:{:02d}:00".format(minutes // 60, minutes % 60)
+    return "{}-{}".format(days, text) if days else text
+
+
+def measurements(database, cluster, order, app="seissol"):
+    """Return the node count, power limit, throughput and setup time of
+    the finished runs of a cluster and order"""
+    rows = database.execute(
+        "SELECT nodes, gpu_power_limit, end_time, time_s, stepping_time_s "
+        "FROM runs WHERE cluster = ? AND app = ? AND conv_order = ? "
+        "AND end_time IS NOT NULL AND time_s IS NOT NULL AND nodes IS NOT NULL",
+        [cluster, app, order],
+    ).fetchall()
+    found = []
+    for row in rows:
+        stepping = row["stepping_time_s"] or row["time_s"]
+        found.append(
+            dict(
+                nodes=row["nodes"],
+                cap=row["gpu_power_limit"],
+                rate=row["end_time"] / stepping,
+                setup=row["time_s"] - stepping,
+            )
+        )
+    return found
+
+
+def nearest_cap(caps, cap):
+    """Return the power limit of caps (None for uncapped, above all limits)
+    nearest to cap, preferring lower ones"""
+    if cap in caps:
+        return cap
+    limits = sorted(limit for limit in caps if limit is not None)
+    if cap is None:
+        return limits[-1]
+    lower = [limit for limit in limits if limit < cap]
+    if lower:
+        return lower[-1]
+    higher = [limit for limit in limits if limit > cap]
+    return higher[0] if higher else None
+
+
+def estimate(found, nodes, cap):
+    """Return the throughput (simulated s per wall s) and the setup time
+    in s of runs on nodes at a power limit, and the runs used, or None
+    without runs"""
+    if not found:
+        return None
+    used_cap = nearest_cap({run["cap"] for run in found}, cap)
+    by_nodes = {}
+    for run in found:
+        if run["cap"] == used_cap:
+            by_nodes.setdefault(run["nodes"], []).append(run)
+    basis = "{} W".format(used_cap) if used_cap is not None else "uncapped"
+    if nodes in by_nodes:
+        runs = by_nodes[nodes]
+        return (
+            statistics.mean(run["rate"] for run in runs),
+            statistics.mean(run["setup"] for run in runs),
+            "{} runs on {} nodes, {}".format(len(runs), nodes, basis),
+        )
+
+    # Power law through the mean throughput of each node count
+    points = [
+        (math.log(count), math.log(statistics.mean(run["rate"] for run in runs)))
+        for count, runs in by_nodes.items()
+    ]
+    mean_x = statistics.mean(x for x, _ in points)
+    mean_y = statistics.mean(y for _, y in points)
+    exponent = 1.0
+    if len(points) > 1:
+        exponent = sum((x - mean_x) * (y - mean_y) for x, y in points) / sum(
+            (x - mean_x) ** 2 for x, _ in points
+        )
+        exponent = min(max(exponent, 0.0), 1.0)
+    rate = math.exp(mean_y + exponent * (math.log(nodes) - mean_x))
+    closest = min(by_nodes, key=lambda count: abs(math.log(count / nodes)))
+    return (
+        rate,
+        statistics.mean(run["setup"] for run in by_nodes[closest]),
+        "scaled from {} nodes (nodes^{:.2f}), {}".format(
+            ",".join(str(count) for count in sorted(by_nodes)), exponent, basis
+        ),
+    )
+
+
+def plan(found, nodes, cap, walltime, margin):
+    """Return the EndTime and the time limit of a run taking walltime
+    seconds, and the runs used, or None without runs"""
+    estimated = estimate(found, nodes, cap)
+    if estimated is None:
+        return None
+    rate, setup, basis = estimated
+    end_time = math.floor(10 * (walltime - setup) * rate) / 10
+    if end_time <= 0:
+        sys.exit(
+            "A wall time of {} s does not leave time to simulate after a setup "
+            "of {:.0f} s".format(walltime, setup)
+        )
+    return end_time, time_text(walltime * (1 + margin)), basis
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--db",
+        type=Path,
+        default=Path(store.DATABASE),
+        help="results database (default results.db)",
+    )
+    parser.add_argument("--cluster", required=True, help="cluster")
+    parser.add_argument(
+        "--app", default="seissol", help="application (default seissol)"
+    )
+    parser.add_argument(
+        "--order", type=int, default=6, help="convergence order (default 6)"
+    )
+    parser.add_argument(
+        "--nodes", type=runs.int_list, default=[4], help="node counts (default 4)"
+    )
+    parser.add_argument(
+        "--caps",
+        type=runs.cap_list,
+        default=[None],
+        help='GPU power limits in W, "none" for uncapped (default none)',
+    )
+    parser.add_argument(
+        "--walltime",
+        type=parse_time,
+        default=parse_time("1:00:00"),
+        help="target wall time of a run, as in Slurm (default 1:00:00)",
+    )
+    parser.add_argument(
+        "--margin",
+        type=float,
+        default=0.2,
+        help="time limit above the target, as a fraction (default 0.2)",
+    )
+    args = parser.parse_args()
+
+    if not args.db.exists():
+        sys.exit("{}: no results database".format(args.db))
+    found = measurements(store.connect(args.db), args.cluster, args.order, args.app)
+    if not found:
+        sys.exit(
+            "{}: no runs of {} with order {}".format(args.db, args.cluster, args.order)
+        )
+    print(
+        "{:>6} {:>10} {:>10} {:>10}  {}".format(
+            "nodes", "limit W", "EndTime", "--time", "from"
+        )
+    )
+    for nodes in args.nodes:
+        for cap in args.caps:
+            end_time, limit, basis = plan(
+                found, nodes, cap, args.walltime, args.margin
+            )
+            print(
+                "{:>6} {:>10} {:>10.1f} {:>10}  {}".format(
+                    nodes, "none" if cap is None else cap, end_time, limit, basis
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,35 +4,56 @@ function usage {
         echo ""
         echo "Usage: setup-sim.sh [OPTS] <folder-name>"
         echo ""
-        echo "    --nodes=4|8  number of nodes to use for the simulation"
+        echo "    --nodes=N          number of nodes to use for the simulation (default 4)"
+        echo "    --end-time=SECONDS simulated time (default 40.0 on 4 nodes, 60.0 on 8)"
+        echo "    --time=TIME        time limit of the job (default of submit.slurm)"
+        echo ""
+        echo "For other node counts, or to target a wall time, get --end-time and --time"
+        echo "from earlier runs with: python3 -m pcap.walltime --cluster <cluster> --nodes N"
         echo ""
 }
 
-if [[ ! $# -eq 1 ]] && [[ ! $# -eq 2 ]]
+if [[ $# -lt 1 ]] || [[ $# -gt 4 ]]
 then
         usage
         exit 1
 fi
 
-# Get number of nodes to use
+# Get options
 num_nodes=4
-if [[ $# -eq 2 ]]
+sim_time=""
+time_limit=""
+while [[ $# -gt 1 ]]
+do
+        case "$1" in
+                --nodes=*) num_nodes=${1#*=};;
+                --end-time=*) sim_time=${1#*=};;
+                --time=*) time_limit=${1#*=};;
+                *)
+                        echo "Invalid option: $1"
+                        usage
+                        exit 1;;
+        esac
+        shift
+done
+if [[ ! "$num_nodes" =~ ^[1-9][0-9]*$ ]]
 then
-        if [[ "$1" =~ --nodes=[4,8] ]]
-        then
-                num_nodes=$(echo $1 | cut -d '=' -f 2)
-        else
-                echo "Invalid option: $1"
-                usage
-                exit 1
-        fi
+        echo "Invalid number of nodes: $num_nodes"
+        usage
+        exit 1
 fi
 
 # Set simulation time for around 1h of walltime
-sim_time="40.0"
-if [[ $num_nodes -eq 8 ]]
+if [[ -z "$sim_time" ]]
 then
-        sim_time="60.0"
+        case $num_nodes in
+                4) sim_time="40.0";;
+                8) sim_time="60.0";;
+                *)
+                        echo "No default simulation time for $num_nodes nodes: use --end-time"
+                        usage
+                        exit 1;;
+        esac
 fi
 
 # Move to where this script is located
@@ -40,19 +61,17 @@ cd $(realpath $(dirname $0))
 
 # Get input and simulation directories
 INPUT_DIR=$(realpath ./input)
-
-if [[ "$#" -eq 2 ]]
-then
-        SIM_DIR=$(realpath $2)
-else
-        SIM_DIR=$(realpath $1)
-fi
+SIM_DIR=$(realpath $1)
 
 # Create sim directory
 mkdir -p $SIM_DIR
 
 # Create soft link to container
 ln -s $INPUT_DIR/seissol.sif $SIM_DIR/seissol.sif
+if [[ -f $INPUT_DIR/seissol-overlay.sqsh ]]
+then
+        ln -s $INPUT_DIR/seissol-overlay.sqsh $SIM_DIR/seissol-overlay.sqsh
+fi
 
 # Create soft link to input files
 for file in $(find $INPUT_DIR/Turkey -type f -name *.yaml)
@@ -73,3 +92,7 @@ sed -i "s/EndTime = 150.0/EndTime = $sim_time/g" $SIM_DIR/parameters.par
 
 cp $INPUT_DIR/submit.slurm $SIM_DIR/submit.slurm
 sed -i "s/#SBATCH --nodes=2/#SBATCH --nodes=$num_nodes/g" $SIM_DIR/submit.slurm
+if [[ -n "$time_limit" ]]
+then
+        sed -i "s/^#SBATCH --time=.*/#SBATCH --time=$time_limit/" $SIM_DIR/submit.slurm
+fi
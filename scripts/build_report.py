@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""Summarize the build logs written by recipes generated with the
+"build-log" userarg (see containers/common/buildlog.py).
+
+Building blocks and steps are ranked by wall time (or by CPU time, CPU
+efficiency, idle core-hours or peak memory). Only the latest build of each
+step is taken into account, so that logs of incremental builds can be
+appended to the same file.
+
+Example:
+    scripts/build_report.py --top 10 /path/to/buildlog/seissol.jsonl
+"""
+
+import argparse
+import json
+import sys
+
+SORT_KEYS = {
+    "wall": lambda r: r["wall_s"],
+    "cpu": lambda r: r["cpu_s"],
+    # Least efficient first
+    "efficiency": lambda r: -r["cpu_efficiency"],
+    "idle": lambda r: r["idle_core_h"],
+    "memory": lambda r: r["mem_peak_mib"],
+}
+
+
+def read_records(files):
+    """Return the records of all log files, keeping only the latest run of
+    each step"""
+    records = []
+    for file in files:
+        with open(file) as log:
+            records.extend(json.loads(line) for line in log if line.strip())
+
+    # Runs of a step follow each other, the run of its last record is the
+    # latest one
+    latest = {}
+    for record in sorted(records, key=lambda r: r["start"]):
+        latest[record["step"]] = record["run"]
+    return [r for r in records if latest[r["step"]] == r["run"]]
+
+
+def idle_core_hours(wall, cpu, cores):
+    """Core-hours not used by a build (i.e. room for more parallelism)"""
+    return max(wall * cores - cpu, 0) / 3600
+
+
+def block_rows(records):
+    """Return one row per building block"""
+    rows = []
+    for record in records:
+        rows.append(
+            dict(
+                step=record["step"],
+                name=record["block"],
+                description=record["description"],
+                wall_s=record["wall_s"],
+                cpu_s=record["cpu_s"],
+                cpu_efficiency=record["cpu_efficiency"],
+                idle_core_h=idle_core_hours(
+                    record["wall_s"], record["cpu_s"], record["cores"]
+                ),
+                mem_peak_mib=record["mem_peak_mib"],
+            )
+        )
+    return rows
+
+
+def step_rows(records):
+    """Return one row per step, adding up its building blocks"""
+    steps = {}
+    for record in records:
+        step = steps.setdefault(
+            record["step"],
+            dict(
+                step=record["step"],
+                description="",
+                wall_s=0.0,
+                cpu_s=0.0,
+                core_s=0.0,
+                blocks=0,
+                mem_peak_mib=0,
+            ),
+        )
+        step["wall_s"] += record["wall_s"]
+        step["cpu_s"] += record["cpu_s"]
+        step["core_s"] += record["wall_s"] * record["cores"]
+        step["blocks"] += 1
+        step["mem_peak_mib"] = max(step["mem_peak_mib"], record["mem_peak_mib"])
+        if not step["description"]:
+            step["description"] = record["description"]
+    for step in steps.values():
+        step["name"] = "{} blocks".format(step["blocks"])
+        step["cpu_efficiency"] = (
+            step["cpu_s"] / step["core_s"] if step["core_s"] else 0.0
+        )
+        step["idle_core_h"] = max(step["core_s"] - step["cpu_s"], 0) / 3600
+    return list(steps.values())
+
+
+def duration(seconds):
+    """Format a duration as h:mm:ss"""
+    seconds = int(round(seconds))
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def print_table(title, rows, total_wall):
+    print(title)
+    print(
+        "{:<7} {:<16} {:>9} {:>6} {:>11} {:>5} {:>10} {:>9}  {}".format(
+            "step",
+            "block",
+            "wall",
+            "share",
+            "cpu-hours",
+            "eff",
+            "idle c-h",
+            "peak MiB",
+            "description",
+        )
+    )
+    line = "{:<7} {:<16} {:>9} {:>5.1f}% {:>11.2f} {:>4.0f}% {:>10.2f} {:>9}  {}"
+    for row in rows:
+        print(
+            line.format(
+                row["step"],
+                row["name"][:16],
+                duration(row["wall_s"]),
+                100 * row["wall_s"] / total_wall if total_wall else 0,
+                row["cpu_s"] / 3600,
+                100 * row["cpu_efficiency"],
+                row["idle_core_h"],
+                row["mem_peak_mib"],
+                row["description"][:50],
+            )
+        )
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("logs", nargs="+", help="build log files (JSON lines)")
+    parser.add_argument(
+        "--sort", choices=sorted(SORT_KEYS), default="wall", help="ranking key"
+    )
+    parser.add_argument(
+        "--top", type=int, default=0, help="only show the first N building blocks"
+    )
+    args = parser.parse_args()
+
+    records = read_records(args.logs)
+    if not records:
+        sys.exit("no build records found")
+
+    total_wall = sum(record["wall_s"] for record in records)
+    blocks = sorted(block_rows(records), key=SORT_KEYS[args.sort], reverse=True)
+    steps = sorted(step_rows(records), key=SORT_KEYS[args.sort], reverse=True)
+    print_table("Steps", steps, total_wall)
+    print_table("Building blocks", blocks[: args.top or None], total_wall)
+    print(
+        "Total: {} in {} building blocks ({} steps)".format(
+            duration(total_wall), len(blocks), len(steps)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
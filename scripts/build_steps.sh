@@ -0,0 +1,192 @@
+#!/bin/bash
+
+# Script that builds a singularity definition file step by step.
+# Takes as input the .def file to be built and, optionally, the
+# path of the final image (defaults to the .def file name with a
+# .sif extension).
+# Steps already built by a previous run are taken from a local
+# cache, so the build starts from the first step that changed.
+# Steps which do not depend on each other (see generate_steps.sh)
+# are built at the same time, up to the number given with -j.
+# If the recipe ships the application files in an overlay (see
+# containers/common/buildsteps.py), the overlay is written next to
+# the image, as <image>-overlay.sqsh.
+
+function usage {
+    echo "Usage: $0 [-j <max-parallel-steps>] <my-container.def> [my-container.sif]"
+}
+
+JOBS=1
+if [[ "$1" == "-j" ]]
+then
+    JOBS=$2
+    shift 2
+fi
+
+if [[ ! $# -eq 1 ]] && [[ ! $# -eq 2 ]]
+then
+    usage
+    exit 1
+fi
+
+# The following environment variables can be used to customize
+# the build:
+#
+# STEP_CACHE  folder where built steps are stored, as <key>.sif
+#             (default: ~/.cache/powercapping/steps)
+# APPTAINER   command used to build images (default: apptainer)
+# BUILD_OPTS  extra options passed to "build" (e.g. --fakeroot)
+# MKSQUASHFS_ARGS
+#             compression of the final image, passed to mksquashfs
+#             (e.g. "-comp zstd -b 1M", default: as built by apptainer)
+STEP_CACHE=${STEP_CACHE:-$HOME/.cache/powercapping/steps}
+APPTAINER=${APPTAINER:-apptainer}
+mkdir -p $STEP_CACHE
+STEP_CACHE=$(realpath $STEP_CACHE)
+
+RECIPE_FILE=$(realpath "$1")
+if [[ $# -eq 2 ]]
+then
+    OUTPUT_IMAGE=$(realpath "$2")
+else
+    OUTPUT_IMAGE="${RECIPE_FILE%.def}.sif"
+fi
+
+# Split the recipe in steps and compute the key of each step
+# (see generate_steps.sh)
+$(dirname $(realpath $0))/generate_steps.sh $RECIPE_FILE || exit 1
+STEPS_FOLDER=$(realpath "$(dirname $RECIPE_FILE)/steps")
+
+declare -A step_keys step_parents step_status step_pids
+all_steps=()
+while read step step_key parents
+do
+    all_steps+=($step)
+    step_keys[$step]=$step_key
+    step_parents[$step]=$parents
+done < $STEPS_FOLDER/steps.txt
+
+function build_step {
+    # Build from within the steps folder, so that each step
+    # finds the images of its parent steps, and move the image
+    # to the cache only once the build succeeded
+    local step=$1
+    local cached_image=$STEP_CACHE/${step_keys[$step]}.sif
+
+    rm -f $cached_image.partial
+    cd $STEPS_FOLDER \
+    && $APPTAINER build $BUILD_OPTS $cached_image.partial $step.def \
+        < /dev/null > $step.log 2>&1 \
+    && mv $cached_image.partial $cached_image
+}
+
+failed=0
+while true
+do
+    progress=0
+    running=0
+
+    # Collect finished builds
+    for step in ${all_steps[@]}
+    do
+        [[ ${step_status[$step]} == "running" ]] || continue
+        if kill -0 ${step_pids[$step]} 2> /dev/null
+        then
+            running=$((running + 1))
+        elif wait ${step_pids[$step]}
+        then
+            echo "$step: done"
+            step_status[$step]="done"
+            progress=1
+        else
+            echo "$step: build failed, see $STEPS_FOLDER/$step.log"
+            step_status[$step]="failed"
+            failed=1
+        fi
+    done
+
+    # Start steps whose parents are all built
+    for step in ${all_steps[@]}
+    do
+        [[ -z ${step_status[$step]} ]] && [[ $failed -eq 0 ]] || continue
+
+        ready=1
+        for parent in ${step_parents[$step]}
+        do
+            [[ ${step_status[$parent]} == "done" ]] || ready=0
+        done
+        [[ $ready -eq 1 ]] || continue
+
+        cached_image=$STEP_CACHE/${step_keys[$step]}.sif
+        ln -sfn $cached_image $STEPS_FOLDER/$step.sif
+        if [[ -f $cached_image ]]
+        then
+            echo "$step: cached (${step_keys[$step]})"
+            step_status[$step]="done"
+            progress=1
+        elif [[ $running -lt $JOBS ]]
+        then
+            echo "$step: building (${step_keys[$step]})"
+            build_step $step &
+            step_pids[$step]=$!
+            step_status[$step]="running"
+            running=$((running + 1))
+        fi
+    done
+
+    if [[ $running -eq 0 ]] && [[ $progress -eq 0 ]]
+    then
+        break
+    fi
+    if [[ $progress -eq 0 ]]
+    then
+        sleep 5
+    fi
+done
+
+last_step=${all_steps[-1]}
+if [[ $failed -ne 0 ]] || [[ ${step_status[$last_step]} != "done" ]]
+then
+    exit 1
+fi
+
+if [[ -n "$MKSQUASHFS_ARGS" ]]
+then
+    # Repack the last step with the requested compression
+    $APPTAINER build --force $BUILD_OPTS --mksquashfs-args "$MKSQUASHFS_ARGS" \
+        $OUTPUT_IMAGE $STEP_CACHE/${step_keys[$last_step]}.sif || exit 1
+else
+    cp $STEP_CACHE/${step_keys[$last_step]}.sif $OUTPUT_IMAGE
+fi
+echo "Image written to $OUTPUT_IMAGE"
+
+# Pack the application files into an overlay, taking each path from
+# the first step providing it
+overlay_marker=$(grep "^# $last_step: overlay " $RECIPE_FILE)
+if [[ -n "$overlay_marker" ]]
+then
+    overlay_marker=${overlay_marker#*: overlay }
+    overlay_paths=(${overlay_marker% from *})
+    overlay_sources=(${overlay_marker##* from })
+    OVERLAY_IMAGE="${OUTPUT_IMAGE%.sif}-overlay.sqsh"
+
+    staging=$(mktemp -d)
+    chmod 755 $staging
+    for source in ${overlay_sources[@]}
+    do
+        if [[ ${step_status[$source]} != "done" ]]
+        then
+            echo "Cannot write overlay: $source not built"
+            rm -rf $staging
+            exit 1
+        fi
+        $APPTAINER exec $STEP_CACHE/${step_keys[$source]}.sif sh -c \
+            'cd / && for path; do [ -e "${path#/}" ] && echo "${path#/}"; done | tar -cf - -T -' \
+            sh "${overlay_paths[@]}" \
+        | tar -C $staging --skip-old-files -xf - || { rm -rf $staging; exit 1; }
+    done
+    mksquashfs $staging $OVERLAY_IMAGE -noappend -all-root $MKSQUASHFS_ARGS > /dev/null \
+    || { rm -rf $staging; exit 1; }
+    rm -rf $staging
+    echo "Overlay written to $OVERLAY_IMAGE"
+fi
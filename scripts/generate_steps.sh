@@ -16,19 +16,37 @@ fi
 # step <N>: start
 #
 # where N is a consecutive number representing the step.
+# By default each step is built on top of the previous one.
+# Steps can instead be built on top of a different step, and
+# copy the install prefixes of other steps in their image,
+# through comments like the following (see buildsteps.py in
+# containers/common):
+#
+# step<N>: start after step<P> step<K>
+# step<N>: merge step<J> from step<K>
+# step<N>: prefix /usr/local/foo
+#
+# where step<P> is the image step<N> is built on, and the
+# prefixes of step<J> are copied from the image of step<K>.
 
 # .def files for each step will be placed in a "steps" folder 
 # in the same directory of this script and "seissol_thea.def"
 STEPS_FOLDER=$(realpath "$(dirname $1)/steps")
 mkdir -p $STEPS_FOLDER
 
+# Remove .def files left over from previous runs, which could
+# contain more steps than the current recipe
+rm -f $STEPS_FOLDER/step*.def $STEPS_FOLDER/steps.txt
+
 # Get lines corresponding to each step's starting point
 RECIPE_FILE=$(realpath "$1")
-start_lines=($(grep -n "step[0-9]: start" $RECIPE_FILE | cut -d ':' -f 1))
+start_lines=($(grep -n "^# step[0-9]\+: start" $RECIPE_FILE | cut -d ':' -f 1))
 
+declare -A step_keys step_prefixes
 for i in $(seq 1 $((${#start_lines[@]})))
 do
-    step_file=$STEPS_FOLDER/step$i.def
+    step=step$i
+    step_file=$STEPS_FOLDER/$step.def
     step_start=${start_lines[$((i-1))]}
     step_end=${start_lines[$i]}
 
@@ -38,6 +56,28 @@ do
         step_end=$(($(wc -l $RECIPE_FILE | cut -d ' ' -f 1) + 1))
     fi
 
+    # Isolate section relative to the current step
+    # (only used to get the step's dependencies below)
+    step_section=$(
+        cat $RECIPE_FILE \
+        | head -n "$((step_end-1))" \
+        | tail -n "+$((step_start+1))"
+    )
+
+    # Get parent steps, prefixes and steps to merge
+    step_marker=$(sed -n "${step_start}p" $RECIPE_FILE)
+    if [[ $i -eq 1 ]]
+    then
+        parents=()
+    elif [[ "$step_marker" == *": start after "* ]]
+    then
+        parents=(${step_marker#*: start after })
+    else
+        parents=(step$((i-1)))
+    fi
+    step_prefixes[$step]=$(echo "$step_section" | grep "^# $step: prefix " | cut -d ' ' -f 4-)
+    merges=$(echo "$step_section" | grep "^# $step: merge " | cut -d ' ' -f 4,6)
+
     if [[ $i -eq 1 ]]
     then 
         # Copy bootstrap image from original file
@@ -47,20 +87,70 @@ do
         | sed "/Stage: devel/d" \
         > $step_file
     else
-        # Bootstrap from previous step image"
-        echo "BootStrap: localimage" > $step_file
-        echo "From: step$((i-1)).sif" >> $step_file
+        # Declare the images to merge as separate stages
+        : > $step_file
+        for source in ${parents[@]:1}
+        do
+            echo "BootStrap: localimage" >> $step_file
+            echo "From: $source.sif" >> $step_file
+            echo "Stage: $source" >> $step_file
+            echo "" >> $step_file
+        done
+
+        # Bootstrap from parent step image"
+        echo "BootStrap: localimage" >> $step_file
+        echo "From: ${parents[0]}.sif" >> $step_file
         
         # Add "Stage: devel" to runtime image def file
         if [[ $i -eq ${#start_lines[@]} ]]
         then
             echo "Stage: devel" >> $step_file
+        elif [[ ${#parents[@]} -gt 1 ]]
+        then
+            echo "Stage: $step" >> $step_file
         fi
+
+        # Copy prefixes and environment of merged steps
+        while read merged source
+        do
+            [[ -z $merged ]] && continue
+            if [[ -z ${step_prefixes[$merged]} ]]
+            then
+                echo "Cannot merge $merged into $step: no prefix defined"
+                exit 1
+            fi
+            echo "%files from $source" >> $step_file
+            for prefix in ${step_prefixes[$merged]}
+            do
+                echo "    $prefix $prefix" >> $step_file
+            done
+            awk '/^%environment/ {p=1; print; next} /^[^ \t]/ {p=0} p' \
+                $STEPS_FOLDER/$merged.def >> $step_file
+            awk '/^%environment/ {p=1; print "%post"; next} /^[^ \t]/ {p=0} p' \
+                $STEPS_FOLDER/$merged.def >> $step_file
+        done <<< "$merges"
     fi
 
-    # Isolate section relative to the current step
+    # Append section relative to the current step
     cat $RECIPE_FILE \
     | head -n "$((step_end-1))" \
     | tail -n "+$((step_start+1))" \
     >> $step_file
-done
\ No newline at end of file
+
+    # Key the step by the hash of its own .def file and of the keys
+    # of its parent steps, so that any change to a step invalidates
+    # all the steps built on top of it.
+    # Keys are listed in steps.txt as "<step> <key> [<parents>...]".
+    step_keys[$step]=$(
+        {
+            cat $step_file
+            for parent in ${parents[@]}
+            do
+                echo ${step_keys[$parent]}
+            done
+        } | sha256sum | cut -d ' ' -f 1
+    )
+    echo "$step ${step_keys[$step]} ${parents[@]}" \
+    | sed 's/ *$//' \
+    >> $STEPS_FOLDER/steps.txt
+done
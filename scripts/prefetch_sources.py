@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""Download all sources fetched by one or more definition files into a
+local source mirror (see containers/common/mirror.py for its layout).
+
+Files are downloaded concurrently, git repositories (and their submodules)
+are cloned as bare mirrors, and Python packages installed with pip are
+downloaded with their dependencies, as wheels for the platform and the
+Python of the images built from the config files given with --config (not
+for the host). Running the script again only fetches what is missing, and
+updates the git mirrors.
+
+Example:
+    scripts/prefetch_sources.py -j 8 --config configs/thea.json /scratch/mirror \
+        containers/seissol/seissol_thea.def
+"""
+
+import argparse
+import json
+import re
+import shutil
+import subprocess
+import sys
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Downloads generated by the hpccm wget template
+WGET_RE = re.compile(
+    r"wget -q -nc --no-check-certificate (?:-O \S+ )?-P \S+ (\S+)"
+)
+# Git clones generated by the hpccm git template, or written by hand
+GIT_RE = re.compile(r"git clone [^&;|]*?((?:https?|git)://\S+?)(?=\s)")
+# Packages installed with pip, possibly from a git repository
+PIP_RE = re.compile(r"pip3? install ((?:(?!&&)[^;|\\\n])+)")
+# Python 3 and glibc minor version (2.x) of the base OS of the images
+DISTROS = {
+    "ubuntu20": ("3.8", 31),
+    "ubuntu22": ("3.10", 35),
+    "ubuntu24": ("3.12", 39),
+}
+# Build backend of the packages installed from git, for the isolated builds
+# of pip without index
+BUILD_REQUIREMENTS = ["setuptools", "wheel"]
+
+
+def location(url):
+    """Return the location of a URL in the mirror, i.e., host/path"""
+    return url.split("://", 1)[1].split("?", 1)[0].rstrip("/")
+
+
+def parse(files):
+    """Return the files, git repositories and pip requirements fetched by
+    a list of definition files"""
+    downloads, repositories, requirements = set(), set(), set()
+    for file in files:
+        text = Path(file).read_text()
+        downloads.update(WGET_RE.findall(text))
+        repositories.update(GIT_RE.findall(text))
+        for args in PIP_RE.findall(text):
+            for arg in args.split():
+                if arg.startswith("git+"):
+                    url = arg[len("git+") :].rsplit("@", 1)[0]
+                    repositories.add(url)
+                    requirements.add(arg)
+                elif not arg.startswith(("-", "/", ".")):
+                    requirements.add(arg)
+    return sorted(downloads), sorted(repositories), sorted(requirements)
+
+
+def download(mirror, url):
+    """Download a file into the mirror, unless already there"""
+    path = mirror / "files" / location(url)
+    if path.exists():
+        return "cached {}".format(url)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_name(path.name + ".partial")
+    request = urllib.request.Request(url, headers={"User-Agent": "Wget"})
+    with urllib.request.urlopen(request) as response, open(partial, "wb") as out:
+        shutil.copyfileobj(response, out)
+    partial.rename(path)
+    return "downloaded {}".format(url)
+
+
+def git(*args, cwd=None):
+    """Run a git command, returning its output"""
+    return subprocess.run(
+        ["git", *args], cwd=cwd, check=True, capture_output=True, text=True
+    ).stdout
+
+
+def submodules(path):
+    """Return the URLs of the submodules of all branches and tags of a bare
+    repository, resolving relative URLs"""
+    urls = set()
+    origin = git("config", "--get", "remote.origin.url", cwd=path).strip()
+    for ref in git("for-each-ref", "--format=%(refname)", cwd=path).split():
+        try:
+            config = git(
+                "config", "--blob", "{}:.gitmodules".format(ref), "--list", cwd=path
+            )
+        except subprocess.CalledProcessError:
+            continue
+        for line in config.splitlines():
+            key, _, url = line.partition("=")
+            if not key.endswith(".url"):
+                continue
+            if url.startswith(("./", "../")):
+                base = origin.rstrip("/")
+                while url.startswith(("./", "../")):
+                    if url.startswith("../"):
+                        base = base.rsplit("/", 1)[0]
+                    url = url.split("/", 1)[1]
+                url = "{}/{}".format(base, url)
+            if "://" not in url:
+                continue
+            urls.add(url)
+    return urls
+
+
+def clone(mirror, url):
+    """Clone a git repository into the mirror, or update it, and return
+    the URLs of its submodules"""
+    path = mirror / "git" / location(url)
+    if path.exists():
+        git("remote", "update", "--prune", cwd=path)
+        message = "updated {}".format(url)
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        git("clone", "--mirror", url, str(path))
+        message = "cloned {}".format(url)
+    return message, submodules(path)
+
+
+def pip_platform(config_file):
+    """Return the pip options selecting the wheels for the images built from
+    a config file"""
+    with open(config_file) as file:
+        config = json.load(file)
+    if config["base_os"] not in DISTROS:
+        sys.exit("{}: unsupported base OS {}".format(config_file, config["base_os"]))
+    python, glibc = DISTROS[config["base_os"]]
+    # pip does not select the older manylinux tags supported by the glibc,
+    # except those of manylinux2014 (glibc 2.17)
+    platforms = [
+        "manylinux_2_{}_{}".format(minor, config["arch"])
+        for minor in range(glibc, 17, -1)
+    ] + ["manylinux2014_{}".format(config["arch"])]
+    options = []
+    for platform in platforms:
+        options += ["--platform", platform]
+    return options + [
+        "--python-version",
+        python,
+        "--implementation",
+        "cp",
+        "--only-binary=:all:",
+    ]
+
+
+def pip_download(mirror, requirements, platform):
+    """Download Python packages, with their dependencies, into the mirror,
+    for a platform (pip options)"""
+    if any(requirement.startswith("git+") for requirement in requirements):
+        requirements = requirements + BUILD_REQUIREMENTS
+    subprocess.run(
+        [sys.executable, "-m", "pip", "download", "--dest", str(mirror / "pypi")]
+        + platform
+        + requirements,
+        check=True,
+    )
+
+
+def check(mirror, downloads, repositories):
+    """Return the sources missing from the mirror"""
+    missing = [
+        url for url in downloads if not (mirror / "files" / location(url)).exists()
+    ]
+    missing += [
+        url for url in repositories if not (mirror / "git" / location(url)).exists()
+    ]
+    return missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("mirror", type=Path, help="folder of the source mirror")
+    parser.add_argument("defs", nargs="+", help="definition files to prefetch")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=8, help="parallel downloads"
+    )
+    parser.add_argument(
+        "--config",
+        action="append",
+        default=[],
+        help="config file of the images, for the platform of their Python "
+        "packages (can be repeated)",
+    )
+    parser.add_argument(
+        "--pip", action="append", default=[], help="extra pip requirements"
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="do not download, only list sources missing from the mirror",
+    )
+    args = parser.parse_args()
+
+    downloads, repositories, requirements = parse(args.defs)
+    requirements = sorted(set(requirements + args.pip))
+    if requirements and not args.check and not args.config:
+        sys.exit("Python packages are downloaded for the images: give their --config")
+    platforms = [pip_platform(config) for config in args.config]
+
+    if args.check:
+        missing = check(args.mirror, downloads, repositories)
+        for url in missing:
+            print("missing {}".format(url))
+        sys.exit(1 if missing else 0)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        tasks = {pool.submit(download, args.mirror, url): url for url in downloads}
+        tasks.update(
+            {pool.submit(clone, args.mirror, url): url for url in repositories}
+        )
+        seen = set(repositories)
+        while tasks:
+            task = next(iter(tasks))
+            url = tasks.pop(task)
+            try:
+                result = task.result()
+            except Exception as error:
+                failed.append(url)
+                print("failed {}: {}".format(url, error), file=sys.stderr)
+                continue
+            if isinstance(result, tuple):
+                result, urls = result
+                for sub in sorted(urls - seen):
+                    seen.add(sub)
+                    tasks[pool.submit(clone, args.mirror, sub)] = sub
+            print(result)
+
+    if requirements:
+        for platform in dict.fromkeys(tuple(platform) for platform in platforms):
+            pip_download(args.mirror, requirements, list(platform))
+
+    if failed:
+        sys.exit("{} sources could not be fetched".format(len(failed)))
+
+
+if __name__ == "__main__":
+    main()
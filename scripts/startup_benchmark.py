@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Compare the squashfs compression settings of a container image by
+image size and startup time.
+
+The "pack" command repacks an image with each compression setting, given
+as COMP[:LEVEL][@BLOCK] (e.g. gzip, lz4, lz4:hc, zstd:19@1M). The "run"
+command measures, for each image, its size and the time of:
+
+- cold exec: "apptainer exec <image> true" with the image evicted from the
+  page cache of the node,
+- warm exec: the same, with the image in the page cache (median of the
+  repetitions),
+- cold/warm binary: running the application binary (e.g. with --help)
+  instead of "true", i.e., including the loading of the binary and of its
+  libraries from the image.
+
+Run under srun (one task per node) to measure the startup of many nodes at
+once, with --json to write one record per node and image, and summarize
+the records with the "report" command (slowest node of each image).
+
+Example:
+    scripts/startup_benchmark.py pack seissol.sif gzip lz4 zstd:3@1M zstd:19@1M
+    srun -N 8 --ntasks-per-node=1 scripts/startup_benchmark.py run --json \\
+        --exec-opts=--nv --binary "SeisSol_Release_ssm_90_cuda_6_elastic --help" \\
+        seissol*.sif > startup.jsonl
+    scripts/startup_benchmark.py report startup.jsonl
+"""
+
+import argparse
+import json
+import os
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+APPTAINER = os.environ.get("APPTAINER", "apptainer")
+COMPRESSORS = ["gzip", "lz4", "lzo", "xz", "zstd"]
+METRICS = ["cold_exec_s", "warm_exec_s", "cold_binary_s", "warm_binary_s"]
+
+
+def mksquashfs_args(setting):
+    """Return the name and the mksquashfs arguments of a compression
+    setting COMP[:LEVEL][@BLOCK]"""
+    compression, _, block = setting.partition("@")
+    comp, _, level = compression.partition(":")
+    if comp not in COMPRESSORS:
+        raise ValueError("Invalid compression: {}".format(comp))
+    args = ["-comp", comp]
+    if level == "hc" and comp == "lz4":
+        args.append("-Xhc")
+    elif level and comp != "lz4":
+        args += ["-Xcompression-level", level]
+    elif level:
+        raise ValueError("Invalid compression level for lz4: {}".format(level))
+    if block:
+        args += ["-b", block]
+    name = "-".join(part for part in [comp, level, block] if part)
+    return name, args
+
+
+def pack(image, settings, output):
+    """Repack an image with each compression setting"""
+    output.mkdir(parents=True, exist_ok=True)
+    for setting in settings:
+        name, args = mksquashfs_args(setting)
+        packed = output / "{}-{}.sif".format(Path(image).stem, name)
+        print("packing {} ({})".format(packed, " ".join(args)))
+        subprocess.run(
+            [APPTAINER, "build", "--force", "--mksquashfs-args", " ".join(args)]
+            + [str(packed), str(image)],
+            check=True,
+        )
+
+
+def evict(image):
+    """Drop an image from the page cache of the node"""
+    fd = os.open(image, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def timed(command):
+    """Return the wall time of a command"""
+    start = time.perf_counter()
+    subprocess.run(
+        command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return time.perf_counter() - start
+
+
+def measure(image, exec_opts, binary, repeat):
+    """Return the size and startup times of an image"""
+    exec_cmd = [APPTAINER, "exec"] + exec_opts + [image]
+    record = dict(
+        image=Path(image).name,
+        host=socket.gethostname(),
+        rank=int(os.environ.get("SLURM_PROCID", 0)),
+        size_mib=round(os.path.getsize(image) / 2**20, 1),
+    )
+    commands = {"exec": exec_cmd + ["true"]}
+    if binary:
+        commands["binary"] = exec_cmd + shlex.split(binary)
+    for name, command in commands.items():
+        evict(image)
+        record["cold_{}_s".format(name)] = round(timed(command), 3)
+        warm = [timed(command) for _ in range(repeat)]
+        record["warm_{}_s".format(name)] = round(statistics.median(warm), 3)
+    return record
+
+
+def print_table(records):
+    print(
+        "{:<40} {:>10} {:>10} {:>10} {:>12} {:>12}".format(
+            "image", "size MiB", "cold exec", "warm exec", "cold binary", "warm binary"
+        )
+    )
+    for record in records:
+        times = [record.get(metric) for metric in METRICS]
+        print(
+            "{:<40} {:>10.1f} ".format(record["image"][:40], record["size_mib"])
+            + " ".join(
+                "{:>{}}".format("-" if t is None else "{:.3f}".format(t), width)
+                for t, width in zip(times, [10, 10, 12, 12])
+            )
+        )
+
+
+def report(files):
+    """Return the slowest record of each image over all nodes"""
+    images = {}
+    for file in files:
+        with open(file) as log:
+            for line in log:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                slowest = images.setdefault(record["image"], dict(record, nodes=0))
+                slowest["nodes"] += 1
+                for metric in METRICS:
+                    if metric in record:
+                        slowest[metric] = max(slowest[metric], record[metric])
+    return sorted(images.values(), key=lambda r: r["size_mib"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    pack_parser = commands.add_parser("pack", help="repack an image")
+    pack_parser.add_argument("image", help="image to repack")
+    pack_parser.add_argument(
+        "settings", nargs="+", help="compression settings, COMP[:LEVEL][@BLOCK]"
+    )
+    pack_parser.add_argument(
+        "-o", "--output", type=Path, default=Path("."), help="output folder"
+    )
+
+    run_parser = commands.add_parser("run", help="measure startup times")
+    run_parser.add_argument("images", nargs="+", help="images to measure")
+    run_parser.add_argument(
+        "--exec-opts", default="", help='options of "apptainer exec" (e.g. --nv)'
+    )
+    run_parser.add_argument(
+        "--binary", default="", help="application command run in the images"
+    )
+    run_parser.add_argument(
+        "-r", "--repeat", type=int, default=5, help="warm repetitions"
+    )
+    run_parser.add_argument(
+        "--json", action="store_true", help="print one JSON record per image"
+    )
+
+    report_parser = commands.add_parser("report", help="summarize JSON records")
+    report_parser.add_argument("records", nargs="+", help="JSON lines files")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        try:
+            pack(args.image, args.settings, args.output)
+        except ValueError as error:
+            sys.exit(error)
+    elif args.command == "run":
+        records = []
+        for image in args.images:
+            record = measure(
+                image, shlex.split(args.exec_opts), args.binary, args.repeat
+            )
+            if args.json:
+                print(json.dumps(record), flush=True)
+            records.append(record)
+        if not args.json:
+            print_table(records)
+    else:
+        print_table(report(args.records))
+
+
+if __name__ == "__main__":
+    main()